@@ -0,0 +1,38 @@
+"""
+Measures the per-request overhead of getting a BlobStorage instance:
+constructing a new client per request (old behaviour) versus the shared pooled client.
+
+No network access is needed, the clients are built from a dummy connection string.
+Token acquisition (managed identity mode) is not included, the shared client saves that cost on top.
+
+Usage:
+    python benchmarks/bench_blobstorage_client.py [--requests 2000]
+"""
+import argparse, os, sys, time, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault(
+    "AZURE_STORAGEBLOB_CONNECTIONSTRING",
+    "DefaultEndpointsProtocol=https;AccountName=benchaccount;AccountKey=YmVuY2htYXJrYmVuY2htYXJrYmVuY2htYXJr;EndpointSuffix=core.windows.net"
+)
+
+from chat_bot.azurestorage import BlobStorage, get_shared_blob_storage
+
+
+def measure(name : str, factory, requests : int):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        bs = factory()
+        bs.getBaseUrl()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{name:<24} mean {statistics.mean(timings):8.4f} ms   p50 {timings[len(timings) // 2]:8.4f} ms   p99 {timings[int(len(timings) * 0.99) - 1]:8.4f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BlobStorage per-request overhead")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    measure("new client per request", BlobStorage, args.requests)
+    measure("shared pooled client", get_shared_blob_storage, args.requests)
@@ -0,0 +1,96 @@
+"""
+Measures the local index (chat_bot/localindex.py) on synthetic data:
+load time, latency of the brute force, IVF, keyword and hybrid search (with and without a path prefix filter)
+and the recall@k of the IVF search against brute force for several nprobe values.
+
+No network access is needed, the documents and the (clustered) embeddings are generated.
+
+Usage:
+    python benchmarks/bench_local_index.py [--documents 50000] [--dimensions 1536] [--ivf-lists 0] [--queries 200] [--top 10]
+"""
+import argparse, os, sys, tempfile, time, shutil
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from chat_bot.localindex import LocalVectorIndex, build_local_index
+
+WORDS = [ "travel", "expense", "policy", "holiday", "contract", "salary", "invoice", "laptop", "security", "training",
+          "office", "parking", "insurance", "pension", "overtime", "remote", "onboarding", "budget", "approval", "receipt" ]
+
+
+def generate(documents : int, dimensions : int, seed : int = 0):
+    rnd = np.random.default_rng(seed)
+    topics = rnd.normal(size = (max(8, documents // 500), dimensions)).astype(np.float32)
+    topic = rnd.integers(len(topics), size = documents)
+    vectors = topics[topic] + 0.6 * rnd.normal(size = (documents, dimensions)).astype(np.float32)
+    docs = [
+        {
+            "content": " ".join(WORDS[(t + j * 7 + i) % len(WORDS)] for j in range(40)) + " document" + str(i),
+            "title": "document-" + str(i) + ".pdf",
+            "url": "https://benchaccount.blob.core.windows.net/documents/folder" + str(i % 10) + "/document-" + str(i) + ".pdf",
+            "filepath": "document-" + str(i) + "_pages_0"
+        }
+        for i, t in enumerate(topic)
+    ]
+    queries = topics[rnd.integers(len(topics), size = 1000)] + 0.6 * rnd.normal(size = (1000, dimensions)).astype(np.float32)
+    return docs, vectors, queries
+
+
+def measure(name : str, fn, queries : int):
+    timings = [ ]
+    for i in range(queries):
+        start = time.perf_counter()
+        fn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f"{name:<40} p50 {timings[len(timings) // 2]:8.3f} ms   p99 {timings[max(0, int(len(timings) * 0.99) - 1)]:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Recall and latency of the local index")
+    parser.add_argument("--documents", type = int, default = 50000)
+    parser.add_argument("--dimensions", type = int, default = 1536)
+    parser.add_argument("--ivf-lists", type = int, default = 0, help = "number of IVF lists (default: sqrt of the documents)")
+    parser.add_argument("--queries", type = int, default = 200)
+    parser.add_argument("--top", type = int, default = 10)
+    args = parser.parse_args()
+    ivfLists = args.ivf_lists if args.ivf_lists > 0 else int(np.sqrt(args.documents))
+
+    docs, vectors, queries = generate(args.documents, args.dimensions)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "index")
+        start = time.perf_counter()
+        build_local_index(path, docs, vectors, ivfLists)
+        print(f"build of {args.documents} documents with {ivfLists} IVF lists: {time.perf_counter() - start:.1f} s")
+        start = time.perf_counter()
+        index = LocalVectorIndex(path)
+        print(f"load: {(time.perf_counter() - start) * 1000:.2f} ms")
+        filter = "search.ismatch('\"https\\:\\/\\/benchaccount.blob.core.windows.net\\/documents\\/folder3\\/*\"', 'metadata_storage_path')"
+        candidates = index.getCandidates(filter)
+        q = lambda i: queries[i % len(queries)]
+
+        measure("vectors, brute force", lambda i: index.searchVectors(q(i), args.top), args.queries)
+        measure("vectors, brute force, prefix filter", lambda i: index.searchVectors(q(i), args.top, candidates), args.queries)
+        for nprobe in [ 1, 4, 8, 16, 32 ]:
+            if nprobe >= ivfLists:
+                break
+            measure(f"vectors, ivf nprobe={nprobe}", lambda i: index.searchVectors(q(i), args.top, None, nprobe), args.queries)
+        measure("keywords (bm25)", lambda i: index.searchKeywords(WORDS[i % len(WORDS)] + " " + WORDS[(i * 3) % len(WORDS)], args.top), args.queries)
+        measure("hybrid, ivf nprobe=8", lambda i: index.search(WORDS[i % len(WORDS)], q(i), args.top, "", 8), args.queries)
+        measure("hybrid, ivf nprobe=8, prefix filter", lambda i: index.search(WORDS[i % len(WORDS)], q(i), args.top, filter, 8), args.queries)
+
+        print(f"recall@{args.top} of the IVF search against brute force:")
+        exact = [ set(index.searchVectors(q(i), args.top)) for i in range(args.queries) ]
+        for nprobe in [ 1, 4, 8, 16, 32 ]:
+            if nprobe >= ivfLists:
+                break
+            found = sum(len(exact[i] & set(index.searchVectors(q(i), args.top, None, nprobe))) for i in range(args.queries))
+            print(f"    nprobe={nprobe:<4} {found / (args.queries * args.top):.3f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+
+if __name__ == "__main__":
+    main()
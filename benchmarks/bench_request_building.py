@@ -0,0 +1,74 @@
+"""
+Measures the cost per call of building a chat request (EasyChatClient.createRequestContext() and _buildChatRequest()):
+the role filter and the request template (azure_search data source, system message and request scope) built for every request
+versus compiled once per role and configuration and reused.
+The serialization of the request body by the openai sdk (json) is measured separately, it is the same for both.
+
+No network access is needed, nothing is sent.
+
+Usage:
+    python benchmarks/bench_request_building.py [--calls 20000] [--turns 3]
+"""
+import argparse, json, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault("OPENAI_API_BASE", "https://benchmark.openai.azure.com")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("AZURESEARCH_API_BASE", "https://benchmark.search.windows.net")
+
+from chat_bot.easy_chat import EasyChatClient, EasyChatMessage
+from chat_bot.iam import ChatbotRole
+
+STORAGE_BASE_URL = "https://benchaccount.blob.core.windows.net/documents"
+
+
+def messages(turns : int) -> list:
+    m = [ ]
+    for i in range(turns):
+        m.append(EasyChatMessage("user", "What is the travel expense limit for a trip to city " + str(i) + "?"))
+        m.append(EasyChatMessage("assistant", "The travel expense limit is 100 EUR per day [doc1]. " * 5))
+    m.append(EasyChatMessage("user", "And for the hotel?"))
+    return m
+
+
+def measure(name : str, fn, calls : int):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    print(f"{name:<48} {(time.perf_counter() - start) / calls * 1000000:8.2f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Cost of building a chat request")
+    parser.add_argument("--calls", type = int, default = 20000)
+    parser.add_argument("--turns", type = int, default = 3, help = "question/answer pairs in the history")
+    args = parser.parse_args()
+
+    client = EasyChatClient()
+    client.setSystemPrompts("You are an helpful assistant that helps finding information from documents.\n" * 20, [ "- \"PTO\" means paid time off.\n" * 20 ])
+    role = ChatbotRole("hr", "HR", "department eq 'hr'", "/hr/travel policies/")
+    msgs = messages(args.turns)
+
+    def uncompiled():
+        # every request builds the filter and the template (as before)
+        role._search_filters.clear()
+        client._request_templates.clear()
+        context = client.createRequestContext(role = role, storage_base_url = STORAGE_BASE_URL)
+        client._buildChatRequest(msgs, True, context)
+        client._getRequestKey(msgs, context)
+
+    def compiled():
+        context = client.createRequestContext(role = role, storage_base_url = STORAGE_BASE_URL)
+        client._buildChatRequest(msgs, True, context)
+        client._getRequestKey(msgs, context)
+
+    request = client._buildChatRequest(msgs, True, client.createRequestContext(role = role, storage_base_url = STORAGE_BASE_URL))
+    body = dict(request, **request.pop("extra_body"))
+    print(f"{args.calls} calls, {len(msgs)} messages, request body {len(json.dumps(body))} bytes")
+    measure("built per request", uncompiled, args.calls)
+    measure("compiled per role and configuration", compiled, args.calls)
+    measure("json serialization of the body (sdk)", lambda: json.dumps(body), args.calls)
+
+
+if __name__ == "__main__":
+    main()
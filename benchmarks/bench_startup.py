@@ -0,0 +1,106 @@
+"""
+Measures the startup of a worker process: the import time of the app (python -X importtime), the time until the
+first response of the login page and the cost of the first chat request that creates the chat client (see views.py).
+Fails (exit code 1) if the import of the app takes longer than the budget, so it can run in a CI pipeline.
+
+Every measurement runs in a new python process. No network access is needed, nothing is sent.
+
+Usage:
+    python benchmarks/bench_startup.py [--budget-ms 1000] [--runs 3] [--top 15] [--module chat_bot.webapp]
+"""
+import argparse, json, os, subprocess, sys, statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+ENV = {
+    "OPENAI_API_BASE": "https://benchmark.openai.azure.com",
+    "OPENAI_API_KEY": "benchmark",
+    "AZURESEARCH_API_BASE": "https://benchmark.search.windows.net",
+    "AZURE_STORAGEBLOB_CONNECTIONSTRING": "DefaultEndpointsProtocol=https;AccountName=benchaccount;AccountKey=YmVuY2htYXJrYmVuY2htYXJrYmVuY2htYXJr;EndpointSuffix=core.windows.net",
+    "CHATBOT_CONFIG_RELOAD_INTERVAL": "0"
+}
+
+FIRST_REQUEST = """
+import json, sys, time
+start = time.perf_counter()
+import %(module)s
+imported = time.perf_counter()
+from chat_bot import app
+response = app.test_client().get("/login")
+first = time.perf_counter()
+from chat_bot.views import get_shared_chat_client
+get_shared_chat_client()
+client = time.perf_counter()
+print(json.dumps({
+    "import": (imported - start) * 1000,
+    "first_response": (first - start) * 1000,
+    "status": response.status_code,
+    "chat_client": (client - first) * 1000
+}))
+"""
+
+
+def run_python(args : list) -> subprocess.CompletedProcess:
+    env = dict(os.environ)
+    for k, v in ENV.items():
+        env.setdefault(k, v)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    result = subprocess.run([ sys.executable ] + args, cwd = ROOT, env = env, capture_output = True, text = True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return result
+
+
+def import_times(module : str) -> list:
+    """
+    Returns (self us, cumulative us, depth, module name) per imported module of python -X importtime
+    """
+    times = [ ]
+    for line in run_python([ "-X", "importtime", "-c", "import " + module ]).stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        name = fields[2].rstrip()
+        times.append((int(fields[0]), int(fields[1]), (len(name) - len(name.lstrip())) // 2, name.strip()))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Startup time of a worker process")
+    parser.add_argument("--module", default = "chat_bot.webapp", help = "module imported by the worker (chat_bot.asgi for the asgi app)")
+    parser.add_argument("--budget-ms", type = float, default = 1000, help = "max. import time of the module (median of the runs)")
+    parser.add_argument("--runs", type = int, default = 3)
+    parser.add_argument("--top", type = int, default = 15, help = "number of modules in the report")
+    args = parser.parse_args()
+
+    # the first run fills the bytecode cache
+    run_python([ "-c", "import " + args.module ])
+    times = import_times(args.module)
+    # the lines are written after the imports of a module, its direct imports are the lines before it (depth 1)
+    end = max([ i for i, t in enumerate(times) if t[2] == 0 and t[3] == args.module ])
+    start = max([ i for i, t in enumerate(times[:end]) if t[2] == 0 ] + [ -1 ]) + 1
+    print(f"python -X importtime -c 'import {args.module}': {end - start + 1} modules, {times[end][1] / 1000:.0f} ms (python startup not included)")
+    print(f"\n{'imported by ' + args.module:<40} {'cumulative':>12}")
+    for t in sorted([ t for t in times[start:end] if t[2] == 1 ], key = lambda t: -t[1])[:args.top]:
+        print(f"{t[3]:<40} {t[1] / 1000:9.1f} ms")
+    print(f"\n{'modules':<40} {'self':>12}")
+    for t in sorted(times[start:end + 1], key = lambda t: -t[0])[:args.top]:
+        print(f"{t[3]:<40} {t[0] / 1000:9.1f} ms")
+
+    runs = [ ]
+    for _ in range(args.runs):
+        runs.append(json.loads(run_python([ "-c", FIRST_REQUEST % { "module": args.module } ]).stdout.splitlines()[-1]))
+    print(f"\nmedian of {args.runs} runs")
+    print(f"{'import of the app':<40} {statistics.median([ r['import'] for r in runs ]):9.1f} ms")
+    print(f"{'first response (/login, status ' + str(runs[0]['status']) + ')':<40} {statistics.median([ r['first_response'] for r in runs ]):9.1f} ms")
+    print(f"{'chat client (first chat request)':<40} {statistics.median([ r['chat_client'] for r in runs ]):9.1f} ms")
+
+    importMs = statistics.median([ r["import"] for r in runs ])
+    if importMs > args.budget_ms:
+        print(f"\nFAILED: the import takes {importMs:.0f} ms, the budget is {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print(f"\nOK: the import takes {importMs:.0f} ms, the budget is {args.budget_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compares the wire formats of /api/chat/stream for one synthetic answer:
+the full records (json), the compact format (compact) and the compact format gzipped with a flush per record (compact+gzip).
+
+No network access is needed, the upstream is replaced by synthetic chunks (one token per chunk, citations in the first chunk).
+Reported per format: bytes per answer, bytes per token and the CPU time per token of the encoding (EasyChatClient.streamedChat()).
+
+Usage:
+    python benchmarks/bench_stream_format.py [--tokens 400] [--citations 5] [--answers 200]
+"""
+import argparse, os, sys, time, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault("OPENAI_API_BASE", "https://benchmark.openai.azure.com")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("AZURESEARCH_API_BASE", "https://benchmark.search.windows.net")
+
+from openai.types.chat import ChatCompletionChunk
+from chat_bot.easy_chat import EasyChatClient, EasyChatMessage
+
+WORDS = [ "The ", "travel ", "expense ", "limit ", "for ", "employees ", "is ", "100 ", "EUR ", "per ", "day ", "[doc1]", ". " ]
+
+
+def chunk(delta : dict, finish_reason = None) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-benchmark",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "object": "chat.completion.chunk",
+        "choices": [ { "index": 0, "delta": delta, "finish_reason": finish_reason, "end_turn": finish_reason is not None } ]
+    })
+
+
+def synthetic_answer(tokens : int, citations : int) -> list:
+    context = {
+        "citations": [ {
+            "content": "Travel expenses are reimbursed up to 100 EUR per day. " * 20,
+            "title": "travel_policy_" + str(i) + ".pdf",
+            "url": "https://benchaccount.blob.core.windows.net/documents/travel_policy_" + str(i) + ".pdf",
+            "filepath": "travel_policy_" + str(i) + "_pages_" + str(i + 1),
+            "chunk_id": "0"
+        } for i in range(citations) ],
+        "intent": "[\"travel expense limit\"]"
+    }
+    chunks = [ chunk({ "role": "assistant", "content": "", "context": context }) ]
+    chunks += [ chunk({ "content": WORDS[i % len(WORDS)] }) for i in range(tokens) ]
+    chunks.append(chunk({ }, "stop"))
+    return chunks
+
+
+class FakeCompletions:
+    def __init__(self, chunks : list):
+        self._chunks = chunks
+
+    def create(self, **kwargs):
+        return iter(self._chunks)
+
+
+class FakeOpenAIClient:
+    def __init__(self, chunks : list):
+        self.chat = type("Chat", (), { "completions": FakeCompletions(chunks) })()
+
+
+def gzip_flushed(lines):
+    # same as views.gzipStream()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for line in lines:
+        yield compressor.compress(line.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def measure(name : str, client : EasyChatClient, outputFormat : str, gzip : bool, tokens : int, answers : int):
+    messages = [ EasyChatMessage("user", "What is the travel expense limit?") ]
+    size = 0
+    start = time.process_time()
+    for _ in range(answers):
+        records = client.streamedChat(messages, outputFormat = outputFormat)
+        if gzip:
+            records = gzip_flushed(records)
+        size = sum(len(r) if isinstance(r, bytes) else len(r.encode("utf-8")) for r in records)
+    cpu = time.process_time() - start
+    print(f"{name:<14} {size:>10} bytes/answer   {size / tokens:8.1f} bytes/token   {cpu / (answers * tokens) * 1000000:8.2f} us cpu/token")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compares the wire formats of the answer stream")
+    parser.add_argument("--tokens", type = int, default = 400, help = "tokens per answer")
+    parser.add_argument("--citations", type = int, default = 5, help = "citations per answer")
+    parser.add_argument("--answers", type = int, default = 200, help = "answers per format")
+    args = parser.parse_args()
+
+    client = EasyChatClient()
+    client._open_ai_client = FakeOpenAIClient(synthetic_answer(args.tokens, args.citations))
+    print(f"{args.answers} answers with {args.tokens} tokens and {args.citations} citations")
+    measure("json", client, "json", False, args.tokens, args.answers)
+    measure("compact", client, "compact", False, args.tokens, args.answers)
+    measure("compact+gzip", client, "compact", True, args.tokens, args.answers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Local stand-ins of the Azure services used by the chatbot, for load tests without paying for real calls.
+
+One http server answers:
+    POST /openai/deployments/<deployment>/chat/completions   Azure OpenAI on your data (streamed as SSE or as one JSON answer)
+    POST /openai/deployments/<deployment>/embeddings         random embeddings
+    GET  /indexes/<index>/stats                              Azure Search index statistics
+    POST /indexes/<index>/docs/search                        Azure Search documents
+    GET  /<account>/<container>/<blob>                       Azure Blob Storage download (with Range and If-None-Match)
+    HEAD /<account>/<container>/<blob>                       Azure Blob Storage properties
+
+The latency profile of the completions is configurable (time to first token, tokens per second, answer length,
+number of citations) and a share of the completions can be rejected with 429 and a retry-after header.
+Authentication is not checked.
+
+Usage:
+    python benchmarks/fake_services.py [--port 8900] [--ttft 0.8] [--tokens-per-second 40] [--answer-tokens 200] [--citations 5] [--throttle-rate 0.0]
+
+The environment of the chatbot then needs:
+    OPENAI_API_BASE=http://127.0.0.1:8900  OPENAI_API_KEY=fake
+    AZURESEARCH_API_BASE=http://127.0.0.1:8900  AZURESEARCH_API_KEY=fake
+    AZURE_STORAGEBLOB_CONNECTIONSTRING=<see blob_connection_string()>
+"""
+import argparse, base64, hashlib, json, random, re, threading, time
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Union
+
+ACCOUNT_NAME = "benchaccount"
+ACCOUNT_KEY = base64.b64encode(b"benchmark-account-key-benchmark").decode("ascii")
+CONTAINER_NAME = "documents"
+
+
+def blob_connection_string(port : int, host : str = "127.0.0.1") -> str:
+    """
+    Returns the storage connection string that points the azure sdk to the fake blob store
+    """
+    return (
+        "DefaultEndpointsProtocol=http;AccountName=" + ACCOUNT_NAME + ";AccountKey=" + ACCOUNT_KEY +
+        ";BlobEndpoint=http://" + host + ":" + str(port) + "/" + ACCOUNT_NAME + ";"
+    )
+
+
+class FakeServiceConfig:
+    """
+    Latency profile and payloads of the fake services
+    """
+    def __init__(
+        self,
+        ttft : float = 0.8,
+        tokens_per_second : float = 40,
+        answer_tokens : int = 200,
+        citations : int = 5,
+        citation_size : int = 1500,
+        throttle_rate : float = 0,
+        retry_after : int = 2,
+        blob_size : int = 2 * 1024 * 1024,
+        blobs : int = 20
+    ):
+        self.ttft = float(ttft)
+        self.tokens_per_second = float(tokens_per_second)
+        self.answer_tokens = int(answer_tokens)
+        self.citations = int(citations)
+        self.citation_size = int(citation_size)
+        self.throttle_rate = float(throttle_rate)
+        self.retry_after = int(retry_after)
+        self.blob_size = int(blob_size)
+        self.blobs = int(blobs)
+        self._blob_data = None
+        self.stats = { "completions": 0, "throttled": 0, "embeddings": 0, "searches": 0, "blob_downloads": 0, "blob_bytes": 0 }
+        self.stats_lock = threading.Lock()
+
+    def count(self, name : str, amount : int = 1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def getBlobData(self) -> bytes:
+        # the same (pseudo random) content for every blob, it only has to look like a pdf
+        if self._blob_data is None:
+            rnd = random.Random(42)
+            self._blob_data = b"%PDF-1.4\n" + bytes(rnd.getrandbits(8) for _ in range(max(0, self.blob_size - 9)))
+        return self._blob_data
+
+    def getBlobNames(self):
+        return [ "bench/document-" + str(i) + ".pdf" for i in range(self.blobs) ]
+
+    def citationList(self, host : str) -> list:
+        names = self.getBlobNames()
+        return [
+            {
+                "content": ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (self.citation_size // 57 + 1))[:self.citation_size],
+                "title": names[i % len(names)].split("/")[-1],
+                "url": "https://" + ACCOUNT_NAME + ".blob.core.windows.net/" + CONTAINER_NAME + "/" + names[i % len(names)],
+                "filepath": names[i % len(names)].split("/")[-1] + "_pages_" + str(i),
+                "chunk_id": str(i)
+            }
+            for i in range(self.citations)
+        ]
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config : FakeServiceConfig = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _readBody(self) -> dict:
+        length = int(self.headers.get("Content-Length", "0"))
+        if length == 0:
+            return { }
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return { }
+
+    def _sendJson(self, data : Union[dict, list], status : int = 200, headers : dict = { }):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self._readBody()
+        m = re.match(r"^/openai/deployments/([^/]+)/(chat/completions|embeddings)", self.path)
+        if m is not None and m.group(2) == "embeddings":
+            self.config.count("embeddings")
+            inputs = body.get("input", "")
+            inputs = inputs if isinstance(inputs, list) else [ inputs ]
+            rnd = random.Random(hashlib.sha256(json.dumps(inputs).encode("utf-8")).digest())
+            return self._sendJson({
+                "object": "list",
+                "model": m.group(1),
+                "data": [ { "object": "embedding", "index": i, "embedding": [ rnd.uniform(-1, 1) for _ in range(1536) ] } for i in range(len(inputs)) ],
+                "usage": { "prompt_tokens": 10, "total_tokens": 10 }
+            })
+        if m is not None:
+            return self._chatCompletion(m.group(1), body)
+        if re.match(r"^/indexes/[^/]+/docs/search", self.path):
+            self.config.count("searches")
+            # fields of the documents index (see iac/azure_search/documents-index.json)
+            return self._sendJson({ "value": [
+                { "@search.score": 1.0 / (i + 1), "chunk_id": c["filepath"], "title": c["title"], "chunk": c["content"], "metadata_storage_path": c["url"] }
+                for i, c in enumerate(self.config.citationList(self.headers.get("Host", "")))
+            ][:int(body.get("top", 5))] })
+        self._sendJson({ "error": "not found" }, 404)
+
+    def _chatCompletion(self, deployment : str, body : dict):
+        if self.config.throttle_rate > 0 and random.random() < self.config.throttle_rate:
+            self.config.count("throttled")
+            return self._sendJson(
+                { "error": { "code": "429", "message": "Rate limit is exceeded." } },
+                429,
+                { "retry-after": str(self.config.retry_after), "retry-after-ms": str(self.config.retry_after * 1000) }
+            )
+        self.config.count("completions")
+        created = int(time.time())
+        # only the azure_search data source adds a context, with direct retrieval the documents are part of the prompt
+        context = None
+        if len(body.get("data_sources", [ ])) > 0:
+            context = {
+                "citations": self.config.citationList(self.headers.get("Host", "")),
+                "intent": json.dumps([ "fake intent" ])
+            }
+        # like azure openai, end_turn is only part of the answer with a data source
+        def withEndTurn(value, fields):
+            return fields if context is None else dict(fields, end_turn = value)
+        words = [ ("word" + str(i % 50) + " ") for i in range(self.config.answer_tokens) ]
+        words[-1] = "[doc1]."
+        base = { "id": "chatcmpl-fake", "created": created, "model": deployment, "system_fingerprint": None }
+        time.sleep(self.config.ttft)
+        if not body.get("stream"):
+            time.sleep(self.config.answer_tokens / self.config.tokens_per_second)
+            return self._sendJson(dict(base, **{
+                "object": "chat.completion",
+                "choices": [ {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": withEndTurn(True, dict({ "role": "assistant", "content": "".join(words) }, **({ } if context is None else { "context": context })))
+                } ],
+                "usage": { "prompt_tokens": 3000, "completion_tokens": len(words), "total_tokens": 3000 + len(words) }
+            }))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        def send(choice):
+            chunk = dict(base, **{ "object": "chat.completion.chunk", "choices": [ choice ] })
+            self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+        try:
+            send(withEndTurn(False, { "index": 0, "finish_reason": None, "delta": dict({ "role": "assistant" }, **({ } if context is None else { "context": context })) }))
+            delay = 1 / self.config.tokens_per_second
+            for w in words:
+                time.sleep(delay)
+                send(withEndTurn(False, { "index": 0, "finish_reason": None, "delta": { "content": w } }))
+            send(withEndTurn(True, { "index": 0, "finish_reason": "stop", "delta": { } }))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the stream
+            pass
+        self.close_connection = True
+
+    def do_GET(self):
+        if re.match(r"^/indexes/[^/]+/stats", self.path):
+            return self._sendJson({ "documentCount": self.config.blobs, "storageSize": self.config.blobs * self.config.blob_size })
+        self._blob(True)
+
+    def do_HEAD(self):
+        self._blob(False)
+
+    def _blob(self, withBody : bool):
+        path = self.path.split("?")[0]
+        prefix = "/" + ACCOUNT_NAME + "/" + CONTAINER_NAME + "/"
+        if not path.startswith(prefix) or path[len(prefix):] not in self.config.getBlobNames():
+            self.send_response(404)
+            self.send_header("x-ms-error-code", "BlobNotFound")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = self.config.getBlobData()
+        etag = '"0x8DC' + hashlib.sha256(path.encode("utf-8")).hexdigest()[:12].upper() + '"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(1700000000, usegmt = True),
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-version": "2024-08-04",
+            "x-ms-request-id": "fake",
+            "x-ms-creation-time": formatdate(1700000000, usegmt = True),
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/pdf"
+        }
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        status = 200
+        start, end = 0, len(data) - 1
+        r = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("x-ms-range", self.headers.get("Range", "")) or "")
+        if r is not None and withBody:
+            start = int(r.group(1))
+            end = min(len(data) - 1, int(r.group(2))) if r.group(2) != "" else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("x-ms-error-code", "InvalidRange")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+            headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(len(data))
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if withBody:
+            self.config.count("blob_downloads")
+            self.config.count("blob_bytes", end - start + 1)
+            try:
+                self.wfile.write(data[start:end + 1])
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+def start_fake_services(config : FakeServiceConfig, port : int = 0, host : str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Starts the fake services in a background thread, the port is in server.server_address[1]
+    """
+    handler = type("ConfiguredFakeServiceHandler", (FakeServiceHandler, ), { "config": config })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+def add_config_arguments(parser : argparse.ArgumentParser):
+    parser.add_argument("--ttft", type = float, default = 0.8, help = "seconds until the first token")
+    parser.add_argument("--tokens-per-second", type = float, default = 40)
+    parser.add_argument("--answer-tokens", type = int, default = 200)
+    parser.add_argument("--citations", type = int, default = 5)
+    parser.add_argument("--citation-size", type = int, default = 1500, help = "characters per citation")
+    parser.add_argument("--throttle-rate", type = float, default = 0, help = "share of the completions rejected with 429")
+    parser.add_argument("--retry-after", type = int, default = 2)
+    parser.add_argument("--blob-size", type = int, default = 2 * 1024 * 1024)
+
+def config_from_arguments(args) -> FakeServiceConfig:
+    return FakeServiceConfig(
+        ttft = args.ttft,
+        tokens_per_second = args.tokens_per_second,
+        answer_tokens = args.answer_tokens,
+        citations = args.citations,
+        citation_size = args.citation_size,
+        throttle_rate = args.throttle_rate,
+        retry_after = args.retry_after,
+        blob_size = args.blob_size
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Fake Azure OpenAI, Azure Search and Blob Storage")
+    parser.add_argument("--port", type = int, default = 8900)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = start_fake_services(config_from_arguments(args), args.port)
+    print("Fake services listening on http://127.0.0.1:" + str(args.port))
+    print("AZURE_STORAGEBLOB_CONNECTIONSTRING=" + blob_connection_string(args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,323 @@
+"""
+Offline load test of the chatbot: starts the fake Azure services (see fake_services.py), starts the app with
+one or more server configurations and drives /api/chat, /api/chat/stream and /api/blobstorage/file with
+a configurable number of concurrent users.
+
+Reported per server configuration:
+    requests/s, latency percentiles per endpoint (and the time to the first record of the streams),
+    errors per status code, max. number of streams held open at the same time,
+    max. memory (RSS) per worker process and of all processes of the server.
+
+Server configurations (missing servers are skipped):
+    gunicorn-sync       gunicorn sync workers (--workers)
+    gunicorn-gthread    gunicorn threaded workers (--workers, --threads)
+    uwsgi               uwsgi with uwsgi.ini (--workers and --threads override the processes and threads of the ini)
+    asgi                gunicorn with uvicorn workers on startup_asgi:app (plain uvicorn if gunicorn is not installed)
+
+Users are authenticated with a generated easy auth header (USE_AUTH_TYPE=aad), so no users.json is needed.
+
+Usage:
+    python benchmarks/loadtest.py [--servers gunicorn-sync,gunicorn-gthread,uwsgi,asgi] [--users 50] [--duration 30]
+                                  [--workers 4] [--threads 8] [--mix chat=1,stream=3,file=2] [--ttft 0.8] [--tokens-per-second 40]
+                                  [--throttle-rate 0.0] [--json results.json]
+"""
+import argparse, base64, json, os, random, shutil, signal, socket, subprocess, sys, threading, time
+from typing import Union, List, Dict
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fake_services import ACCOUNT_NAME, CONTAINER_NAME, start_fake_services, blob_connection_string, add_config_arguments, config_from_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def server_command(name : str, port : int, workers : int, threads : int) -> Union[None, List[str]]:
+    """
+    Returns the command line of a server configuration or None, if the server is not installed
+    """
+    bind = "127.0.0.1:" + str(port)
+    if name == "gunicorn-sync" and shutil.which("gunicorn"):
+        return [ "gunicorn", "--bind", bind, "--workers", str(workers), "--timeout", "120", "startup:app" ]
+    if name == "gunicorn-gthread" and shutil.which("gunicorn"):
+        return [ "gunicorn", "--bind", bind, "--workers", str(workers), "--threads", str(threads), "--worker-class", "gthread", "--timeout", "120", "startup:app" ]
+    if name == "uwsgi" and shutil.which("uwsgi"):
+        return [ "uwsgi", "--ini", "uwsgi.ini", "--http", bind, "--processes", str(workers), "--threads", str(threads), "--disable-logging" ]
+    if name == "asgi":
+        if shutil.which("gunicorn"):
+            return [ "gunicorn", "--bind", bind, "--workers", str(workers), "--worker-class", "uvicorn.workers.UvicornWorker", "startup_asgi:app" ]
+        if shutil.which("uvicorn"):
+            return [ "uvicorn", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning", "startup_asgi:app" ]
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def easy_auth_header(user : int) -> str:
+    principal = {
+        "auth_typ": "aad",
+        "claims": [
+            { "typ": "preferred_username", "val": "bench-user-" + str(user) + "@example.com" },
+            { "typ": "http://schemas.microsoft.com/identity/claims/objectidentifier", "val": "00000000-0000-0000-0000-" + str(user).zfill(12) }
+        ]
+    }
+    return base64.b64encode(json.dumps(principal).encode("utf-8")).decode("ascii")
+
+
+def process_tree(pid : int) -> List[int]:
+    """
+    Returns the pid and the pids of all (grand) children (linux only)
+    """
+    children = { }
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, [ ]).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            pass
+    result = [ pid ]
+    for p in result:
+        result.extend(children.get(p, [ ]))
+    return result
+
+
+def rss_kb(pid : int) -> int:
+    try:
+        with open("/proc/" + str(pid) + "/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the memory of the server processes while the load test runs
+    """
+    def __init__(self, pid : int, interval : float = 0.5):
+        super().__init__(daemon = True)
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self.max_worker_kb = 0
+        self.max_total_kb = 0
+        self.workers = 0
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+        while not self._stop.wait(self._interval):
+            pids = process_tree(self._pid)
+            usage = [ rss_kb(p) for p in pids ]
+            self.workers = max(self.workers, len(pids) - 1)
+            self.max_total_kb = max(self.max_total_kb, sum(usage))
+            # the first process is the master (or the only process)
+            self.max_worker_kb = max([ self.max_worker_kb ] + usage[1:] if len(usage) > 1 else [ self.max_worker_kb ] + usage)
+
+    def stop(self):
+        self._stop.set()
+
+
+class LoadResults:
+    """
+    Latencies and errors of all requests of one load test (thread-safe)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = { }
+        self.first_record = [ ]
+        self.errors = { }
+        self.requests = 0
+        self.open_streams = 0
+        self.max_open_streams = 0
+
+    def add(self, endpoint : str, seconds : float, status : Union[int, str]):
+        with self.lock:
+            self.requests += 1
+            if status == 200 or status == 206:
+                self.latencies.setdefault(endpoint, [ ]).append(seconds)
+            else:
+                key = endpoint + " " + str(status)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def streamOpened(self, first_record : float):
+        with self.lock:
+            self.first_record.append(first_record)
+            self.open_streams += 1
+            self.max_open_streams = max(self.max_open_streams, self.open_streams)
+
+    def streamClosed(self):
+        with self.lock:
+            self.open_streams -= 1
+
+
+def percentile(values : List[float], p : float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_user(base_url : str, user : int, mix : List[str], deadline : float, results : LoadResults):
+    session = requests.Session()
+    session.headers["x-ms-client-principal"] = easy_auth_header(user)
+    rnd = random.Random(user)
+    question = { "messages": [ { "role": "user", "content": "What does document " + str(user) + " say about the benchmark?" } ] }
+    while time.monotonic() < deadline:
+        endpoint = rnd.choice(mix)
+        start = time.monotonic()
+        try:
+            if endpoint == "chat":
+                r = session.post(base_url + "/api/chat", json = question, timeout = 120)
+                r.content
+                results.add(endpoint, time.monotonic() - start, r.status_code)
+            elif endpoint == "stream":
+                with session.post(base_url + "/api/chat/stream", json = question, timeout = 120, stream = True) as r:
+                    if r.status_code != 200:
+                        r.content
+                        results.add(endpoint, time.monotonic() - start, r.status_code)
+                        continue
+                    lines = r.iter_lines()
+                    next(lines, None)
+                    results.streamOpened(time.monotonic() - start)
+                    try:
+                        for _ in lines:
+                            pass
+                    finally:
+                        results.streamClosed()
+                    results.add(endpoint, time.monotonic() - start, r.status_code)
+            else:
+                r = session.get(base_url + "/api/blobstorage/file", params = {
+                    "storageaccount_name": ACCOUNT_NAME,
+                    "storageaccount_container": CONTAINER_NAME,
+                    "storageaccount_blob": "bench/document-" + str(rnd.randrange(20)) + ".pdf"
+                }, timeout = 120)
+                r.content
+                results.add(endpoint, time.monotonic() - start, r.status_code)
+        except requests.RequestException as e:
+            results.add(endpoint, time.monotonic() - start, type(e).__name__)
+
+
+def wait_for_server(base_url : str, process : subprocess.Popen, timeout : float = 60) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            requests.get(base_url + "/", timeout = 2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.3)
+    return False
+
+
+def run_config(name : str, args, fake_port : int) -> Union[None, dict]:
+    port = free_port()
+    command = server_command(name, port, args.workers, args.threads)
+    if command is None:
+        print(f"{name:<18} skipped (server not installed)")
+        return None
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_DIR,
+        "USE_AUTH_TYPE": "aad",
+        "CHATBOT_SECRET_KEY": "benchmark",
+        "OPENAI_API_BASE": "http://127.0.0.1:" + str(fake_port),
+        "OPENAI_API_KEY": "fake",
+        "AZURESEARCH_API_BASE": "http://127.0.0.1:" + str(fake_port),
+        "AZURESEARCH_API_KEY": "fake",
+        "AZURE_STORAGEBLOB_CONNECTIONSTRING": blob_connection_string(fake_port),
+        "AZURE_STORAGEBLOB_CONTAINER": CONTAINER_NAME
+    })
+    env.pop("AZURE_STORAGEBLOB_RESOURCEENDPOINT", None)
+    process = subprocess.Popen(command, cwd = REPO_DIR, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE if args.quiet else None, start_new_session = True)
+    base_url = "http://127.0.0.1:" + str(port)
+    try:
+        if not wait_for_server(base_url, process):
+            print(f"{name:<18} failed to start")
+            return None
+        mix = [ ]
+        for part in args.mix.split(","):
+            endpoint, weight = part.split("=")
+            mix += [ endpoint.strip() ] * int(weight)
+        results = LoadResults()
+        sampler = MemorySampler(process.pid)
+        sampler.start()
+        deadline = time.monotonic() + args.duration
+        start = time.monotonic()
+        users = [ threading.Thread(target = run_user, args = (base_url, u, mix, deadline, results), daemon = True) for u in range(args.users) ]
+        for u in users:
+            u.start()
+        for u in users:
+            u.join()
+        elapsed = time.monotonic() - start
+        sampler.stop()
+        return {
+            "server": name,
+            "command": " ".join(command),
+            "requests_per_second": results.requests / elapsed,
+            "latency": {
+                endpoint: { "count": len(v), "p50": percentile(v, 0.5), "p95": percentile(v, 0.95), "p99": percentile(v, 0.99) }
+                for endpoint, v in sorted(results.latencies.items())
+            },
+            "stream_first_record": { "p50": percentile(results.first_record, 0.5), "p95": percentile(results.first_record, 0.95), "p99": percentile(results.first_record, 0.99) },
+            "errors": results.errors,
+            "max_open_streams": results.max_open_streams,
+            "worker_processes": sampler.workers,
+            "max_worker_rss_mb": sampler.max_worker_kb / 1024,
+            "max_total_rss_mb": sampler.max_total_kb / 1024
+        }
+    finally:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(15)
+        except (ProcessLookupError, subprocess.TimeoutExpired):
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def print_result(r : dict):
+    print(f"{r['server']:<18} {r['requests_per_second']:8.1f} req/s   open streams max {r['max_open_streams']:4d}   "
+        f"rss/worker {r['max_worker_rss_mb']:7.1f} MB   rss total {r['max_total_rss_mb']:7.1f} MB ({r['worker_processes']} child processes)")
+    for endpoint, l in r["latency"].items():
+        print(f"    {endpoint:<8} n={l['count']:<6} p50 {l['p50'] * 1000:8.0f} ms   p95 {l['p95'] * 1000:8.0f} ms   p99 {l['p99'] * 1000:8.0f} ms")
+    f = r["stream_first_record"]
+    print(f"    {'1st rec':<8} {'':<8} p50 {f['p50'] * 1000:8.0f} ms   p95 {f['p95'] * 1000:8.0f} ms   p99 {f['p99'] * 1000:8.0f} ms")
+    if len(r["errors"]) > 0:
+        print("    errors: " + ", ".join(k + " x" + str(v) for k, v in sorted(r["errors"].items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Offline load test of the chatbot with fake Azure services")
+    parser.add_argument("--servers", default = "gunicorn-sync,gunicorn-gthread,uwsgi,asgi")
+    parser.add_argument("--users", type = int, default = 50, help = "concurrent users")
+    parser.add_argument("--duration", type = float, default = 30, help = "seconds per server configuration")
+    parser.add_argument("--workers", type = int, default = 4)
+    parser.add_argument("--threads", type = int, default = 8)
+    parser.add_argument("--mix", default = "chat=1,stream=3,file=2", help = "relative weights of the endpoints")
+    parser.add_argument("--json", default = "", help = "write the results to this file")
+    parser.add_argument("--quiet", action = "store_true", help = "hide the output of the servers")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    config = config_from_arguments(args)
+    fake = start_fake_services(config)
+    print(f"{args.users} users, {args.duration:.0f} s per server, mix {args.mix}, ttft {args.ttft} s, {args.tokens_per_second} tokens/s, throttle rate {args.throttle_rate}")
+    allResults = [ ]
+    for name in [ s.strip() for s in args.servers.split(",") if s.strip() != "" ]:
+        result = run_config(name, args, fake.server_address[1])
+        if result is not None:
+            print_result(result)
+            allResults.append(result)
+    print("fake services: " + ", ".join(k + " " + str(v) for k, v in config.stats.items()))
+    if args.json != "":
+        with open(args.json, "w") as f:
+            json.dump({ "arguments": vars(args), "results": allResults, "fake_services": config.stats }, f, indent = 2)
+    fake.shutdown()
@@ -4,7 +4,8 @@ app = Flask(__name__)    # Create an instance of the class for our use
 app.config['MAX_CONTENT_LENGTH'] = 64 * 1000 * 1000
 
 
-from .iam import USE_AUTH_TYPE, all_defined_users
+from .iam import USE_AUTH_TYPE
+from .config import get_config
 
 print("Using authentication: ", USE_AUTH_TYPE)
 
@@ -17,6 +18,4 @@ if USE_AUTH_TYPE == "local":
 
     @login_manager.user_loader
     def loader_user(user_id):
-        if user_id in all_defined_users:
-            return all_defined_users[user_id]
-        return None
+        return get_config().getUser(user_id)
@@ -0,0 +1,454 @@
+import os, math, sqlite3, threading, time, asyncio
+from typing import Union, List, Tuple, Callable
+from .easy_chat import EasyChatMessage, count_tokens
+from .metrics import get_counter
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Environment variables used for the admission control of the chat api:
+CHATBOT_ADMISSION                           Optional, enable the admission control (default: false)
+CHATBOT_ADMISSION_USER_REQUESTS_PER_MINUTE  Optional, max. chat requests per user and minute, 0 means no limit (default: 20)
+CHATBOT_ADMISSION_USER_TOKENS_PER_MINUTE    Optional, max. estimated tokens per user and minute, 0 means no limit (default: 100000)
+CHATBOT_ADMISSION_ROLE_REQUESTS_PER_MINUTE  Optional, max. chat requests of all users of a role per minute, 0 means no limit (default: 0)
+CHATBOT_ADMISSION_ROLE_TOKENS_PER_MINUTE    Optional, max. estimated tokens of all users of a role per minute, 0 means no limit (default: 0)
+CHATBOT_ADMISSION_REQUEST_OVERHEAD_TOKENS   Optional, tokens added to the estimate of the messages for the retrieved documents and the answer (default: 3000)
+CHATBOT_ADMISSION_MAX_CONCURRENT            Optional, max. concurrent chat requests per worker process, 0 means no limit (default: 0)
+CHATBOT_ADMISSION_MAX_QUEUE                 Optional, max. chat requests waiting for a free slot per worker process (default: 0)
+CHATBOT_ADMISSION_QUEUE_TIMEOUT             Optional, max. seconds a chat request waits for a free slot (default: 5)
+CHATBOT_ADMISSION_BACKEND                   Optional, where the rate limit counters are stored: memory (per worker process), sqlite (shared by the workers of a host) or redis (shared by all hosts) (default: sqlite)
+CHATBOT_ADMISSION_SQLITE_PATH               Optional, path of the sqlite database (default: /tmp/chatbot-admission.sqlite)
+CHATBOT_ADMISSION_REDIS_URL                 Optional, redis url, required for the redis backend (f.e. rediss://:password@host:6380/0)
+"""
+
+
+class AdmissionRejectedError(Exception):
+    """
+    Raised if a request exceeds a rate limit or the request queue is full
+    """
+    retry_after : float
+    reason : str
+
+    def __init__(self, reason : str, retry_after : float):
+        super().__init__("Too many requests (" + str(reason) + "), retry after " + str(math.ceil(retry_after)) + " seconds")
+        self.reason = str(reason)
+        self.retry_after = float(retry_after)
+
+
+class MemoryCounterBackend:
+    """
+    Token buckets in the memory of the worker process (the limits apply per process)
+    """
+    def __init__(self):
+        self._buckets = { }
+        self._lock = threading.Lock()
+
+    def take(self, buckets : List[Tuple[str, float, float, float]]) -> float:
+        """
+        Takes the amounts from all buckets or from none of them
+
+        :param buckets: List of (key, rate per second, capacity, amount)
+        :returns float, 0 if the amounts were taken, otherwise the seconds until they are available
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait = 0
+            levels = [ ]
+            for key, rate, capacity, amount in buckets:
+                level, updated = self._buckets.get(key, (capacity, now))
+                level = min(capacity, level + (now - updated) * rate)
+                amount = min(amount, capacity)
+                if level < amount:
+                    wait = max(wait, (amount - level) / rate)
+                levels.append(level - amount)
+            if wait > 0:
+                return wait
+            for (key, _, _, _), level in zip(buckets, levels):
+                self._buckets[key] = (level, now)
+            return 0
+
+    def refund(self, buckets : List[Tuple[str, float, float, float]]):
+        """
+        Puts the amounts taken by take() back (f.e. if the request is rejected afterwards)
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, rate, capacity, amount in buckets:
+                if key in self._buckets:
+                    level, updated = self._buckets[key]
+                    self._buckets[key] = (min(capacity, level + (now - updated) * rate + min(amount, capacity)), now)
+
+
+class SqliteCounterBackend:
+    """
+    Token buckets in a sqlite database, so the limits hold across the worker processes of a host
+    """
+    def __init__(self, path : str):
+        self._path = str(path)
+        self._local = threading.local()
+        self._connection().execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL, updated REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self._path, timeout = 5, isolation_level = None)
+        return self._local.connection
+
+    def take(self, buckets : List[Tuple[str, float, float, float]]) -> float:
+        now = time.time()
+        con = self._connection()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            wait = 0
+            levels = [ ]
+            for key, rate, capacity, amount in buckets:
+                row = con.execute("SELECT level, updated FROM buckets WHERE key = ?", (key, )).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + max(0, now - row[1]) * rate)
+                amount = min(amount, capacity)
+                if level < amount:
+                    wait = max(wait, (amount - level) / rate)
+                levels.append(level - amount)
+            if wait > 0:
+                con.execute("ROLLBACK")
+                return wait
+            con.executemany(
+                "INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)",
+                [ (key, level, now) for (key, _, _, _), level in zip(buckets, levels) ]
+            )
+            con.execute("COMMIT")
+            return 0
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def refund(self, buckets : List[Tuple[str, float, float, float]]):
+        now = time.time()
+        con = self._connection()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for key, rate, capacity, amount in buckets:
+                con.execute(
+                    "UPDATE buckets SET level = MIN(?, level + MAX(0, ? - updated) * ? + ?), updated = ? WHERE key = ?",
+                    (capacity, now, rate, min(amount, capacity), now, key)
+                )
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+
+class RedisCounterBackend:
+    """
+    Token buckets in redis, so the limits hold across all hosts (requires the redis package)
+    """
+    _script = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local levels = { }
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    local amount = math.min(tonumber(ARGV[i * 3 + 1]), capacity)
+    local bucket = redis.call('HMGET', KEYS[i], 'level', 'updated')
+    local level = capacity
+    if bucket[1] then
+        level = math.min(capacity, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    if level < amount then
+        wait = math.max(wait, (amount - level) / rate)
+    end
+    levels[i] = level - amount
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i = 1, #KEYS do
+    redis.call('HSET', KEYS[i], 'level', tostring(levels[i]), 'updated', ARGV[1])
+    redis.call('EXPIRE', KEYS[i], math.ceil(tonumber(ARGV[i * 3]) / tonumber(ARGV[i * 3 - 1])) + 60)
+end
+return '0'
+"""
+    _refund_script = """
+local now = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    local amount = math.min(tonumber(ARGV[i * 3 + 1]), capacity)
+    local bucket = redis.call('HMGET', KEYS[i], 'level', 'updated')
+    if bucket[1] then
+        local level = math.min(capacity, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate + amount)
+        redis.call('HSET', KEYS[i], 'level', tostring(level), 'updated', ARGV[1])
+    end
+end
+return '0'
+"""
+
+    def __init__(self, url : str):
+        if redis is None:
+            raise ValueError("The redis package is required for the redis admission backend")
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self._script)
+        self._refund = self._client.register_script(self._refund_script)
+
+    def _args(self, buckets : List[Tuple[str, float, float, float]]) -> list:
+        args = [ repr(time.time()) ]
+        for _, rate, capacity, amount in buckets:
+            args += [ repr(float(rate)), repr(float(capacity)), repr(float(amount)) ]
+        return args
+
+    def take(self, buckets : List[Tuple[str, float, float, float]]) -> float:
+        return float(self._take(keys = [ "chatbot:admission:" + b[0] for b in buckets ], args = self._args(buckets)))
+
+    def refund(self, buckets : List[Tuple[str, float, float, float]]):
+        self._refund(keys = [ "chatbot:admission:" + b[0] for b in buckets ], args = self._args(buckets))
+
+
+class ConcurrencyLimiter:
+    """
+    Bounded number of concurrent requests with a bounded queue of waiting requests (thread-safe)
+    """
+    def __init__(self, max_concurrent : int, max_queue : int = 0, timeout : float = 5):
+        self._max_concurrent = int(max_concurrent)
+        self._max_queue = int(max_queue)
+        self._timeout = float(timeout)
+        self._running = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def isFull(self) -> bool:
+        return self._running >= self._max_concurrent and self._waiting >= self._max_queue
+
+    def acquire(self) -> bool:
+        """
+        Waits for a free slot, returns False if the queue is full or the timeout passed
+        """
+        with self._cond:
+            if self._running < self._max_concurrent:
+                self._running += 1
+                return True
+            if self._waiting >= self._max_queue:
+                return False
+            self._waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self._running < self._max_concurrent, self._timeout):
+                    return False
+                self._running += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify()
+
+
+class AsyncConcurrencyLimiter:
+    """
+    asyncio variant of ConcurrencyLimiter (for use within one event loop)
+    """
+    def __init__(self, max_concurrent : int, max_queue : int = 0, timeout : float = 5):
+        self._max_concurrent = int(max_concurrent)
+        self._max_queue = int(max_queue)
+        self._timeout = float(timeout)
+        self._running = 0
+        self._waiting = 0
+        self._cond = asyncio.Condition()
+
+    def isFull(self) -> bool:
+        return self._running >= self._max_concurrent and self._waiting >= self._max_queue
+
+    async def acquire(self) -> bool:
+        async with self._cond:
+            if self._running < self._max_concurrent:
+                self._running += 1
+                return True
+            if self._waiting >= self._max_queue:
+                return False
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._cond.wait_for(lambda: self._running < self._max_concurrent), self._timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._waiting -= 1
+            self._running += 1
+            return True
+
+    async def release(self):
+        async with self._cond:
+            self._running -= 1
+            self._cond.notify()
+
+
+class AdmissionController:
+    """
+    Admission control of the chat api: token bucket limits of the requests and estimated tokens per user and per role,
+    and a bounded number of concurrent requests per worker process.
+    Rejected requests fail fast with AdmissionRejectedError, so the api can answer with 429 and a Retry-After header.
+    """
+    _backend : Union[MemoryCounterBackend, SqliteCounterBackend, RedisCounterBackend]
+    _limiter : Union[None, ConcurrencyLimiter] = None
+    _async_limiter : Union[None, AsyncConcurrencyLimiter] = None
+
+    def __init__(
+        self,
+        backend : Union[MemoryCounterBackend, SqliteCounterBackend, RedisCounterBackend],
+        user_requests_per_minute : float = 20,
+        user_tokens_per_minute : float = 100000,
+        role_requests_per_minute : float = 0,
+        role_tokens_per_minute : float = 0,
+        request_overhead_tokens : int = 3000,
+        max_concurrent : int = 0,
+        max_queue : int = 0,
+        queue_timeout : float = 5
+    ):
+        """
+        Create a new AdmissionController (limits of 0 are not enforced)
+
+        :param backend: the token bucket store
+        :param user_requests_per_minute: float
+        :param user_tokens_per_minute: float
+        :param role_requests_per_minute: float, shared by all users of a role
+        :param role_tokens_per_minute: float, shared by all users of a role
+        :param request_overhead_tokens: int, tokens added to the estimate of the messages (retrieved documents and answer)
+        :param max_concurrent: int, max. concurrent requests per worker process
+        :param max_queue: int, max. requests waiting for a free slot
+        :param queue_timeout: float, max. seconds a request waits for a free slot
+        """
+        self._backend = backend
+        self._user_requests_per_minute = float(user_requests_per_minute)
+        self._user_tokens_per_minute = float(user_tokens_per_minute)
+        self._role_requests_per_minute = float(role_requests_per_minute)
+        self._role_tokens_per_minute = float(role_tokens_per_minute)
+        self._request_overhead_tokens = int(request_overhead_tokens)
+        self._queue_timeout = float(queue_timeout)
+        self._limiter = None
+        self._async_limiter = None
+        if int(max_concurrent) > 0:
+            self._limiter = ConcurrencyLimiter(max_concurrent, max_queue, queue_timeout)
+            self._async_limiter = AsyncConcurrencyLimiter(max_concurrent, max_queue, queue_timeout)
+        self._rejected = get_counter("chat_admission_rejected_total", "Number of chat requests rejected by the admission control")
+
+    def estimateTokens(self, messages : List[EasyChatMessage]) -> int:
+        return sum(count_tokens(m.content) for m in messages) + self._request_overhead_tokens
+
+    def _buckets(self, user_id : str, role_name : str, tokens : int) -> List[Tuple[str, float, float, float]]:
+        buckets = [ ]
+        for key, perMinute, amount in [
+            ("user:" + user_id + ":requests", self._user_requests_per_minute, 1),
+            ("user:" + user_id + ":tokens", self._user_tokens_per_minute, tokens),
+            ("role:" + role_name + ":requests", self._role_requests_per_minute, 1),
+            ("role:" + role_name + ":tokens", self._role_tokens_per_minute, tokens)
+        ]:
+            if perMinute > 0:
+                buckets.append((key, perMinute / 60, perMinute, amount))
+        return buckets
+
+    def _reject(self, reason : str, retry_after : float):
+        self._rejected.inc(reason = reason)
+        raise AdmissionRejectedError(reason, retry_after)
+
+    def _checkRate(self, user_id : str, role_name : str, messages : List[EasyChatMessage]) -> list:
+        """
+        Takes the request and its tokens from the buckets of the user and the role
+
+        :returns list, the buckets taken from (see _refund())
+        :raises AdmissionRejectedError: if a limit is exceeded
+        """
+        buckets = self._buckets(str(user_id), str(role_name), self.estimateTokens(messages))
+        if len(buckets) == 0:
+            return buckets
+        wait = self._backend.take(buckets)
+        if wait > 0:
+            self._reject("rate_limit", wait)
+        return buckets
+
+    def _refund(self, buckets : list):
+        # a request rejected after the rate check (queue full) does not count against the limits
+        if len(buckets) == 0:
+            return
+        try:
+            self._backend.refund(buckets)
+        except Exception as e:
+            print("Admission tokens not refunded:", str(e))
+
+    def admit(self, user_id : str, role_name : str, messages : List[EasyChatMessage]) -> Callable[[], None]:
+        """
+        Admits a chat request (waits for a free slot if required)
+
+        :param user_id: str
+        :param role_name: str
+        :param messages: List[EasyChatMessage], used to estimate the tokens of the request
+        :returns a function that has to be called when the request is finished
+        :raises AdmissionRejectedError: if a limit is exceeded or the queue is full
+        """
+        if self._limiter is not None and self._limiter.isFull():
+            self._reject("queue_full", self._queue_timeout)
+        taken = self._checkRate(user_id, role_name, messages)
+        if self._limiter is None:
+            return lambda: None
+        if not self._limiter.acquire():
+            self._refund(taken)
+            self._reject("queue_full", self._queue_timeout)
+        released = [ False ]
+        def release():
+            if not released[0]:
+                released[0] = True
+                self._limiter.release()
+        return release
+
+    async def admitAsync(self, user_id : str, role_name : str, messages : List[EasyChatMessage]):
+        """
+        asyncio variant of admit(), the returned function has to be awaited
+        """
+        if self._async_limiter is not None and self._async_limiter.isFull():
+            self._reject("queue_full", self._queue_timeout)
+        taken = await asyncio.to_thread(self._checkRate, user_id, role_name, messages)
+        released = [ False ]
+        async def release():
+            if not released[0] and self._async_limiter is not None:
+                released[0] = True
+                await self._async_limiter.release()
+        if self._async_limiter is not None and not await self._async_limiter.acquire():
+            await asyncio.to_thread(self._refund, taken)
+            self._reject("queue_full", self._queue_timeout)
+        return release
+
+
+_shared_admission_controller : Union[None, AdmissionController] = None
+_shared_admission_controller_lock = threading.Lock()
+
+def get_shared_admission_controller() -> Union[None, AdmissionController]:
+    """
+    Returns the AdmissionController of this worker process (created on first use) or None, if the admission control is disabled
+    """
+    global _shared_admission_controller
+    if str(os.getenv("CHATBOT_ADMISSION", "false")).lower() not in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+        return None
+    if _shared_admission_controller is not None:
+        return _shared_admission_controller
+    with _shared_admission_controller_lock:
+        if _shared_admission_controller is None:
+            backendType = os.getenv("CHATBOT_ADMISSION_BACKEND", "sqlite").lower().strip()
+            if backendType == "redis":
+                if os.getenv("CHATBOT_ADMISSION_REDIS_URL", "") == "":
+                    raise ValueError("CHATBOT_ADMISSION_REDIS_URL is required for the redis admission backend")
+                backend = RedisCounterBackend(os.getenv("CHATBOT_ADMISSION_REDIS_URL"))
+            elif backendType == "memory":
+                backend = MemoryCounterBackend()
+            else:
+                backend = SqliteCounterBackend(os.getenv("CHATBOT_ADMISSION_SQLITE_PATH", "/tmp/chatbot-admission.sqlite"))
+            _shared_admission_controller = AdmissionController(
+                backend,
+                float(os.getenv("CHATBOT_ADMISSION_USER_REQUESTS_PER_MINUTE", "20")),
+                float(os.getenv("CHATBOT_ADMISSION_USER_TOKENS_PER_MINUTE", "100000")),
+                float(os.getenv("CHATBOT_ADMISSION_ROLE_REQUESTS_PER_MINUTE", "0")),
+                float(os.getenv("CHATBOT_ADMISSION_ROLE_TOKENS_PER_MINUTE", "0")),
+                int(os.getenv("CHATBOT_ADMISSION_REQUEST_OVERHEAD_TOKENS", "3000")),
+                int(os.getenv("CHATBOT_ADMISSION_MAX_CONCURRENT", "0")),
+                int(os.getenv("CHATBOT_ADMISSION_MAX_QUEUE", "0")),
+                float(os.getenv("CHATBOT_ADMISSION_QUEUE_TIMEOUT", "5"))
+            )
+    return _shared_admission_controller
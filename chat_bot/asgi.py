@@ -0,0 +1,190 @@
+"""
+ASGI entry point of the chatbot.
+
+The chat endpoints (/api/chat and /api/chat/stream) are served natively with asyncio on top of AsyncEasyChatClient,
+so a single worker process can hold hundreds of concurrent answer streams.
+All other routes (ui, login, blob storage) are served by the existing flask app through a WSGI adapter.
+The JSON contract of the chat endpoints is the same as in views.py.
+
+Run with:
+    gunicorn --workers=4 --worker-class uvicorn.workers.UvicornWorker startup_asgi:app
+"""
+import json, math, os, zlib, threading
+from typing import Union
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route, Mount
+from a2wsgi import WSGIMiddleware
+from werkzeug.test import EnvironBuilder
+from . import app as flask_app
+from .iam import ChatbotUser, iam_get_current_user
+from .views import load_system_prompts
+from .metrics import RequestTimings
+# the openai and azure sdks are imported by the chat endpoints, see views.py
+
+_shared_async_chat_client = None
+_shared_async_chat_client_lock = threading.Lock()
+
+def get_shared_async_chat_client():
+    """
+    Returns the AsyncEasyChatClient of this worker process (created on first use)
+
+    :returns AsyncEasyChatClient
+    """
+    global _shared_async_chat_client
+    if _shared_async_chat_client is not None:
+        return _shared_async_chat_client
+    with _shared_async_chat_client_lock:
+        if _shared_async_chat_client is None:
+            from .easy_chat import AsyncEasyChatClient
+            client = AsyncEasyChatClient()
+            load_system_prompts(client)
+            _shared_async_chat_client = client
+    return _shared_async_chat_client
+
+
+def _get_current_user(request : Request) -> Union[None, ChatbotUser]:
+    # resolve the user through the flask auth layer (session cookie or easy auth headers)
+    environ = EnvironBuilder(
+        path = request.url.path,
+        method = request.method,
+        headers = list(request.headers.items())
+    ).get_environ()
+    with flask_app.request_context(environ):
+        return iam_get_current_user()
+
+
+async def _admit(user : ChatbotUser, messages : list):
+    from .admission import get_shared_admission_controller
+    admission = get_shared_admission_controller()
+    if admission is None:
+        async def release():
+            pass
+        return release
+    return await admission.admitAsync(user.id, user.getRole().getName(), messages)
+
+
+def _rejected(e) -> JSONResponse:
+    return JSONResponse({"success": False, "error": str(e)}, 429, headers = {"Retry-After": str(math.ceil(e.retry_after))})
+
+
+async def api_chat(request : Request):
+    from .easy_chat import dict_to_chat_messages
+    from .azurestorage import get_shared_blob_storage
+    from .admission import AdmissionRejectedError
+    timings = RequestTimings()
+    with timings.measure("auth"):
+        user = _get_current_user(request)
+    if user is None:
+        return JSONResponse({"success": False, "error": "Not logged in"}, 404)
+    timings.setLabel("role", user.getRole().getName())
+    try:
+        messages = dict_to_chat_messages(await request.json())
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, 500)
+    try:
+        with timings.measure("admission"):
+            release = await _admit(user, messages)
+    except AdmissionRejectedError as e:
+        return _rejected(e)
+    try:
+        with timings.measure("setup"):
+            asyncChatClient = get_shared_async_chat_client()
+            context = asyncChatClient.createRequestContext(role = user.getRole(), storage_base_url = get_shared_blob_storage().getBaseUrl(), timings = timings)
+        answer = await asyncChatClient.chat(
+            messages,
+            context = context
+        )
+        with timings.measure("response"):
+            response = JSONResponse(answer, 200)
+        response.headers["Server-Timing"] = timings.toServerTiming()
+        return response
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, 500)
+    finally:
+        await release()
+        timings.finish()
+
+
+async def _release_after(records, release, timings : RequestTimings, timings_record : bool = False):
+    try:
+        async for r in records:
+            yield r
+        if timings_record:
+            yield json.dumps({ "timings": timings.getAll(), "tokens_per_second": timings.getTokensPerSecond() }) + "\n"
+    finally:
+        await release()
+        timings.finish()
+
+
+async def _gzip(chunks):
+    # every chunk is flushed, so the client can render it right away
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+async def api_chat_stream(request : Request):
+    from .easy_chat import dict_to_chat_messages
+    from .azurestorage import get_shared_blob_storage
+    from .admission import AdmissionRejectedError
+    timings = RequestTimings()
+    with timings.measure("auth"):
+        user = _get_current_user(request)
+    if user is None:
+        return JSONResponse({"success": False, "error": "Not logged in"}, 404)
+    timings.setLabel("role", user.getRole().getName())
+    try:
+        messages = dict_to_chat_messages(await request.json())
+    except Exception as e:
+        return JSONResponse({"success": False, "error": str(e)}, 500)
+    try:
+        with timings.measure("admission"):
+            release = await _admit(user, messages)
+    except AdmissionRejectedError as e:
+        return _rejected(e)
+    try:
+        with timings.measure("setup"):
+            asyncChatClient = get_shared_async_chat_client()
+            context = asyncChatClient.createRequestContext(role = user.getRole(), storage_base_url = get_shared_blob_storage().getBaseUrl(), timings = timings)
+        # clients can request the compact stream format (see EasyChatCompactStreamEncoder)
+        compact = str(request.query_params.get("format", "")).lower() == "compact"
+        headers = { "Server-Timing": timings.toServerTiming() }
+        records = _release_after(
+            asyncChatClient.streamedChat(
+                messages,
+                outputFormat = "compact" if compact else "json",
+                context = context
+            ),
+            release,
+            timings,
+            # the timings of the answer are only known at the end, clients can request them as the last record
+            str(request.query_params.get("timings", "false")).lower() in [ "true", "on", "yes", "1" ]
+        )
+        if compact:
+            headers["X-Chat-Stream-Format"] = "compact"
+            if str(os.getenv("CHATBOT_STREAM_GZIP", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ] and "gzip" in request.headers.get("accept-encoding", "").lower():
+                records = _gzip(records)
+                headers["Content-Encoding"] = "gzip"
+                headers["Vary"] = "Accept-Encoding"
+        return StreamingResponse(
+            records,
+            200,
+            headers = headers,
+            media_type = "application/x-ndjson" if compact else "application/json"
+        )
+    except Exception as e:
+        await release()
+        timings.finish()
+        return JSONResponse({"success": False, "error": str(e)}, 500)
+
+
+app = Starlette(
+    routes = [
+        Route("/api/chat", api_chat, methods = ["POST"]),
+        Route("/api/chat/stream", api_chat_stream, methods = ["POST"]),
+        Mount("/", WSGIMiddleware(flask_app))
+    ]
+)
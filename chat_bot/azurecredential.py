@@ -0,0 +1,72 @@
+import os, threading, time
+from typing import Union
+from azure.core.credentials import AccessToken, TokenCredential
+from azure.identity import DefaultAzureCredential
+
+"""
+Environment variables used for the shared Azure credential:
+AZURE_CREDENTIAL_TOKEN_CACHE            Optional, cache access tokens in process (default: true)
+AZURE_CREDENTIAL_TOKEN_REFRESH_MARGIN   Optional, seconds before expiry a cached token gets refreshed (default: 300)
+"""
+
+
+class CachedTokenCredential(TokenCredential):
+    """
+    Wraps a TokenCredential and caches the access tokens per scope until shortly before they expire.
+    Not every credential in the DefaultAzureCredential chain caches its tokens (f.e. the azure cli credential spawns a process per call),
+    so without this wrapper a token can be re-acquired on every request.
+    """
+    _credential : TokenCredential
+    _refresh_margin : int = 300
+    _tokens : dict
+    _lock : threading.Lock
+
+    def __init__(self, credential : TokenCredential, refresh_margin : int = 300):
+        self._credential = credential
+        self._refresh_margin = int(refresh_margin)
+        self._tokens = { }
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes : str, **kwargs) -> AccessToken:
+        # claims or tenant specific requests are not cached
+        if kwargs.get("claims") or kwargs.get("tenant_id"):
+            return self._credential.get_token(*scopes, **kwargs)
+        key = " ".join(sorted(scopes))
+        token = self._tokens.get(key)
+        if token is not None and token.expires_on - self._refresh_margin > time.time():
+            return token
+        with self._lock:
+            # another thread might have refreshed the token in the meantime
+            token = self._tokens.get(key)
+            if token is not None and token.expires_on - self._refresh_margin > time.time():
+                return token
+            token = self._credential.get_token(*scopes, **kwargs)
+            self._tokens[key] = token
+            return token
+
+    def close(self) -> None:
+        try:
+            self._credential.close()
+        except:
+            pass
+
+
+_shared_credential : Union[None, TokenCredential] = None
+_shared_credential_lock = threading.Lock()
+
+def get_default_credential() -> TokenCredential:
+    """
+    Returns the process wide DefaultAzureCredential (created on first use)
+
+    :returns TokenCredential
+    """
+    global _shared_credential
+    if _shared_credential is not None:
+        return _shared_credential
+    with _shared_credential_lock:
+        if _shared_credential is None:
+            credential = DefaultAzureCredential()
+            if str(os.getenv("AZURE_CREDENTIAL_TOKEN_CACHE", "true")).lower() not in [ "false", "off", "no", "disabled", "disable" ]:
+                credential = CachedTokenCredential(credential, int(os.getenv("AZURE_CREDENTIAL_TOKEN_REFRESH_MARGIN", "300")))
+            _shared_credential = credential
+    return _shared_credential
@@ -1,48 +1,74 @@
-import os
+import os, threading, time, json, hashlib, tempfile, base64
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Union
-from azure.storage.blob import BlobServiceClient, BlobClient, ContentSettings, StandardBlobTier
+import requests
+from azure.storage.blob import BlobServiceClient, BlobClient, BlobBlock, ContentSettings, StandardBlobTier, StorageStreamDownloader
 import azure.storage.blob
 from azure.data.tables import TableServiceClient
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from azure.identity import DefaultAzureCredential
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, HttpResponseError
+from azure.core import MatchConditions
+from azure.core.pipeline.transport import RequestsTransport
+from .azurecredential import get_default_credential
+from .metrics import get_counter
 
 """
 Environment variables used for Azure Storage Auto-Configuration:
 AZURE_STORAGEBLOB_CONNECTIONSTRING   Required for storage account key auth (if not using AZURE_STORAGEBLOB_RESOURCEENDPOINT)
 AZURE_STORAGEBLOB_RESOURCEENDPOINT   Required for default credential auth  (if not using AZURE_STORAGEBLOB_CONNECTIONSTRING)
 AZURE_STORAGEBLOB_CONTAINER          Optional, default is 'documents'
+AZURE_STORAGEBLOB_POOL_SIZE          Optional, max. pooled connections of the shared client (default: 32)
+AZURE_STORAGEBLOB_CONNECTION_TIMEOUT Optional, connect timeout in seconds of the shared client (default: 10)
+AZURE_STORAGEBLOB_READ_TIMEOUT       Optional, read timeout in seconds of the shared client (default: 60)
+AZURE_STORAGEBLOB_DOWNLOAD_CHUNK_SIZE   Optional, size in bytes of the chunks streamed by the shared client (default: 1048576)
+CHATBOT_FILE_CACHE_DIR               Optional, directory of the local blob file cache (cache is disabled if not set)
+CHATBOT_FILE_CACHE_SIZE_MB           Optional, max. size of the local blob file cache in MB (default: 1024)
+CHATBOT_FILE_CACHE_REVALIDATE_AFTER  Optional, seconds a cached file is used before it gets revalidated against the blob (default: 60)
 """
 
 
+def get_file_md5(file_path : str, chunk_size : int = 4 * 1024 * 1024) -> bytes:
+    """
+    Returns the MD5 digest of a file (read in chunks, the file is never held in memory)
+    """
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
 class BlobStorage:
     _bsc = None
     _container = ""
     _blob_tier = StandardBlobTier.COOL
 
-    def __init__(self, container : Union[str, None] = None, connection_string : Union[str, None] = None, account_url : Union[str, None] = None, credential = None):
-        # set the blob service client
+    def __init__(self, container : Union[str, None] = None, connection_string : Union[str, None] = None, account_url : Union[str, None] = None, credential = None, **kwargs):
+        # set the blob service client (kwargs are passed to the BlobServiceClient, f.e. transport)
         if connection_string is None and account_url is None:
             if os.getenv("AZURE_STORAGEBLOB_CONNECTIONSTRING"):
                 self._bsc = BlobServiceClient.from_connection_string(
                         conn_str=os.getenv("AZURE_STORAGEBLOB_CONNECTIONSTRING"),
+                        **kwargs
                     )
             elif os.getenv("AZURE_STORAGEBLOB_RESOURCEENDPOINT"):
                 self._bsc = BlobServiceClient(
                     account_url=os.getenv("AZURE_STORAGEBLOB_RESOURCEENDPOINT"),
-                    credential=DefaultAzureCredential()
+                    credential=get_default_credential(),
+                    **kwargs
                 )
             else:
                 raise ValueError("No connection string or resource endpoint provided")
         elif connection_string is not None:
             if credential is None:
-                self._bsc = BlobServiceClient.from_connection_string(conn_str=connection_string)
+                self._bsc = BlobServiceClient.from_connection_string(conn_str=connection_string, **kwargs)
             else:
-                self._bsc = BlobServiceClient.from_connection_string(conn_str=connection_string, credential=credential)
+                self._bsc = BlobServiceClient.from_connection_string(conn_str=connection_string, credential=credential, **kwargs)
         elif account_url is not None:
             if credential is None:
-                self._bsc = BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+                self._bsc = BlobServiceClient(account_url=account_url, credential=get_default_credential(), **kwargs)
             else:
-                self._bsc = BlobServiceClient(account_url=account_url, credential=credential)
+                self._bsc = BlobServiceClient(account_url=account_url, credential=credential, **kwargs)
         else:
             raise ValueError("No connection_string or account_url provided")
         # Set the container
@@ -61,11 +87,16 @@ class BlobStorage:
     def getBaseUrl(self) -> str:
         return "https://" + str(self._bsc.account_name).lower().split(".")[0] + ".blob.core.windows.net" + "/" + str(self._container)   
     
-    def hasFullPath(self, account_name : str, container_name : str, path : str) -> bool:
+    def isAccountAndContainer(self, account_name : str, container_name : str) -> bool:
         if account_name.lower().split(".")[0] != str(self._bsc.account_name).lower().split(".")[0]:
             return False
         if container_name.lower() != self._container.lower():
             return False
+        return True
+
+    def hasFullPath(self, account_name : str, container_name : str, path : str) -> bool:
+        if not self.isAccountAndContainer(account_name, container_name):
+            return False
         return self._getBlobClientForPath(path).exists()
 
     def _getBlobClientForPath(self, path : str) -> BlobClient:
@@ -77,8 +108,9 @@ class BlobStorage:
     def getBlobTier(self):
         return self._blob_tier
     
-    def hasPath(self, path : str) -> bool:
-        return self._getBlobClientForPath(path).exists()
+    def hasPath(self, path : str, **kwargs) -> bool:
+        # kwargs are passed to the request, f.e. retry_total
+        return self._getBlobClientForPath(path).exists(**kwargs)
     
     def uploadBinary(self, path : str, binary, content_settings : Union[None, str, ContentSettings] = None, overwrite : bool = False):
         if isinstance(binary, bytearray):
@@ -94,12 +126,78 @@ class BlobStorage:
             return False
         return True
 
+    def uploadFile(self, path : str, file_path : str, content_settings : Union[None, str, ContentSettings] = None, block_size : int = 4 * 1024 * 1024, content_md5 : Union[None, bytes] = None) -> str:
+        """
+        Uploads a file from disk, a file larger than block_size is staged block by block and committed at the end,
+        so only one block is held in memory. The MD5 of the file is stored as Content-MD5 of the blob (see listPath).
+        Blocks staged by an interrupted upload of the same content are not uploaded again (uncommitted blocks are kept by the storage for 7 days).
+        An existing blob is overwritten.
+
+        :param path: str, path of the blob
+        :param file_path: str, local file
+        :param content_settings: str (content type) or ContentSettings, optional
+        :param block_size: int, max. bytes per request (max. 4000 MiB, up to 50000 blocks per blob)
+        :param content_md5: bytes, optional, the MD5 digest of the file if already known
+        :returns str, the ETag of the uploaded blob
+        """
+        if content_md5 is None:
+            content_md5 = get_file_md5(file_path)
+        if isinstance(content_settings, str):
+            content_settings = ContentSettings(content_settings)
+        if not isinstance(content_settings, ContentSettings):
+            content_settings = ContentSettings()
+        content_settings.content_md5 = bytearray(content_md5)
+        block_size = max(1, int(block_size))
+        size = os.path.getsize(file_path)
+        bc = self._getBlobClientForPath(path)
+        with open(file_path, "rb") as f:
+            if size <= block_size:
+                r = bc.upload_blob(f.read(), overwrite = True, standard_blob_tier = self._blob_tier, content_settings = content_settings)
+                return str(r["etag"])
+            # the ids depend on the content and the block size, so only blocks of the same file version are reused
+            prefix = content_md5.hex() + "-" + str(block_size) + "-"
+            ids = [ base64.b64encode((prefix + "%08d" % i).encode("ascii")).decode("ascii") for i in range((size + block_size - 1) // block_size) ]
+            try:
+                staged = set(b.id for b in bc.get_block_list("uncommitted")[1])
+            except ResourceNotFoundError:
+                staged = set()
+            for i, blockId in enumerate(ids):
+                if blockId in staged:
+                    continue
+                f.seek(i * block_size)
+                data = f.read(block_size)
+                bc.stage_block(blockId, data, length = len(data))
+        r = bc.commit_block_list([ BlobBlock(blockId) for blockId in ids ], content_settings = content_settings, standard_blob_tier = self._blob_tier)
+        return str(r["etag"])
+
     def downloadBinary(self, path : str) -> Union[None, bytes]:
         try:
             return self._getBlobClientForPath(path).download_blob().readall()
         except ResourceNotFoundError:
             return None
     
+    def getETag(self, path : str) -> Union[None, str]:
+        try:
+            return str(self._getBlobClientForPath(path).get_blob_properties().etag)
+        except ResourceNotFoundError:
+            return None
+
+    def downloadStream(self, path : str, offset : Union[None, int] = None, length : Union[None, int] = None, **kwargs) -> Union[None, StorageStreamDownloader]:
+        """
+        Starts a (ranged) download, the content can be streamed with chunks() of the returned downloader
+
+        :param path: str, path of the blob
+        :param offset: int, optional, start of the byte range
+        :param length: int, optional, number of bytes to download (requires offset)
+        :param kwargs: passed to download_blob, f.e. etag and match_condition for conditional downloads
+        :returns StorageStreamDownloader or None in case the blob does not exist
+        :raises HttpResponseError: f.e. with status code 416 in case the range is not satisfiable or 304 in case of not modified
+        """
+        try:
+            return self._getBlobClientForPath(path).download_blob(offset = offset, length = length, **kwargs)
+        except ResourceNotFoundError:
+            return None
+
     def deletePath(self, path : str) -> bool:
         try:
             self._getBlobClientForPath(path).delete_blob(delete_snapshots="include")
@@ -117,7 +215,351 @@ class BlobStorage:
                 "ContentType"  : blob.content_settings.content_type,
                 "Created"      : blob.creation_time,
                 "LastModified" : blob.last_modified,
-                "Size"         : blob.size
+                "Size"         : blob.size,
+                "ETag"         : str(blob.etag),
+                "ContentMD5"   : bytes(blob.content_settings.content_md5 or b"")
             })
         return a
-    
\ No newline at end of file
+
+
+def create_pooled_transport(pool_size : Union[None, int] = None, connection_timeout : Union[None, int] = None, read_timeout : Union[None, int] = None) -> RequestsTransport:
+    """
+    Creates a requests based transport with a sized connection pool
+
+    :param pool_size: int, optional, default from AZURE_STORAGEBLOB_POOL_SIZE or 32
+    :param connection_timeout: int, optional, default from AZURE_STORAGEBLOB_CONNECTION_TIMEOUT or 10
+    :param read_timeout: int, optional, default from AZURE_STORAGEBLOB_READ_TIMEOUT or 60
+    :returns RequestsTransport
+    """
+    if pool_size is None:
+        pool_size = int(os.getenv("AZURE_STORAGEBLOB_POOL_SIZE", "32"))
+    if connection_timeout is None:
+        connection_timeout = int(os.getenv("AZURE_STORAGEBLOB_CONNECTION_TIMEOUT", "10"))
+    if read_timeout is None:
+        read_timeout = int(os.getenv("AZURE_STORAGEBLOB_READ_TIMEOUT", "60"))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = max(1, int(pool_size)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session = session, session_owner = False, connection_timeout = connection_timeout, read_timeout = read_timeout)
+
+
+_shared_blob_storage : Union[None, BlobStorage] = None
+_shared_blob_storage_lock = threading.Lock()
+
+def get_shared_blob_storage() -> BlobStorage:
+    """
+    Returns the BlobStorage of this worker process (created on first use).
+    The underlying BlobServiceClient is thread-safe and keeps its connections and tokens across requests.
+
+    :returns BlobStorage
+    """
+    global _shared_blob_storage
+    if _shared_blob_storage is not None:
+        return _shared_blob_storage
+    with _shared_blob_storage_lock:
+        if _shared_blob_storage is None:
+            chunkSize = int(os.getenv("AZURE_STORAGEBLOB_DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+            _shared_blob_storage = BlobStorage(
+                transport = create_pooled_transport(),
+                max_single_get_size = chunkSize,
+                max_chunk_get_size = chunkSize
+            )
+    return _shared_blob_storage
+
+
+class BlobFileCacheEntry:
+    _path : str
+    _file_path : str
+    _etag : str
+    _size : int
+    _content_type : str
+    _validated_at : float = 0
+    _downloader : Union[None, StorageStreamDownloader] = None
+
+    def __init__(self, path : str, file_path : str, etag : str, size : int, content_type : str, validated_at : float = 0, downloader : Union[None, StorageStreamDownloader] = None):
+        self._path = str(path)
+        self._file_path = str(file_path)
+        self._etag = str(etag)
+        self._size = int(size)
+        self._content_type = str(content_type)
+        self._validated_at = float(validated_at)
+        self._downloader = downloader
+
+    def getPath(self) -> str:
+        return self._path
+    def getFilePath(self) -> str:
+        return self._file_path
+    def getETag(self) -> str:
+        return self._etag
+    def getSize(self) -> int:
+        return self._size
+    def getContentType(self) -> str:
+        return self._content_type
+    def getValidatedAt(self) -> float:
+        return self._validated_at
+    def setValidatedAt(self, validated_at : float):
+        self._validated_at = float(validated_at)
+    def isCached(self) -> bool:
+        """
+        False for a blob larger than the cache, it has no file and is read from getDownloader()
+        """
+        return self._downloader is None
+    def getDownloader(self) -> Union[None, StorageStreamDownloader]:
+        return self._downloader
+
+
+class BlobFileCache:
+    """
+    Size bounded on-disk LRU cache of blobs, keyed by blob path and ETag.
+    A cached file is used without contacting the storage for revalidate_after seconds,
+    afterwards it is revalidated with a conditional (If-None-Match) download.
+    Blobs larger than the cache are not stored, their entry holds the open download instead of a file.
+    Every worker process keeps its own index of the (shared) directory.
+    """
+    _bs : BlobStorage
+    _directory : str
+    _max_size : int
+    _revalidate_after : int
+    _entries : OrderedDict
+    _size : int = 0
+    _lock : threading.Lock
+    _path_locks : dict
+    # seconds without a write after which a temporary download file is removed
+    STALE_DOWNLOAD_AGE = 600
+
+    def __init__(self, blob_storage : BlobStorage, directory : str, max_size : int = 1024 * 1024 * 1024, revalidate_after : int = 60):
+        """
+        Create a new BlobFileCache
+
+        :param blob_storage: BlobStorage, the storage the files are downloaded from
+        :param directory: str, cache directory (created if it does not exist)
+        :param max_size: int, max. size of all cached files in bytes
+        :param revalidate_after: int, seconds a cached file is used before it gets revalidated
+        """
+        self._bs = blob_storage
+        self._directory = str(directory)
+        self._max_size = int(max_size)
+        self._revalidate_after = int(revalidate_after)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._path_locks = { }
+        self._hits = get_counter("blob_file_cache_hits_total", "Number of files served from the local file cache")
+        self._misses = get_counter("blob_file_cache_misses_total", "Number of files downloaded into the local file cache")
+        self._revalidations = get_counter("blob_file_cache_revalidations_total", "Number of cached files revalidated against the blob storage")
+        self._evictions = get_counter("blob_file_cache_evictions_total", "Number of files evicted from the local file cache")
+        os.makedirs(self._directory, exist_ok = True)
+        self._loadIndex()
+
+    def _loadIndex(self):
+        # restore the entries of a previous run, least recently used first
+        found = []
+        for name in os.listdir(self._directory):
+            if name.startswith(".download-"):
+                self._removeStaleDownload(os.path.join(self._directory, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self._directory, name), "r") as f:
+                    meta = json.load(f)
+                filePath = os.path.join(self._directory, name[:-5])
+                found.append((os.path.getmtime(filePath), BlobFileCacheEntry(meta["path"], filePath, meta["etag"], meta["size"], meta["content_type"])))
+            except:
+                pass
+        found.sort(key = lambda x: x[0])
+        with self._lock:
+            for _, entry in found:
+                self._entries[entry.getPath()] = entry
+                self._size += entry.getSize()
+        self._evict()
+
+    def _removeStaleDownload(self, tmpPath : str):
+        # temporary file of a download that was interrupted (f.e. the worker was killed), downloads of
+        # other worker processes sharing the directory are still written to and keep a recent mtime
+        try:
+            if time.time() - os.path.getmtime(tmpPath) > self.STALE_DOWNLOAD_AGE:
+                os.remove(tmpPath)
+        except OSError:
+            pass
+
+    def _evict(self, keep : Union[None, str] = None):
+        # keep: path of the entry that was just stored, it is never evicted
+        removed = []
+        with self._lock:
+            while self._size > self._max_size and len(self._entries) > 0:
+                if next(iter(self._entries)) == keep:
+                    if len(self._entries) == 1:
+                        break
+                    self._entries.move_to_end(keep)
+                    continue
+                _, entry = self._entries.popitem(last = False)
+                self._size -= entry.getSize()
+                removed.append(entry)
+        for entry in removed:
+            self._removeFiles(entry)
+            self._evictions.inc()
+
+    def _removeFiles(self, entry : BlobFileCacheEntry):
+        for p in [ entry.getFilePath(), entry.getFilePath() + ".json" ]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _remove(self, path : str):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._size -= entry.getSize()
+        if entry is not None:
+            self._removeFiles(entry)
+
+    def _store(self, path : str, downloader : StorageStreamDownloader) -> BlobFileCacheEntry:
+        etag = str(downloader.properties.etag)
+        fileName = hashlib.sha256((path + "\n" + etag).encode("utf-8")).hexdigest()
+        filePath = os.path.join(self._directory, fileName)
+        contentType = downloader.properties.content_settings.content_type or "application/octet-stream"
+        # write to a temporary file first, so no partial file is ever served
+        fd, tmpPath = tempfile.mkstemp(dir = self._directory, prefix = ".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                downloader.readinto(f)
+            os.replace(tmpPath, filePath)
+        except:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+            raise
+        entry = BlobFileCacheEntry(path, filePath, etag, os.path.getsize(filePath), contentType, time.time())
+        with open(filePath + ".json", "w") as f:
+            json.dump({ "path": path, "etag": etag, "size": entry.getSize(), "content_type": contentType }, f)
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._size -= previous.getSize()
+            self._entries[path] = entry
+            self._size += entry.getSize()
+        # the same blob version has the same file name, only the file of an older version is removed
+        if previous is not None and previous.getFilePath() != filePath:
+            self._removeFiles(previous)
+        self._evict(path)
+        return entry
+
+    def getFile(self, path : str) -> Union[None, BlobFileCacheEntry]:
+        """
+        Returns the cache entry of the blob (downloads or revalidates it if required).
+        The file of an entry can be evicted by another worker process before it is opened, call getFile() again in that case.
+
+        :param path: str, path of the blob
+        :returns BlobFileCacheEntry (not cached, see isCached(), if the blob is larger than the cache) or None in case the blob does not exist
+        """
+        entry = self._getEntry(path)
+        if entry is not None and self._isFresh(entry):
+            self._hits.inc()
+            return entry
+        # one download or revalidation per path, concurrent requests for the path wait for it
+        with self._lockPath(path):
+            return self._fetch(path)
+
+    def _getEntry(self, path : str) -> Union[None, BlobFileCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+        if entry is not None and not os.path.exists(entry.getFilePath()):
+            # evicted by another worker process
+            self._remove(path)
+            entry = None
+        return entry
+
+    def _isFresh(self, entry : BlobFileCacheEntry) -> bool:
+        return time.time() - entry.getValidatedAt() < self._revalidate_after
+
+    @contextmanager
+    def _lockPath(self, path : str):
+        with self._lock:
+            lock = self._path_locks.get(path)
+            if lock is None:
+                # [lock, number of threads using it]
+                lock = [ threading.Lock(), 0 ]
+                self._path_locks[path] = lock
+            lock[1] += 1
+        try:
+            with lock[0]:
+                yield
+        finally:
+            with self._lock:
+                lock[1] -= 1
+                if lock[1] == 0:
+                    del self._path_locks[path]
+
+    def _fetch(self, path : str) -> Union[None, BlobFileCacheEntry]:
+        # another thread might have downloaded or revalidated the file in the meantime
+        entry = self._getEntry(path)
+        if entry is not None and self._isFresh(entry):
+            self._hits.inc()
+            return entry
+        try:
+            if entry is None:
+                downloader = self._bs.downloadStream(path)
+            else:
+                self._revalidations.inc()
+                downloader = self._bs.downloadStream(path, etag = entry.getETag(), match_condition = MatchConditions.IfModified)
+        except HttpResponseError as e:
+            if entry is not None and e.status_code == 304:
+                entry.setValidatedAt(time.time())
+                self._hits.inc()
+                return entry
+            raise
+        if downloader is None:
+            self._remove(path)
+            return None
+        self._misses.inc()
+        if downloader.size > self._max_size:
+            # would evict the whole cache (and itself), the caller streams it from the storage
+            self._remove(path)
+            return BlobFileCacheEntry(
+                path, "", str(downloader.properties.etag), downloader.size,
+                downloader.properties.content_settings.content_type or "application/octet-stream", time.time(), downloader
+            )
+        return self._store(path, downloader)
+
+    def getStats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "size": self._size,
+                "max_size": self._max_size,
+                "hits": self._hits.get(),
+                "misses": self._misses.get(),
+                "revalidations": self._revalidations.get(),
+                "evictions": self._evictions.get()
+            }
+
+
+_shared_blob_file_cache : Union[None, BlobFileCache] = None
+_shared_blob_file_cache_lock = threading.Lock()
+
+def get_shared_blob_file_cache() -> Union[None, BlobFileCache]:
+    """
+    Returns the BlobFileCache of this worker process (created on first use) or None if CHATBOT_FILE_CACHE_DIR is not set
+
+    :returns BlobFileCache or None
+    """
+    global _shared_blob_file_cache
+    if not os.getenv("CHATBOT_FILE_CACHE_DIR"):
+        return None
+    if _shared_blob_file_cache is not None:
+        return _shared_blob_file_cache
+    with _shared_blob_file_cache_lock:
+        if _shared_blob_file_cache is None:
+            _shared_blob_file_cache = BlobFileCache(
+                get_shared_blob_storage(),
+                os.getenv("CHATBOT_FILE_CACHE_DIR"),
+                int(os.getenv("CHATBOT_FILE_CACHE_SIZE_MB", "1024")) * 1024 * 1024,
+                int(os.getenv("CHATBOT_FILE_CACHE_REVALIDATE_AFTER", "60"))
+            )
+    return _shared_blob_file_cache
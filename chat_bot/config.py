@@ -0,0 +1,260 @@
+import os, threading, time
+from typing import Union, List, Callable
+from .iam import USE_AUTH_TYPE, ChatbotRole, ChatbotUser, create_all_roles, create_all_users
+from .metrics import get_counter
+
+"""
+Environment variables used for the configuration files (roles.json, users.json, system-prompt.md and system-prompt-fewshot-examples.md):
+CHATBOT_CONFIG_DIR              Optional, directory of the configuration files (default: the directory of the app)
+CHATBOT_CONFIG_RELOAD_INTERVAL  Optional, seconds between checks of the files, changed files are loaded without restarting the workers, 0 disables the reload (default: 5)
+"""
+
+CONFIG_FILES = [ "roles.json", "users.json", "system-prompt.md", "system-prompt-fewshot-examples.md" ]
+
+
+def get_config_directory() -> str:
+    directory = os.getenv("CHATBOT_CONFIG_DIR", "")
+    if directory == "":
+        directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    return directory
+
+
+def _read_prompt(path : str) -> str:
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+class ChatbotConfig:
+    """
+    Immutable snapshot of the configuration files: the roles (with their search filters), the users of the local authentication and the system prompts.
+    A reload builds a new snapshot and replaces the current one, so a request never sees a partly loaded configuration.
+    """
+    _version : int
+    _roles : dict
+    _role_groups : frozenset
+    _users : dict
+    _system_message : str
+    _few_shot_examples : List[str]
+
+    def __init__(self, version : int, roles : dict, users : dict, system_message : str = "", few_shot_examples : List[str] = [ ]):
+        """
+        Create a new ChatbotConfig
+
+        :param version: int, increases with every reload
+        :param roles: dict, role name -> ChatbotRole (has to contain 'user')
+        :param users: dict, user id -> ChatbotUser
+        :param system_message: str, empty to keep the default system message of the client
+        :param few_shot_examples: List[str]
+        """
+        if "user" not in roles:
+            raise ValueError("The role 'user' is required")
+        self._version = int(version)
+        self._roles = dict(roles)
+        self._role_groups = frozenset(self._roles.keys())
+        self._users = dict(users)
+        self._system_message = str(system_message)
+        self._few_shot_examples = list(few_shot_examples)
+
+    def getVersion(self) -> int:
+        return self._version
+    def getRoles(self) -> dict:
+        return dict(self._roles)
+    def getRole(self, name : str) -> ChatbotRole:
+        """
+        Returns the role or the 'user' role if it is not defined
+        """
+        return self._roles.get(name, self._roles["user"])
+    def getRoleGroups(self) -> frozenset:
+        return self._role_groups
+    def getUsers(self) -> dict:
+        return dict(self._users)
+    def getUser(self, user_id : str) -> Union[None, ChatbotUser]:
+        return self._users.get(user_id)
+    def getSystemMessage(self) -> str:
+        return self._system_message
+    def getFewShotExamples(self) -> List[str]:
+        return list(self._few_shot_examples)
+
+    def precompile(self, previous : Union[None, "ChatbotConfig"] = None):
+        """
+        Builds the search filters of all roles for the storage base urls used with the previous configuration
+        """
+        urls = set([ "" ])
+        if previous is not None:
+            for role in previous._roles.values():
+                urls.update(role.getSearchFilterBaseUrls())
+        for role in self._roles.values():
+            for url in urls:
+                role.getSearchFilter(url)
+
+
+def load_config(directory : Union[None, str] = None, version : int = 1) -> ChatbotConfig:
+    """
+    Loads the configuration files of the directory (missing files are skipped, users are only loaded for the local authentication)
+
+    :param directory: str, optional, default see get_config_directory()
+    :param version: int, version of the new configuration
+    :returns ChatbotConfig
+    :raises ValueError: if a json file is not valid
+    """
+    if directory is None:
+        directory = get_config_directory()
+    roles = create_all_roles(directory)
+    users = create_all_users(roles, directory) if USE_AUTH_TYPE == "local" else { }
+    fewShot = _read_prompt(os.path.join(directory, "system-prompt-fewshot-examples.md"))
+    return ChatbotConfig(
+        version,
+        roles,
+        users,
+        _read_prompt(os.path.join(directory, "system-prompt.md")),
+        [ fewShot ] if fewShot != "" else [ ]
+    )
+
+
+class ChatbotConfigWatcher:
+    """
+    Keeps the current ChatbotConfig and reloads it in a background thread when one of the configuration files changes (size, mtime or inode).
+    Requests only read the current snapshot and never wait for a reload. A file that cannot be loaded (f.e. while it is written)
+    keeps the previous configuration until the file changes again.
+    """
+    _directory : str
+    _interval : float
+    _config : ChatbotConfig
+    _signature : tuple
+    _listeners : List[Callable[[ChatbotConfig], None]]
+    _lock : threading.Lock
+    _thread : Union[None, threading.Thread] = None
+
+    def __init__(self, directory : Union[None, str] = None, interval : float = 5):
+        """
+        Create a new ChatbotConfigWatcher, the configuration is loaded right away
+
+        :param directory: str, optional, default see get_config_directory()
+        :param interval: float, seconds between checks of the files (see start())
+        :raises ValueError: if a json file is not valid
+        """
+        self._directory = get_config_directory() if directory is None else str(directory)
+        self._interval = float(interval)
+        self._listeners = [ ]
+        self._lock = threading.Lock()
+        self._thread = None
+        self._reloads = get_counter("config_reloads_total", "Number of configuration reloads")
+        self._errors = get_counter("config_reload_errors_total", "Number of configuration reloads that failed")
+        self._signature = self._getSignature()
+        self._config = load_config(self._directory)
+        self._config.precompile()
+
+    def _getSignature(self) -> tuple:
+        signature = [ ]
+        for name in CONFIG_FILES:
+            try:
+                st = os.stat(os.path.join(self._directory, name))
+                signature.append((name, st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                signature.append((name, None))
+        return tuple(signature)
+
+    def getConfig(self) -> ChatbotConfig:
+        return self._config
+
+    def addListener(self, listener : Callable[[ChatbotConfig], None]):
+        """
+        Registers a function that is called with the current configuration and again after every reload (in the thread of the watcher)
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            listener(self._config)
+
+    def checkForChanges(self) -> bool:
+        """
+        Reloads the configuration if a file has changed
+
+        :returns bool, True if a new configuration was loaded
+        """
+        with self._lock:
+            signature = self._getSignature()
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            try:
+                config = load_config(self._directory, self._config.getVersion() + 1)
+                config.precompile(self._config)
+            except Exception as e:
+                self._errors.inc()
+                print("Configuration not reloaded:", str(e))
+                return False
+            self._config = config
+            for listener in self._listeners:
+                try:
+                    listener(config)
+                except Exception as e:
+                    print("Configuration listener failed:", str(e))
+        self._reloads.inc()
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self.checkForChanges()
+            except Exception as e:
+                print("Configuration check failed:", str(e))
+
+    def start(self):
+        """
+        Starts the background thread that checks the files every interval seconds (not started if the interval is 0)
+        """
+        with self._lock:
+            if self._thread is not None or self._interval <= 0:
+                return
+            self._thread = threading.Thread(target = self._run, name = "chatbot-config-watcher", daemon = True)
+            self._thread.start()
+
+    def _restartAfterFork(self):
+        # the child of a fork (f.e. a uwsgi worker without lazy-apps) only runs the forking thread,
+        # the lock might have been held by the thread of the parent
+        self._lock = threading.Lock()
+        started = self._thread is not None
+        self._thread = None
+        if started:
+            self.start()
+
+
+_shared_config_watcher : Union[None, ChatbotConfigWatcher] = None
+_shared_config_watcher_lock = threading.Lock()
+
+def get_shared_config_watcher() -> ChatbotConfigWatcher:
+    """
+    Returns the ChatbotConfigWatcher of this worker process (created and started on first use)
+
+    :returns ChatbotConfigWatcher
+    """
+    global _shared_config_watcher
+    if _shared_config_watcher is not None:
+        return _shared_config_watcher
+    with _shared_config_watcher_lock:
+        if _shared_config_watcher is None:
+            watcher = ChatbotConfigWatcher(interval = float(os.getenv("CHATBOT_CONFIG_RELOAD_INTERVAL", "5")))
+            watcher.start()
+            _shared_config_watcher = watcher
+    return _shared_config_watcher
+
+
+def _restart_shared_config_watcher():
+    global _shared_config_watcher_lock
+    _shared_config_watcher_lock = threading.Lock()
+    if _shared_config_watcher is not None:
+        _shared_config_watcher._restartAfterFork()
+
+if hasattr(os, "register_at_fork"):
+    # a watcher created before the fork keeps checking the files in every worker
+    os.register_at_fork(after_in_child = _restart_shared_config_watcher)
+
+
+def get_config() -> ChatbotConfig:
+    """
+    Returns the current configuration, read it once per request to use the same snapshot for the whole request
+    """
+    return get_shared_config_watcher().getConfig()
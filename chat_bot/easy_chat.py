@@ -1,24 +1,78 @@
-import os, re
-from urllib.parse import unquote, quote
-from typing import Union, List, Generator
-from openai import AzureOpenAI
+import os, re, asyncio, copy, hashlib, threading, time, queue, sqlite3
+from urllib.parse import unquote
+from typing import Union, List, Tuple, Generator, AsyncGenerator
+import numpy as np
+from openai import AzureOpenAI, AsyncAzureOpenAI
 from openai.types.chat import ChatCompletion, ChatCompletionChunk
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from .iam import ChatbotRole
+from azure.identity import get_bearer_token_provider
+from .iam import ChatbotRole, build_search_filter_from_role
+from .metrics import get_counter, RequestTimings
+from .lrucache import LRUCache
+from .azurecredential import get_default_credential
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .openaipool import OpenAIBackendPool, create_backend_pool_from_env
+from .openaihttp import get_shared_openai_http_client
+from .retrieval import AzureSearchRetriever, get_azure_search_index_version
+from .localindex import LocalIndexRetriever
 import json
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 """
 Environment variables used for EasyChatClient Auto-Configuration:
-OPENAI_API_BASE             Required
+OPENAI_API_BASE             Required (unless OPENAI_BACKENDS is set)
 OPENAI_API_KEY              Optional, if not set will use default credential
 OPENAI_DEPLOYMENT_NAME      Optional, default is 'gpt-4o'
 OPENAI_EMBEDDING_DEPLOYMENT_NAME    Optional, default is 'text-embedding-ada-002'
-AZURESEARCH_API_BASE        Required
+OPENAI_BACKENDS             Optional, JSON list of deployments to balance the chat completions over (see openaipool.py)
+OPENAI_HTTP_*               Optional, connection pool, timeouts and HTTP/2 of the http client shared by all openai clients (see openaihttp.py)
+AZURESEARCH_API_BASE        Required (unless CHATBOT_RETRIEVAL_BACKEND is 'local')
 AZURESEARCH_API_KEY         Optional, if not set will use managed identity of open ai
 AZURESEARCH_INDEX_NAME      Optiona, default is 'documents'
+CHATBOT_ANSWER_CACHE        Optional, enable the answer cache (default: false)
+CHATBOT_ANSWER_CACHE_SIZE   Optional, max. number of cached answers (default: 1000)
+CHATBOT_ANSWER_CACHE_TTL    Optional, seconds an answer is cached (default: 3600)
+CHATBOT_ANSWER_CACHE_SIMILARITY     Optional, min. cosine similarity of a question to reuse an answer, 0 disables the similarity lookup (default: 0.97)
+CHATBOT_ANSWER_CACHE_INDEX_CHECK_INTERVAL   Optional, seconds between checks of the search index version (default: 300)
+CHATBOT_COALESCE_REQUESTS   Optional, identical concurrent requests share one upstream completion (default: false)
+CHATBOT_HISTORY_TOKEN_BUDGET        Optional, max. number of tokens of the conversation history sent to the model, 0 means no limit (default: 0)
+CHATBOT_HISTORY_SUMMARIZE           Optional, summarize the turns that exceed the history budget instead of dropping them (default: false)
+CHATBOT_HISTORY_SUMMARY_TOKENS      Optional, max. number of tokens of a history summary (default: 300)
+CHATBOT_CITATION_SNIPPET_LENGTH     Optional, max. number of characters of the citation content sent to the client, 0 sends the full chunks (default: 0)
+CHATBOT_CITATION_STORE_SIZE         Optional, max. number of full citation texts kept for /api/chat/citation (default: 5000)
+CHATBOT_CITATION_STORE_TTL          Optional, seconds the full citation texts are kept (default: 3600)
+CHATBOT_CITATION_STORE_BACKEND      Optional, where the full citation texts are kept: memory (per worker process), sqlite (shared by the workers of a host) or redis (shared by all hosts) (default: sqlite)
+CHATBOT_CITATION_STORE_SQLITE_PATH  Optional, path of the sqlite database (default: /tmp/chatbot-citations.sqlite)
+CHATBOT_CITATION_STORE_REDIS_URL    Optional, redis url, required for the redis backend (f.e. rediss://:password@host:6380/0)
+CHATBOT_RETRIEVAL                   Optional, query the search index directly (with a result cache) instead of the azure_search data source (see retrieval.py)
+CHATBOT_RETRIEVAL_BACKEND           Optional, 'azure' or 'local' (a local index instead of azure search, see localindex.py) (default: azure)
+CHATBOT_EMBEDDING_CACHE_SIZE        Optional, max. number of query embeddings kept in memory (default: 10000)
+CHATBOT_EMBEDDING_STORE_PATH        Optional, directory to keep the query embeddings on disk, shared by all worker processes (default: not set)
+CHATBOT_EMBEDDING_BATCH_WINDOW      Optional, seconds to collect concurrent embedding requests into one call, 0 disables batching (default: 0.01)
+CHATBOT_EMBEDDING_MAX_BATCH_SIZE    Optional, max. number of texts per embedding call (default: 16)
 """
 
-def get_json_serializable_response(completion : Union[ChatCompletion, ChatCompletionChunk]) -> dict:
+def get_json_serializable_response(
+    completion : Union[ChatCompletion, ChatCompletionChunk],
+    snippet_length : int = 0,
+    citation_store : Union[None, "EasyChatCitationStore"] = None,
+    citation_scope : str = ""
+) -> dict:
+    """
+    Converts a completion (or chunk) into a JSON serializable dict, the intent and the citations of the context are parsed
+
+    :param completion: ChatCompletion or ChatCompletionChunk
+    :param snippet_length: int, if greater than 0, the citation content is trimmed and duplicate chunks are removed (see compact_citations)
+    :param citation_store: EasyChatCitationStore, optional, keeps the full texts of trimmed citations
+    :param citation_scope: str, scope of the stored texts (f.e. the search filter of the role)
+    :returns dict
+    """
     if isinstance(completion, ChatCompletionChunk):
         isStreamed = True
     else:
@@ -47,10 +101,11 @@ def get_json_serializable_response(completion : Union[ChatCompletion, ChatComple
     for choice in completion.choices:
         if isStreamed:
             currentKey = "delta"
+            # end_turn is only sent with a data source (not with the direct retrieval)
             c = {
                 "finish_reason": choice.finish_reason,
                 "index": choice.index,
-                "end_turn": choice.end_turn,
+                "end_turn": getattr(choice, "end_turn", None),
                 #"logprobs": choice.logprobs,
                 currentKey: {
                     "refusal": choice.delta.refusal,
@@ -69,7 +124,7 @@ def get_json_serializable_response(completion : Union[ChatCompletion, ChatComple
             c = {
                 "finish_reason": choice.finish_reason,
                 "index": choice.index,
-                "end_turn": choice.message.end_turn,
+                "end_turn": getattr(choice.message, "end_turn", None),
                 #"logprobs": choice.logprobs,
                 currentKey: {
                     "refusal": choice.message.refusal,
@@ -104,9 +159,543 @@ def get_json_serializable_response(completion : Union[ChatCompletion, ChatComple
                                 citation["storageaccount_blob"] = unquote("/".join(urlParts[4:]).split("?")[0].split("#")[0])
                     except:
                         pass
+                if snippet_length > 0:
+                    c[currentKey]["context"]["citations"] = compact_citations(c[currentKey]["context"]["citations"], snippet_length, citation_store, citation_scope)
         data["choices"].append(c)
     return data
 
+def _trim_snippet(content : str, snippet_length : int) -> str:
+    if len(content) <= snippet_length:
+        return content
+    snippet = content[:snippet_length]
+    # cut at the last word boundary, if there is one in the second half of the snippet
+    boundary = max(snippet.rfind(" "), snippet.rfind("\n"))
+    if boundary > snippet_length // 2:
+        snippet = snippet[:boundary]
+    return snippet.rstrip() + "..."
+
+# min. number of characters two chunks of a document have to share to be treated as overlapping
+MIN_CITATION_OVERLAP = 40
+
+def _chunk_overlap(first : str, second : str) -> int:
+    """
+    Returns the length of the longest end of first that is the start of second (0 if it is shorter than MIN_CITATION_OVERLAP)
+    """
+    if len(first) < MIN_CITATION_OVERLAP or len(second) < MIN_CITATION_OVERLAP:
+        return 0
+    probe = second[:MIN_CITATION_OVERLAP]
+    p = first.find(probe, max(0, len(first) - len(second)))
+    while p != -1:
+        if second.startswith(first[p:]):
+            return len(first) - p
+        p = first.find(probe, p + 1)
+    return 0
+
+def _citation_document(citation : dict) -> Union[None, str]:
+    # the chunks of a document share the url, the file path has the chunk number (_pages_N)
+    if citation.get("url"):
+        return str(citation["url"])
+    if citation.get("filepath"):
+        return re.sub(r'_pages_\d+', '', str(citation["filepath"]))
+    return None
+
+def compact_citations(citations : list, snippet_length : int, store : Union[None, "EasyChatCitationStore"] = None, scope : str = "") -> list:
+    """
+    Trims the content of the citations to a snippet and removes the text the chunks of a document share.
+    The order of the citations is kept, so the [docN] references of the answer stay valid:
+    a chunk whose text is part of an earlier chunk of the same document keeps its title, url and pages,
+    its content is replaced by "duplicate_of" (the number N of the earlier citation). A chunk that overlaps an earlier one
+    (the neighbour chunks N and N+1 share the text at their border) only keeps the text the earlier one does not have, "overlaps" is N.
+    If a store is given, the full texts are kept in the store and can be fetched by the "id" of the citation.
+
+    :param citations: List[dict], citations as parsed by get_json_serializable_response
+    :param snippet_length: int, max. number of characters of the content
+    :param store: EasyChatCitationStore, optional
+    :param scope: str, scope of the stored texts
+    :returns List[dict]
+    """
+    documents = { }
+    for i, citation in enumerate(citations):
+        if not isinstance(citation, dict):
+            continue
+        content = str(citation.get("content") or "")
+        if store is not None and content != "":
+            citation["id"] = store.add(scope, content)
+        document = _citation_document(citation)
+        head = 0
+        tail = 0
+        duplicateOf = None
+        overlaps = None
+        if document is not None and content != "":
+            for n, earlier in documents.get(document, [ ]):
+                if content in earlier:
+                    duplicateOf = n
+                    break
+                # this chunk continues the earlier one, or the earlier one continues this chunk
+                start = _chunk_overlap(earlier, content)
+                end = _chunk_overlap(content, earlier)
+                if start > 0 or end > 0:
+                    head = max(head, start)
+                    tail = max(tail, end)
+                    if overlaps is None:
+                        overlaps = n
+            documents.setdefault(document, [ ]).append((i + 1, content))
+        if duplicateOf is None and head + tail >= len(content) and content != "":
+            duplicateOf = overlaps
+        if duplicateOf is not None:
+            citation["duplicate_of"] = duplicateOf
+            citation["content"] = ""
+        else:
+            if overlaps is not None:
+                citation["overlaps"] = overlaps
+            citation["content"] = _trim_snippet(content[head:len(content) - tail].strip(), snippet_length)
+        citation["truncated"] = len(citation["content"]) < len(content)
+    return citations
+
+def answer_to_stream_records(answer : dict, words_per_record : int = 8) -> Generator[dict, None, None]:
+    """
+    Replays a (non-streamed) answer in the record format of EasyChatClient.streamedChat()
+
+    :param answer: dict, answer as returned by EasyChatClient.chat()
+    :param words_per_record: int, number of words sent per record
+    :returns Generator of dicts
+    """
+    def record(choices : list) -> dict:
+        return {
+            "choices": choices,
+            "created": answer.get("created"),
+            "id": answer.get("id"),
+            "model": answer.get("model"),
+            "object": "chat.completion.chunk",
+            "system_fingerprint": answer.get("system_fingerprint"),
+            "usage": { "prompt_tokens": None, "completion_tokens": None, "total_tokens": None }
+        }
+    # the first record carries the role and the context (citations), like the upstream stream does
+    yield record([
+        {
+            "finish_reason": None,
+            "index": c["index"],
+            "end_turn": None,
+            "delta": { "refusal": None, "role": "assistant", "content": "", "context": c["message"].get("context", {}) }
+        }
+        for c in answer["choices"]
+    ])
+    for c in answer["choices"]:
+        words = re.findall(r'\s*\S+\s*|\s+', str(c["message"]["content"] or ""))
+        for i in range(0, len(words), words_per_record):
+            yield record([{
+                "finish_reason": None,
+                "index": c["index"],
+                "end_turn": None,
+                "delta": { "refusal": None, "role": None, "content": "".join(words[i:i + words_per_record]) }
+            }])
+    yield record([
+        {
+            "finish_reason": c["finish_reason"],
+            "index": c["index"],
+            "end_turn": c["end_turn"],
+            "delta": { "refusal": None, "role": None, "content": None }
+        }
+        for c in answer["choices"]
+    ])
+
+
+class SqliteCitationBackend:
+    """
+    Full citation texts in a sqlite database, shared by the worker processes of a host
+    """
+    def __init__(self, path : str, max_entries : int = 5000, ttl : float = 3600):
+        self._path = str(path)
+        self._max_entries = int(max_entries)
+        self._ttl = float(ttl)
+        self._writes = 0
+        self._local = threading.local()
+        con = self._connection()
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("CREATE TABLE IF NOT EXISTS citations (key TEXT PRIMARY KEY, content TEXT, created REAL)")
+        con.execute("CREATE INDEX IF NOT EXISTS citations_created ON citations (created)")
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self._path, timeout = 5, isolation_level = None)
+        return self._local.connection
+
+    def setMany(self, items : List[Tuple[str, str]]):
+        now = time.time()
+        con = self._connection()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.executemany("INSERT OR REPLACE INTO citations (key, content, created) VALUES (?, ?, ?)", [ (k, c, now) for k, c in items ])
+            self._writes += len(items)
+            if self._writes >= 500:
+                # remove the expired texts and the oldest texts above max_entries now and then
+                self._writes = 0
+                if self._ttl > 0:
+                    con.execute("DELETE FROM citations WHERE created < ?", (now - self._ttl, ))
+                con.execute("DELETE FROM citations WHERE key IN (SELECT key FROM citations ORDER BY created DESC LIMIT -1 OFFSET ?)", (self._max_entries, ))
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def get(self, key : str) -> Union[None, str]:
+        row = self._connection().execute("SELECT content, created FROM citations WHERE key = ?", (key, )).fetchone()
+        if row is None or (self._ttl > 0 and row[1] < time.time() - self._ttl):
+            return None
+        return row[0]
+
+
+class RedisCitationBackend:
+    """
+    Full citation texts in redis, shared by all hosts (requires the redis package)
+    """
+    def __init__(self, url : str, ttl : float = 3600):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("The redis package is required for the redis citation store")
+        self._client = redis.Redis.from_url(url)
+        self._ttl = float(ttl)
+
+    def setMany(self, items : List[Tuple[str, str]]):
+        pipeline = self._client.pipeline(transaction = False)
+        for k, c in items:
+            pipeline.set("chatbot:citation:" + k, c, ex = int(self._ttl) if self._ttl > 0 else None)
+        pipeline.execute()
+
+    def get(self, key : str) -> Union[None, str]:
+        content = self._client.get("chatbot:citation:" + key)
+        return None if content is None else content.decode("utf-8")
+
+
+class EasyChatCitationStore:
+    """
+    Keeps the full texts of trimmed citations, so clients can fetch them when needed.
+    The texts are scoped (f.e. by the search filter of the role), a text can only be fetched within the scope it was stored in.
+    With a backend the texts are shared by the worker processes (a request for a text can reach any worker):
+    they are written to the backend in a background thread, so the answers never wait for it.
+    """
+    _cache : LRUCache
+    _backend : Union[None, SqliteCitationBackend, RedisCitationBackend] = None
+    _pending : queue.Queue
+    _writer : Union[None, threading.Thread] = None
+
+    def __init__(self, max_entries : int = 5000, ttl : float = 3600, backend : Union[None, SqliteCitationBackend, RedisCitationBackend] = None):
+        """
+        Create a new EasyChatCitationStore
+
+        :param max_entries: int, max. number of texts kept in memory
+        :param ttl: float, seconds a text is kept (0 means no expiry)
+        :param backend: SqliteCitationBackend or RedisCitationBackend, optional, shares the texts with the other worker processes
+        """
+        self._cache = LRUCache(max_entries, ttl)
+        self._backend = backend
+        self._pending = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _getId(self, scope : str, content : str) -> str:
+        return hashlib.sha256((str(scope) + "\0" + str(content)).encode("utf-8")).hexdigest()[:32]
+
+    def _getBackendKey(self, scope : str, citation_id : str) -> str:
+        return str(citation_id) + ":" + hashlib.sha256(str(scope).encode("utf-8")).hexdigest()[:32]
+
+    def add(self, scope : str, content : str) -> str:
+        """
+        Stores a text, returns its id
+        """
+        citationId = self._getId(scope, content)
+        key = (str(scope), citationId)
+        if self._cache.get(key) is None:
+            self._cache.set(key, str(content))
+            if self._backend is not None:
+                self._startWriter()
+                self._pending.put((self._getBackendKey(scope, citationId), str(content)))
+        return citationId
+
+    def get(self, scope : str, citation_id : str) -> Union[None, str]:
+        key = (str(scope), str(citation_id))
+        content = self._cache.get(key)
+        if content is None and self._backend is not None:
+            try:
+                content = self._backend.get(self._getBackendKey(scope, citation_id))
+            except Exception as e:
+                print("Citation store not available:", str(e))
+            if content is not None:
+                self._cache.set(key, content)
+        return content
+
+    def _startWriter(self):
+        if self._writer is not None:
+            return
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target = self._write, name = "chatbot-citation-store", daemon = True)
+                self._writer.start()
+
+    def _write(self):
+        while True:
+            items = [ self._pending.get() ]
+            while len(items) < 100:
+                try:
+                    items.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._backend.setMany(items)
+            except Exception as e:
+                print("Citation texts not stored:", str(e))
+            for _ in items:
+                self._pending.task_done()
+
+    def flush(self):
+        """
+        Waits until all texts are written to the backend
+        """
+        self._pending.join()
+
+    def clear(self):
+        self._cache.clear()
+
+
+_shared_citation_store = None
+_shared_citation_store_lock = threading.Lock()
+
+def get_shared_citation_store() -> EasyChatCitationStore:
+    """
+    Returns the citation store shared by all clients of the process (the sync and the async client use the same texts),
+    the texts are shared with the other worker processes through the backend (CHATBOT_CITATION_STORE_BACKEND)
+    """
+    global _shared_citation_store
+    if _shared_citation_store is None:
+        with _shared_citation_store_lock:
+            if _shared_citation_store is None:
+                size = int(os.getenv("CHATBOT_CITATION_STORE_SIZE", "5000"))
+                ttl = float(os.getenv("CHATBOT_CITATION_STORE_TTL", "3600"))
+                backendType = os.getenv("CHATBOT_CITATION_STORE_BACKEND", "sqlite").lower().strip()
+                backend = None
+                if backendType == "redis":
+                    if os.getenv("CHATBOT_CITATION_STORE_REDIS_URL", "") == "":
+                        raise ValueError("CHATBOT_CITATION_STORE_REDIS_URL is required for the redis citation store")
+                    backend = RedisCitationBackend(os.getenv("CHATBOT_CITATION_STORE_REDIS_URL"), ttl)
+                elif backendType != "memory":
+                    backend = SqliteCitationBackend(os.getenv("CHATBOT_CITATION_STORE_SQLITE_PATH", "/tmp/chatbot-citations.sqlite"), size, ttl)
+                _shared_citation_store = EasyChatCitationStore(size, ttl, backend)
+    return _shared_citation_store
+
+
+class EasyChatCompactStreamEncoder:
+    """
+    Converts the records of EasyChatClient.streamedChat() into the compact stream format (one JSON object per line):
+        {"meta": {"id": ..., "model": ..., "created": ...}}     once, at the start
+        {"context": {"citations": [...], "intent": ...}}        once, as soon as the data source returned the documents
+        {"d": "content"}                                        content deltas
+        {"end": {"finish_reason": ..., "end_turn": ...}}        once, at the end
+        {"usage": {...}}                                        if the upstream reported the token usage
+    Records of other choices than the first carry the index of the choice in "i".
+    """
+    _started : bool = False
+
+    def __init__(self):
+        self._started = False
+
+    def encode(self, data : dict) -> List[dict]:
+        records = [ ]
+        if not self._started:
+            self._started = True
+            records.append({ "meta": { "id": data.get("id"), "model": data.get("model"), "created": data.get("created") } })
+        for c in data.get("choices", [ ]):
+            delta = c.get("delta") or { }
+            choice = { } if c.get("index", 0) == 0 else { "i": c["index"] }
+            if delta.get("context") is not None:
+                records.append(dict(choice, context = delta["context"]))
+            if delta.get("content"):
+                records.append(dict(choice, d = delta["content"]))
+            if c.get("finish_reason") is not None:
+                records.append(dict(choice, end = { "finish_reason": c["finish_reason"], "end_turn": c.get("end_turn") }))
+        usage = data.get("usage")
+        if usage is not None and any(v is not None for v in usage.values()):
+            records.append({ "usage": usage })
+        return records
+
+
+class EasyChatStreamCollector:
+    """
+    Assembles the records of a streamed answer into the answer format of EasyChatClient.chat()
+    """
+    _answer : Union[None, dict] = None
+
+    def __init__(self):
+        self._answer = None
+
+    def add(self, data : dict):
+        if self._answer is None:
+            self._answer = {
+                "choices": [ ],
+                "created": data["created"],
+                "id": data["id"],
+                "model": data["model"],
+                "object": "chat.completion",
+                "system_fingerprint": data["system_fingerprint"],
+                "usage": data["usage"]
+            }
+        for c in data["choices"]:
+            while len(self._answer["choices"]) <= c["index"]:
+                self._answer["choices"].append({
+                    "finish_reason": None,
+                    "index": len(self._answer["choices"]),
+                    "end_turn": None,
+                    "message": { "refusal": None, "role": "assistant", "content": "" }
+                })
+            choice = self._answer["choices"][c["index"]]
+            if c["finish_reason"] is not None:
+                choice["finish_reason"] = c["finish_reason"]
+            if c["end_turn"] is not None:
+                choice["end_turn"] = c["end_turn"]
+            if c["delta"].get("content"):
+                choice["message"]["content"] += c["delta"]["content"]
+            if "context" in c["delta"]:
+                choice["message"]["context"] = c["delta"]["context"]
+
+    def getAnswer(self) -> Union[None, dict]:
+        return self._answer
+
+
+def build_retrieval_query(messages : List["EasyChatMessage"]) -> str:
+    """
+    Returns the search query for a conversation: the last question, for follow-up questions prefixed by the previous question
+    """
+    questions = [ m.content for m in messages if m.role == "user" and str(m.content).strip() != "" ]
+    return " ".join(str(q).strip() for q in questions[-2:])
+
+def _attach_retrieved_context(completion : Union[ChatCompletion, ChatCompletionChunk], retrieved : dict):
+    # the same place the azure_search data source puts its context, so the response is parsed the same way
+    for choice in completion.choices:
+        if isinstance(completion, ChatCompletionChunk):
+            choice.delta.context = copy.deepcopy(retrieved)
+        else:
+            choice.message.context = copy.deepcopy(retrieved)
+
+
+class _RetrievedContextStream:
+    """
+    Adds the context of the retrieved documents to the first chunk of a stream that has choices
+    """
+    def __init__(self, stream, retrieved : dict):
+        self._stream = stream
+        self._retrieved = retrieved
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        msg = next(self._stream)
+        if self._retrieved is not None and len(msg.choices) > 0:
+            _attach_retrieved_context(msg, self._retrieved)
+            self._retrieved = None
+        return msg
+
+    def close(self):
+        self._stream.close()
+
+
+class _AsyncRetrievedContextStream:
+    """
+    asyncio variant of _RetrievedContextStream
+    """
+    def __init__(self, stream, retrieved : dict):
+        self._stream = stream
+        self._retrieved = retrieved
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self._stream.__anext__()
+        if self._retrieved is not None and len(msg.choices) > 0:
+            _attach_retrieved_context(msg, self._retrieved)
+            self._retrieved = None
+        return msg
+
+    async def close(self):
+        await self._stream.close()
+
+
+def _count_streamed_tokens(completion : ChatCompletionChunk) -> int:
+    # every streamed chunk with content carries (roughly) one token
+    for choice in completion.choices:
+        if choice.delta is not None and choice.delta.content:
+            return 1
+    return 0
+
+def _record_stream_end(tokens : int, aborted : bool):
+    completed = get_counter("chat_streams_completed_total", "Number of answer streams that were fully sent")
+    completedTokens = get_counter("chat_streams_completed_tokens_total", "Number of tokens sent by fully sent answer streams")
+    if not aborted:
+        completed.inc()
+        completedTokens.inc(tokens)
+        return
+    get_counter("chat_streams_aborted_total", "Number of answer streams cancelled because the client disconnected").inc()
+    # estimate the saved tokens with the average answer length of the completed streams
+    if completed.get() > 0:
+        saved = completedTokens.get() / completed.get() - tokens
+        if saved > 0:
+            get_counter("chat_streams_aborted_tokens_saved_total", "Estimated number of completion tokens saved by cancelled answer streams").inc(saved)
+
+
+def _record_generation_timings(timings : RequestTimings, first_token_at : Union[None, float], tokens : int):
+    if first_token_at is None:
+        return
+    generation = time.perf_counter() - first_token_at
+    timings.add("generation", generation)
+    if generation > 0 and tokens > 1:
+        timings.setTokensPerSecond((tokens - 1) / generation)
+
+
+class EasyChatRequestContext:
+    """
+    Immutable per-request settings for EasyChatClient.chat() and EasyChatClient.streamedChat().
+    A context is passed along with every call, so one client instance can serve concurrent requests.
+    """
+    __slots__ = ("_filter", "_temperature", "_top_n", "_system_message", "_timings")
+
+    def __init__(self, filter : str = "", temperature : float = 0.1, top_n : int = 5, system_message : str = "", timings : Union[None, RequestTimings] = None):
+        if temperature < 0 or temperature > 2:
+            raise ValueError("Temperature must be between 0 and 2")
+        if int(top_n) < 1:
+            raise ValueError("top_n must be greater than 0")
+        object.__setattr__(self, "_filter", str(filter))
+        object.__setattr__(self, "_temperature", float(temperature))
+        object.__setattr__(self, "_top_n", int(top_n))
+        object.__setattr__(self, "_system_message", str(system_message))
+        # the timings of the request are collected in the (mutable) timings object
+        object.__setattr__(self, "_timings", RequestTimings() if timings is None else timings)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EasyChatRequestContext is immutable")
+
+    def getFilter(self) -> str:
+        return self._filter
+    def getTemperature(self) -> float:
+        return self._temperature
+    def getTopN(self) -> int:
+        return self._top_n
+    def getSystemMessage(self) -> str:
+        return self._system_message
+    def getTimings(self) -> RequestTimings:
+        return self._timings
+
+
+class _RequestTemplate:
+    # the parts of a chat request that only depend on the request settings, shared (read-only) by all requests with the same settings
+    __slots__ = ("system", "extra_body", "scope")
+
+    def __init__(self, system : dict, extra_body : dict, scope : str):
+        self.system = system
+        self.extra_body = extra_body
+        self.scope = scope
+
+
 class EasyChatMessage:
     role: str
     content: str
@@ -118,7 +707,570 @@ class EasyChatMessage:
         self.content = content
 
 
+_token_encoding = None
+
+def count_tokens(text : str) -> int:
+    """
+    Counts the tokens of a text with the tokenizer of gpt-4o (o200k_base).
+    Without tiktoken (or if the encoding cannot be loaded) the count is estimated with 4 characters per token.
+    """
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = False
+        if tiktoken is not None:
+            try:
+                _token_encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                pass
+    if _token_encoding is False:
+        return (len(str(text)) + 3) // 4
+    return len(_token_encoding.encode(str(text), disallowed_special = ()))
+
+
+class EasyChatHistoryTrimmer:
+    """
+    Keeps the conversation history within a token budget.
+    The oldest turns are dropped (or replaced by a summary) until the history fits, the last message is always kept.
+    Summaries are cached by the conversation prefix they cover, so a growing conversation only summarizes the newly dropped turns.
+    """
+    _token_budget : int
+    _summarize : bool = False
+    _summary_tokens : int = 300
+    _summaries : LRUCache
+
+    def __init__(self, token_budget : int = 4000, summarize : bool = False, summary_tokens : int = 300, max_summaries : int = 1000):
+        """
+        Create a new EasyChatHistoryTrimmer
+
+        :param token_budget: int, max. number of tokens of the history (including the summary)
+        :param summarize: bool, summarize the dropped turns
+        :param summary_tokens: int, max. number of tokens of a summary (reserved from the budget)
+        :param max_summaries: int, max. number of cached summaries
+        :raises ValueError: if the budget does not leave room for the summary
+        """
+        if int(token_budget) < 1:
+            raise ValueError("token_budget must be greater than 0")
+        if summarize and int(summary_tokens) >= int(token_budget):
+            raise ValueError("summary_tokens must be less than token_budget")
+        self._token_budget = int(token_budget)
+        self._summarize = bool(summarize)
+        self._summary_tokens = int(summary_tokens)
+        self._summaries = LRUCache(max_summaries)
+
+    def getTokenBudget(self) -> int:
+        return self._token_budget
+    def getSummarize(self) -> bool:
+        return self._summarize
+    def getSummaryTokens(self) -> int:
+        return self._summary_tokens
+
+    @staticmethod
+    def countMessageTokens(message : EasyChatMessage) -> int:
+        # every message has an overhead of a few tokens for the role and separators
+        return count_tokens(message.content) + 4
+
+    def split(self, messages : List[EasyChatMessage]) -> Tuple[List[EasyChatMessage], List[EasyChatMessage]]:
+        """
+        Splits the history into the oldest messages that exceed the budget and the newest messages that fit
+
+        :param messages: List[EasyChatMessage]
+        :returns (dropped, kept)
+        """
+        budget = self._token_budget - (self._summary_tokens if self._summarize else 0)
+        used = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            used += self.countMessageTokens(messages[i])
+            if used > budget and i < len(messages) - 1:
+                break
+            start = i
+        # the kept history should not start with an answer to a dropped question
+        while start < len(messages) - 1 and messages[start].role == "assistant":
+            start += 1
+        return messages[:start], messages[start:]
+
+    @staticmethod
+    def _prefixKeys(messages : List[EasyChatMessage]) -> List[str]:
+        # keys[i] identifies messages[:i + 1]
+        keys = [ ]
+        h = hashlib.sha256()
+        for m in messages:
+            h.update(json.dumps([ m.role, m.content ]).encode("utf-8"))
+            keys.append(h.hexdigest())
+        return keys
+
+    def getSummary(self, dropped : List[EasyChatMessage]) -> Tuple[Union[None, str], int]:
+        """
+        Returns the cached summary of the longest prefix of the dropped messages
+
+        :param dropped: List[EasyChatMessage]
+        :returns (summary or None, number of messages covered by the summary)
+        """
+        keys = self._prefixKeys(dropped)
+        for i in range(len(keys) - 1, -1, -1):
+            summary = self._summaries.get(keys[i])
+            if summary is not None:
+                return summary, i + 1
+        return None, 0
+
+    def setSummary(self, dropped : List[EasyChatMessage], summary : str):
+        if len(dropped) > 0:
+            self._summaries.set(self._prefixKeys(dropped)[-1], str(summary))
+
+    def buildSummaryMessages(self, previous_summary : Union[None, str], messages : List[EasyChatMessage]) -> List[dict]:
+        """
+        Builds the messages of the completion that summarizes the given messages (continuing the previous summary)
+        """
+        transcript = ""
+        if previous_summary is not None:
+            transcript += "Summary of the earlier conversation:\n" + previous_summary + "\n\n"
+        transcript += "\n".join(m.role + ": " + str(m.content) for m in messages)
+        return [
+            {
+                "role": "system",
+                "content": "Summarize the following conversation between a user and an assistant in a few sentences. " +
+                    "Keep names, facts, numbers and document references that later questions may refer to."
+            },
+            {
+                "role": "user",
+                "content": transcript
+            }
+        ]
+
+    def compose(self, summary : Union[None, str], kept : List[EasyChatMessage]) -> List[EasyChatMessage]:
+        if summary is None or summary == "":
+            return kept
+        return [ EasyChatMessage("system", "Summary of the earlier conversation:\n" + summary) ] + kept
+
+
+class EasyChatEmbeddingStore:
+    """
+    Append-only store of embeddings on disk, shared by all worker processes:
+    the vectors are float32 rows in vectors.f32, keys.txt maps every key to the offset and the dimensions of its row.
+    Appends are serialized with a file lock, every process picks up the keys the others appended.
+    """
+    _path : str
+    _entries : dict
+    _keys_offset : int = 0
+    _lock : threading.Lock
+
+    def __init__(self, path : str):
+        """
+        Create a new EasyChatEmbeddingStore
+
+        :param path: str, directory of the store (created if missing)
+        """
+        os.makedirs(path, exist_ok = True)
+        self._path = str(path)
+        self._vectors_path = os.path.join(self._path, "vectors.f32")
+        self._keys_path = os.path.join(self._path, "keys.txt")
+        self._entries = { }
+        self._keys_offset = 0
+        self._lock = threading.Lock()
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        # reads the keys appended since the last sync (only complete lines)
+        if not os.path.exists(self._keys_path):
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("ascii").splitlines():
+            parts = line.split(" ")
+            if len(parts) == 3:
+                self._entries[parts[0]] = (int(parts[1]), int(parts[2]))
+        self._keys_offset += end
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key : str) -> Union[None, np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._sync()
+                entry = self._entries.get(key)
+        if entry is None:
+            return None
+        vector = np.fromfile(self._vectors_path, dtype = np.float32, count = entry[1], offset = entry[0] * 4)
+        return vector if len(vector) == entry[1] else None
+
+    def add(self, key : str, vector : np.ndarray):
+        vector = np.ascontiguousarray(vector, dtype = np.float32)
+        with self._lock:
+            with open(self._keys_path, "ab") as keys:
+                if fcntl is not None:
+                    fcntl.flock(keys, fcntl.LOCK_EX)
+                try:
+                    self._sync()
+                    if key in self._entries:
+                        return
+                    with open(self._vectors_path, "ab") as vectors:
+                        # rows are aligned to float32, a partially written row of a crashed process is skipped
+                        size = vectors.seek(0, os.SEEK_END)
+                        vectors.write(b"\0" * (-size % 4))
+                        offset = (size + (-size % 4)) // 4
+                        vectors.write(vector.tobytes())
+                    # the key is written after the vector, so readers never see a key without its vector
+                    keys.write((key + " " + str(offset) + " " + str(len(vector)) + "\n").encode("ascii"))
+                    keys.flush()
+                    self._entries[key] = (offset, len(vector))
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(keys, fcntl.LOCK_UN)
+
+
+class _EmbeddingRequest:
+    def __init__(self, text : str):
+        self.text = text
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EasyChatEmbeddingService:
+    """
+    Embeddings of queries: memoized in an LRU (and optionally in an EasyChatEmbeddingStore on disk),
+    concurrent requests (of many users) within a small time window are sent as one embedding call.
+    The first caller of a batch waits for the window, collects the pending texts and calls the api,
+    the other callers wait for their result. Identical texts in a batch are embedded once.
+    """
+    _deployment_name : str
+    _cache : LRUCache
+    _store : Union[None, EasyChatEmbeddingStore] = None
+    _batch_window : float = 0.01
+    _max_batch_size : int = 16
+
+    def __init__(
+        self,
+        client : Union[AzureOpenAI, AsyncAzureOpenAI],
+        deployment_name : str,
+        cache_size : int = 10000,
+        store : Union[None, EasyChatEmbeddingStore] = None,
+        batch_window : float = 0.01,
+        max_batch_size : int = 16
+    ):
+        """
+        Create a new EasyChatEmbeddingService
+
+        :param client: AzureOpenAI (AsyncAzureOpenAI for AsyncEasyChatEmbeddingService)
+        :param deployment_name: str, the embedding deployment
+        :param cache_size: int, max. number of embeddings kept in memory
+        :param store: EasyChatEmbeddingStore, optional, keeps the embeddings on disk
+        :param batch_window: float, seconds to wait for more texts before the embedding call (0 sends every text on its own)
+        :param max_batch_size: int, max. number of texts per embedding call
+        """
+        if int(max_batch_size) < 1:
+            raise ValueError("max_batch_size must be greater than 0")
+        self._client = client
+        self._deployment_name = str(deployment_name)
+        self._cache = LRUCache(cache_size)
+        self._store = store
+        self._batch_window = max(0, float(batch_window))
+        self._max_batch_size = int(max_batch_size)
+        self._pending = { }
+        self._leading = False
+        self._lock = threading.Lock()
+        self._hits = get_counter("chat_embedding_cache_hits_total", "Number of query embeddings served from the memory or disk cache")
+        self._misses = get_counter("chat_embedding_cache_misses_total", "Number of query embeddings requested from the embedding deployment")
+        self._batches = get_counter("chat_embedding_batches_total", "Number of embedding api calls")
+
+    def getDeploymentName(self) -> str:
+        return self._deployment_name
+    def getStore(self) -> Union[None, EasyChatEmbeddingStore]:
+        return self._store
+
+    def _getKey(self, text : str) -> str:
+        return hashlib.sha256((self._deployment_name + "\0" + str(text)).encode("utf-8")).hexdigest()
+
+    def _lookup(self, key : str) -> Union[None, np.ndarray]:
+        vector = self._cache.get(key)
+        if vector is None and self._store is not None:
+            vector = self._store.get(key)
+            if vector is not None:
+                vector.setflags(write = False)
+                self._cache.set(key, vector)
+        return vector
+
+    def _remember(self, text : str, embedding : list, persist : bool = True) -> np.ndarray:
+        key = self._getKey(text)
+        vector = np.asarray(embedding, dtype = np.float32)
+        vector.setflags(write = False)
+        self._cache.set(key, vector)
+        if persist:
+            self._persist({ key: vector })
+        return vector
+
+    def _persist(self, vectors : dict):
+        # key -> vector, written to the store (file i/o and lock)
+        if self._store is None:
+            return
+        for key, vector in vectors.items():
+            try:
+                self._store.add(key, vector)
+            except OSError:
+                # the memory cache is enough to answer, the store is only a second level
+                pass
+
+    def _takeBatch(self) -> list:
+        texts = list(self._pending.keys())[:self._max_batch_size]
+        return [ self._pending.pop(t) for t in texts ]
+
+    def _embedBatch(self, batch : List[_EmbeddingRequest]):
+        self._batches.inc()
+        try:
+            response = self._client.embeddings.create(model = self._deployment_name, input = [ r.text for r in batch ])
+            for d in response.data:
+                batch[d.index].result = self._remember(batch[d.index].text, d.embedding)
+        except Exception as e:
+            for r in batch:
+                r.error = e
+        for r in batch:
+            if r.result is None and r.error is None:
+                r.error = ValueError("No embedding returned")
+            r.event.set()
+
+    def embed(self, text : str) -> np.ndarray:
+        """
+        Returns the embedding of a text (read-only float32 array)
+
+        :raises the error of the embedding call
+        """
+        vector = self._lookup(self._getKey(text))
+        if vector is not None:
+            self._hits.inc()
+            return vector
+        self._misses.inc()
+        with self._lock:
+            request = self._pending.get(text)
+            if request is None:
+                request = _EmbeddingRequest(text)
+                self._pending[text] = request
+        while not request.event.is_set():
+            with self._lock:
+                lead = not self._leading and len(self._pending) > 0
+                if lead:
+                    self._leading = True
+            if not lead:
+                request.event.wait(max(self._batch_window, 0.005))
+                continue
+            # this caller collects the batch, the next batch can be collected while this one is embedded
+            if self._batch_window > 0:
+                time.sleep(self._batch_window)
+            with self._lock:
+                batch = self._takeBatch()
+                self._leading = False
+            if len(batch) > 0:
+                self._embedBatch(batch)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def embedMany(self, texts : List[str]) -> List[np.ndarray]:
+        """
+        Returns the embeddings of many texts (f.e. the chunks of a local index), sent in calls of max_batch_size texts.
+        The embeddings are not cached, the cache is meant for queries.
+        """
+        results = [ ]
+        for start in range(0, len(texts), self._max_batch_size):
+            batch = [ str(t) for t in texts[start:start + self._max_batch_size] ]
+            self._batches.inc()
+            response = self._client.embeddings.create(model = self._deployment_name, input = batch)
+            embeddings = sorted(response.data, key = lambda d: d.index)
+            results += [ np.asarray(d.embedding, dtype = np.float32) for d in embeddings ]
+        return results
+
+
+class AsyncEasyChatEmbeddingService(EasyChatEmbeddingService):
+    """
+    asyncio variant of EasyChatEmbeddingService (for use within one event loop),
+    the store is read and written in a worker thread
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the event loop only keeps weak references to the tasks, a collected batch would never resolve its futures
+        self._tasks = set()
+
+    def _startTask(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embedBatchAsync(self, batch : dict):
+        self._batches.inc()
+        texts = list(batch.keys())
+        try:
+            response = await self._client.embeddings.create(model = self._deployment_name, input = texts)
+            results = { texts[d.index]: self._remember(texts[d.index], d.embedding, persist = False) for d in response.data }
+            for text, future in batch.items():
+                if not future.done():
+                    if text in results:
+                        future.set_result(results[text])
+                    else:
+                        future.set_exception(ValueError("No embedding returned"))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if self._store is not None:
+            # after the callers got their embeddings
+            await asyncio.to_thread(self._persist, { self._getKey(text): vector for text, vector in results.items() })
+
+    async def _flush(self):
+        if self._batch_window > 0:
+            await asyncio.sleep(self._batch_window)
+        self._leading = False
+        while len(self._pending) > 0:
+            texts = list(self._pending.keys())[:self._max_batch_size]
+            batch = { t: self._pending.pop(t) for t in texts }
+            self._startTask(self._embedBatchAsync(batch))
+
+    async def embedMany(self, texts : List[str]) -> List[np.ndarray]:
+        results = [ ]
+        for start in range(0, len(texts), self._max_batch_size):
+            batch = [ str(t) for t in texts[start:start + self._max_batch_size] ]
+            self._batches.inc()
+            response = await self._client.embeddings.create(model = self._deployment_name, input = batch)
+            embeddings = sorted(response.data, key = lambda d: d.index)
+            results += [ np.asarray(d.embedding, dtype = np.float32) for d in embeddings ]
+        return results
+
+    async def embed(self, text : str) -> np.ndarray:
+        key = self._getKey(text)
+        vector = self._cache.get(key)
+        if vector is None and self._store is not None:
+            vector = await asyncio.to_thread(self._lookup, key)
+        if vector is not None:
+            self._hits.inc()
+            return vector
+        self._misses.inc()
+        future = self._pending.get(text)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[text] = future
+            if not self._leading:
+                self._leading = True
+                self._startTask(self._flush())
+        # a cancelled caller does not cancel the embedding of the other callers
+        return await asyncio.shield(future)
+
+
+class EasyChatAnswerCache:
+    """
+    Cache of answers, scoped by the effective request settings (search filter, system message, ...),
+    so users with different roles never see each other's answers.
+    Lookups are done by the exact conversation and, for single questions, by the similarity of the question embedding.
+    All answers are dropped when the index version changes.
+    """
+    _cache : LRUCache
+    _similarity_threshold : float = 0.97
+    _index_version : str = ""
+
+    def __init__(self, max_entries : int = 1000, ttl : float = 3600, similarity_threshold : float = 0.97):
+        """
+        Create a new EasyChatAnswerCache
+
+        :param max_entries: int, max. number of answers (least recently used answers are evicted first)
+        :param ttl: float, seconds an answer is cached
+        :param similarity_threshold: float, min. cosine similarity of two questions to share an answer (0 disables the similarity lookup)
+        """
+        self._cache = LRUCache(max_entries, ttl)
+        self._similarity_threshold = float(similarity_threshold)
+        self._index_version = ""
+        self._hits = get_counter("answer_cache_hits_total", "Number of answers served from the answer cache")
+        self._misses = get_counter("answer_cache_misses_total", "Number of answer cache misses")
+
+    @staticmethod
+    def _normalize(text : str) -> str:
+        return re.sub(r'\s+', ' ', str(text)).strip().lower().rstrip("?!. ")
+
+    def _key(self, scope : str, messages : List[EasyChatMessage]) -> str:
+        return hashlib.sha256(json.dumps([ scope, [ [ m.role, self._normalize(m.content) ] for m in messages ] ]).encode("utf-8")).hexdigest()
+
+    def getSimilarityThreshold(self) -> float:
+        return self._similarity_threshold
+
+    def getIndexVersion(self) -> str:
+        return self._index_version
+
+    def setIndexVersion(self, version : str):
+        """
+        Sets the version of the search index, all answers are invalidated if the version changes
+        """
+        if str(version) != self._index_version:
+            self._index_version = str(version)
+            self.invalidate()
+
+    def invalidate(self):
+        self._cache.clear()
+
+    def getExact(self, scope : str, messages : List[EasyChatMessage]) -> Union[None, dict]:
+        """
+        Returns a copy of the answer cached for exactly this conversation or None (a miss is not counted, see get())
+        """
+        entry = self._cache.get(self._key(scope, messages))
+        if entry is None:
+            return None
+        self._hits.inc()
+        return copy.deepcopy(entry["answer"])
+
+    def get(self, scope : str, messages : List[EasyChatMessage], embedding : Union[None, list] = None) -> Union[None, dict]:
+        """
+        Returns a copy of the cached answer or None
+
+        :param scope: str, the request settings the answer is valid for
+        :param messages: List[EasyChatMessage], the conversation
+        :param embedding: list, optional, embedding of the question (enables the similarity lookup)
+        :returns dict or None
+        """
+        entry = self._cache.get(self._key(scope, messages))
+        if entry is None and embedding is not None and self._similarity_threshold > 0:
+            candidates = [ e for _, e in self._cache.items() if e["scope"] == scope and e["embedding"] is not None ]
+            if len(candidates) > 0:
+                similarities = np.stack([ e["embedding"] for e in candidates ]) @ self._toUnitVector(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self._similarity_threshold:
+                    entry = candidates[best]
+        if entry is None:
+            self._misses.inc()
+            return None
+        self._hits.inc()
+        return copy.deepcopy(entry["answer"])
+
+    def set(self, scope : str, messages : List[EasyChatMessage], answer : dict, embedding : Union[None, list] = None):
+        """
+        Caches an answer (incomplete answers, f.e. cut off by the token limit, are not cached)
+        """
+        if len(answer.get("choices", [])) == 0 or any(c.get("finish_reason") != "stop" for c in answer["choices"]):
+            return
+        self._cache.set(self._key(scope, messages), {
+            "scope": scope,
+            "answer": copy.deepcopy(answer),
+            "embedding": None if embedding is None else self._toUnitVector(embedding)
+        })
+
+    @staticmethod
+    def _toUnitVector(embedding : list) -> np.ndarray:
+        v = np.asarray(embedding, dtype = np.float32)
+        n = np.linalg.norm(v)
+        return v if n == 0 else v / n
+
+    def getStats(self) -> dict:
+        return {
+            "answers": len(self._cache),
+            "index_version": self._index_version,
+            "hits": self._hits.get(),
+            "misses": self._misses.get()
+        }
+
+
 class EasyChatClient:
+    _open_ai_client_class = AzureOpenAI
     _open_ai_client: AzureOpenAI
     _open_ai_deployment_name: str
     _open_ai_embedding_deployment_name: str
@@ -131,7 +1283,17 @@ class EasyChatClient:
     _system_few_shot_examples : List[str] = [ ]
     _final_system_message : str = "You are an helpful assistant that helps finding information from documents."
     _temperature : float = 0.1
-    
+    _top_n : int = 5
+    _system_message_variants : dict
+    _answer_cache : Union[None, EasyChatAnswerCache] = None
+    _answer_cache_index_check_interval : float = 300
+    _answer_cache_index_checked_at : float = 0
+    _single_flight_class = SingleFlight
+    _embedding_service_class = EasyChatEmbeddingService
+    _single_flight : Union[None, SingleFlight] = None
+    _history_trimmer : Union[None, EasyChatHistoryTrimmer] = None
+    _backend_pool : Union[None, OpenAIBackendPool] = None
+
     def __init__(
         self,
         open_ai_client : Union[AzureOpenAI, None] = None,
@@ -145,7 +1307,7 @@ class EasyChatClient:
         """
         Create a new EasyChatClient
 
-        :param open_ai_client: AzureOpenAI, optional, if not set, will use default credential
+        :param open_ai_client: AzureOpenAI, optional, if not set, OPENAI_BACKENDS or OPENAI_API_BASE is used
         :param open_ai_deployment_name: str, optional, default is 'gpt-4o'
         :param open_ai_embedding_deployment_name: str, optional, default is 'text-embedding-ada-002'
         :param azure_search_api_base: str, required
@@ -155,22 +1317,29 @@ class EasyChatClient:
         :raises ValueError: if azure_search_api_base or open_ai_client is not set
         """
 
-        if isinstance(open_ai_client, AzureOpenAI):
+        self._backend_pool = None
+        if isinstance(open_ai_client, self._open_ai_client_class):
             self._open_ai_client = open_ai_client
+        elif os.getenv("OPENAI_BACKENDS", "").strip() != "":
+            self._backend_pool = create_backend_pool_from_env(self._open_ai_client_class)
+            # embeddings and summaries are sent to the first backend
+            self._open_ai_client = self._backend_pool.getBackends()[0].getClient()
         else:
             if os.getenv("OPENAI_API_BASE") is None or os.getenv("OPENAI_API_BASE") == "":
                 raise ValueError("OPENAI_API_BASE is required")
             if os.getenv("OPENAI_API_KEY") is None:
-                self._open_ai_client = AzureOpenAI(
+                self._open_ai_client = self._open_ai_client_class(
                     azure_endpoint = os.getenv("OPENAI_API_BASE"),
-                    azure_ad_token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"),
-                    api_version = "2024-02-01"
+                    azure_ad_token_provider = get_bearer_token_provider(get_default_credential(), "https://cognitiveservices.azure.com/.default"),
+                    api_version = "2024-02-01",
+                    http_client = get_shared_openai_http_client(issubclass(self._open_ai_client_class, AsyncAzureOpenAI))
                 )
             else:
-                self._open_ai_client = AzureOpenAI(
+                self._open_ai_client = self._open_ai_client_class(
                     azure_endpoint = os.getenv("OPENAI_API_BASE"),
                     api_key = os.getenv("OPENAI_API_KEY"),
-                    api_version = "2024-02-01"
+                    api_version = "2024-02-01",
+                    http_client = get_shared_openai_http_client(issubclass(self._open_ai_client_class, AsyncAzureOpenAI))
                 )
         
         # api_key: if none, try to get from env
@@ -184,9 +1353,11 @@ class EasyChatClient:
         # api_base: if none, try to get from env
         if azure_search_api_base is None:
             azure_search_api_base = os.getenv("AZURESEARCH_API_BASE")
-        # api_base is required
+        # api_base is required (unless the documents are retrieved from a local index)
         if azure_search_api_base is None or azure_search_api_base == "":
-            raise ValueError("AZURESEARCH_API_BASE is required")
+            if not self._useLocalIndex():
+                raise ValueError("AZURESEARCH_API_BASE is required")
+            azure_search_api_base = ""
         self._azure_search_api_base = str(azure_search_api_base)
 
         # index_name: if none, try to get from env
@@ -218,6 +1389,68 @@ class EasyChatClient:
             semantic_configuration = f"{self._azure_search_index_name}-semantic-configuration"
         self._semantic_configuration = str(semantic_configuration)
 
+        self._system_message_variants = { }
+        # request templates per search filter, number of documents, temperature and system message (see _getRequestTemplate)
+        self._request_templates = LRUCache(256)
+
+        # query embeddings are memoized (optionally on disk) and batched
+        embeddingStore = None
+        if os.getenv("CHATBOT_EMBEDDING_STORE_PATH", "") != "":
+            embeddingStore = EasyChatEmbeddingStore(os.getenv("CHATBOT_EMBEDDING_STORE_PATH"))
+        self._embedding_service = self._embedding_service_class(
+            self._open_ai_client,
+            self._open_ai_embedding_deployment_name,
+            int(os.getenv("CHATBOT_EMBEDDING_CACHE_SIZE", "10000")),
+            embeddingStore,
+            float(os.getenv("CHATBOT_EMBEDDING_BATCH_WINDOW", "0.01")),
+            int(os.getenv("CHATBOT_EMBEDDING_MAX_BATCH_SIZE", "16"))
+        )
+        # answer cache is optional
+        self._answer_cache = None
+        self._answer_cache_index_checked_at = 0
+        self._answer_cache_index_check_interval = float(os.getenv("CHATBOT_ANSWER_CACHE_INDEX_CHECK_INTERVAL", "300"))
+        # coalescing of identical concurrent requests is optional
+        self._single_flight = None
+        if str(os.getenv("CHATBOT_COALESCE_REQUESTS", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+            self._single_flight = self._single_flight_class()
+        if str(os.getenv("CHATBOT_ANSWER_CACHE", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+            self._answer_cache = EasyChatAnswerCache(
+                int(os.getenv("CHATBOT_ANSWER_CACHE_SIZE", "1000")),
+                float(os.getenv("CHATBOT_ANSWER_CACHE_TTL", "3600")),
+                float(os.getenv("CHATBOT_ANSWER_CACHE_SIMILARITY", "0.97"))
+            )
+        # citation snippets are optional
+        self._citation_snippet_length = int(os.getenv("CHATBOT_CITATION_SNIPPET_LENGTH", "0"))
+        self._citation_store = get_shared_citation_store() if self._citation_snippet_length > 0 else None
+        # direct retrieval (instead of the azure_search data source) is optional
+        self._retriever = None
+        if self._useLocalIndex():
+            self._retriever = LocalIndexRetriever(os.getenv("CHATBOT_LOCAL_INDEX_PATH", ""), int(os.getenv("CHATBOT_LOCAL_INDEX_NPROBE", "8")))
+        elif str(os.getenv("CHATBOT_RETRIEVAL", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+            self._retriever = AzureSearchRetriever(
+                self._azure_search_api_base,
+                self._azure_search_index_name,
+                self._azure_search_api_key,
+                self._semantic_configuration,
+                int(os.getenv("CHATBOT_RETRIEVAL_CACHE_SIZE", "1000")),
+                float(os.getenv("CHATBOT_RETRIEVAL_CACHE_TTL", "600")),
+                float(os.getenv("CHATBOT_RETRIEVAL_INDEX_CHECK_INTERVAL", "300"))
+            )
+        # history budget is optional
+        self._history_trimmer = None
+        if int(os.getenv("CHATBOT_HISTORY_TOKEN_BUDGET", "0")) > 0:
+            self._history_trimmer = EasyChatHistoryTrimmer(
+                int(os.getenv("CHATBOT_HISTORY_TOKEN_BUDGET", "0")),
+                str(os.getenv("CHATBOT_HISTORY_SUMMARIZE", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ],
+                int(os.getenv("CHATBOT_HISTORY_SUMMARY_TOKENS", "300"))
+            )
+
+
+    @staticmethod
+    def _useLocalIndex() -> bool:
+        if str(os.getenv("CHATBOT_RETRIEVAL", "false")).lower() not in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+            return False
+        return str(os.getenv("CHATBOT_RETRIEVAL_BACKEND", "azure")).lower() == "local"
 
     def setTemperature(self, temperature : float):
         if temperature < 0 or temperature > 2:
@@ -227,17 +1460,16 @@ class EasyChatClient:
     def getTemperature(self) -> float:
         return self._temperature
 
+    def setTopN(self, top_n : int):
+        if int(top_n) < 1:
+            raise ValueError("top_n must be greater than 0")
+        self._top_n = int(top_n)
+
+    def getTopN(self) -> int:
+        return self._top_n
+
     def setSearchFilterFromRole(self, role : ChatbotRole, storage_base_url : str = ""):
-        f = ""
-        if not (role.getFilter() is None):
-            f = str(role.getFilter())
-        if not (role.getBlobPathStartsWith() is None):
-            if f != "":
-                f += " and "
-            metadataPath = storage_base_url + "/" +  quote(str(role.getBlobPathStartsWith()).lstrip("/")) + "*"
-            metadataPath = metadataPath.replace("/", "\\/").replace(":", "\\:")
-            f += "search.ismatch('\"" + metadataPath + "\"', 'metadata_storage_path')" 
-        self._filter = f
+        self._filter = role.getSearchFilter(storage_base_url)
 
     def setSearchFilter(self, filter : str):
         self._filter = str(filter)
@@ -259,14 +1491,301 @@ class EasyChatClient:
         self._updateFinalSystemMessage()
     def getSystemMessage(self) -> str:
         return self._system_message
+    def setSystemPrompts(self, message : str, examples : List[str]):
+        """
+        Sets the system message and the few-shot examples at once, the final system message is built first and swapped in with one assignment
+        (concurrent requests get either the old or the new prompts, see config.py)
+        """
+        final = str(message)
+        if len(examples) > 0:
+            final += "\n\nFew-shot examples:\n" + "\n".join(examples)
+        self._system_message = str(message)
+        self._system_few_shot_examples = list(examples)
+        self._final_system_message = final
+    def setSystemMessageVariant(self, name : str, message : str):
+        """
+        Registers a named system message variant (the few-shot examples are appended like for the default system message)
+        """
+        self._system_message_variants[str(name)] = str(message)
+    def getSystemMessageVariants(self) -> List[str]:
+        return list(self._system_message_variants.keys())
+    def _getFinalSystemMessage(self, variant : Union[None, str] = None) -> str:
+        if variant is None:
+            return self._final_system_message
+        if variant not in self._system_message_variants:
+            raise ValueError("Unknown system message variant: " + str(variant))
+        m = self._system_message_variants[variant]
+        if len(self._system_few_shot_examples) > 0:
+            m += "\n\nFew-shot examples:\n" + "\n".join(self._system_few_shot_examples)
+        return m
+
+    def createRequestContext(
+        self,
+        role : Union[None, ChatbotRole] = None,
+        storage_base_url : str = "",
+        filter : Union[None, str] = None,
+        temperature : Union[None, float] = None,
+        top_n : Union[None, int] = None,
+        system_message_variant : Union[None, str] = None,
+        timings : Union[None, RequestTimings] = None
+    ) -> EasyChatRequestContext:
+        """
+        Creates an immutable request context, missing values are taken from the client defaults
+
+        :param role: ChatbotRole, optional, the search filter is built from the role
+        :param storage_base_url: str, base url of the storage container (used for blobPathStartsWith of the role)
+        :param filter: str, optional, explicit search filter (overrides the role)
+        :param temperature: float, optional
+        :param top_n: int, optional, number of documents to retrieve
+        :param system_message_variant: str, optional, name of a variant registered with setSystemMessageVariant
+        :param timings: RequestTimings, optional, collects the durations of the stages of the request
+        :returns EasyChatRequestContext
+        """
+        if filter is None:
+            if role is None:
+                filter = self._filter
+            else:
+                filter = role.getSearchFilter(storage_base_url)
+        return EasyChatRequestContext(
+            filter = filter,
+            temperature = self._temperature if temperature is None else temperature,
+            top_n = self._top_n if top_n is None else top_n,
+            system_message = self._getFinalSystemMessage(system_message_variant),
+            timings = timings
+        )
+
+    def setAnswerCache(self, cache : Union[None, EasyChatAnswerCache]):
+        self._answer_cache = cache
+    def getAnswerCache(self) -> Union[None, EasyChatAnswerCache]:
+        return self._answer_cache
+
+    def setRequestCoalescing(self, enabled : bool):
+        """
+        Enables or disables coalescing of identical concurrent requests into one upstream completion
+        """
+        self._single_flight = self._single_flight_class() if enabled else None
+    def getRequestCoalescing(self) -> bool:
+        return self._single_flight is not None
+
+    def setBackendPool(self, pool : Union[None, OpenAIBackendPool]):
+        """
+        Balances the chat completions over the backends of the pool (None sends them to the client of this instance)
+        """
+        self._backend_pool = pool
+    def getBackendPool(self) -> Union[None, OpenAIBackendPool]:
+        return self._backend_pool
+    def getOpenAIClients(self) -> list:
+        """
+        Returns the openai clients of this instance (the clients of all backends, if a backend pool is set)
+        """
+        if self._backend_pool is not None:
+            return [ b.getClient() for b in self._backend_pool.getBackends() ]
+        return [ self._open_ai_client ]
 
-    def _chat(self, messages: List[EasyChatMessage], streamed : bool = False):
+    def setCitationSnippetLength(self, snippet_length : int, store : Union[None, EasyChatCitationStore] = None):
+        """
+        Trims the citation content to snippet_length characters and removes the content of duplicate chunks (0 sends the full chunks)
+
+        :param snippet_length: int
+        :param store: EasyChatCitationStore, optional, keeps the full texts (default: the shared store)
+        """
+        if int(snippet_length) < 0:
+            raise ValueError("snippet_length must not be negative")
+        self._citation_snippet_length = int(snippet_length)
+        self._citation_store = None
+        if self._citation_snippet_length > 0:
+            self._citation_store = get_shared_citation_store() if store is None else store
+    def getCitationSnippetLength(self) -> int:
+        return self._citation_snippet_length
+    def getCitationStore(self) -> Union[None, EasyChatCitationStore]:
+        return self._citation_store
+
+    def _getCitationScope(self, context : EasyChatRequestContext) -> str:
+        return json.dumps([ self._azure_search_index_name, context.getFilter() ])
+
+    def getCitationContent(self, citation_id : str, context : Union[None, EasyChatRequestContext] = None) -> Union[None, str]:
+        """
+        Returns the full text of a trimmed citation or None, if the text is unknown (or was stored for another role)
+
+        :param citation_id: str, the "id" of the citation
+        :param context: EasyChatRequestContext, optional, the search filter of the context is the scope of the text
+        """
+        if self._citation_store is None:
+            return None
+        if context is None:
+            context = self.createRequestContext()
+        return self._citation_store.get(self._getCitationScope(context), citation_id)
+
+    def _serializeResponse(self, completion : Union[ChatCompletion, ChatCompletionChunk], context : EasyChatRequestContext) -> dict:
+        return get_json_serializable_response(completion, self._citation_snippet_length, self._citation_store, self._getCitationScope(context))
+
+    def setEmbeddingService(self, service : EasyChatEmbeddingService):
+        """
+        Sets the service for the query embeddings (answer cache and direct retrieval)
+        """
+        self._embedding_service = service
+    def getEmbeddingService(self) -> EasyChatEmbeddingService:
+        return self._embedding_service
+
+    def setRetriever(self, retriever : Union[None, AzureSearchRetriever, LocalIndexRetriever]):
+        """
+        Retrieves the documents with the retriever and passes them to the model (None uses the azure_search data source)
+        """
+        self._retriever = retriever
+    def getRetriever(self) -> Union[None, AzureSearchRetriever, LocalIndexRetriever]:
+        return self._retriever
+
+    def _retrieve(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> Union[None, dict]:
+        """
+        Returns the context (citations and intent) of the retrieved documents or None, if the data source has to search
+
+        :raises RuntimeError: if the search of the local index fails
+        """
+        if self._retriever is None:
+            return None
+        query = build_retrieval_query(messages)
+        if query == "":
+            # the local index has no data source that could search instead
+            return { "citations": [ ], "intent": json.dumps([ ]) } if self._useLocalIndex() else None
+        try:
+            with context.getTimings().measure("retrieval"):
+                documents = self._retriever.search(query, context.getFilter(), context.getTopN(), self._embedding_service.embed)
+        except Exception as e:
+            if self._useLocalIndex():
+                # there is no search index to fall back to, report the cause instead of the error of an unconfigured data source
+                raise RuntimeError("The search of the local index failed: " + str(e)) from e
+            # let the azure_search data source search instead of failing the request
+            get_counter("chat_retrieval_errors_total", "Number of direct searches that failed (the data source searched instead)").inc()
+            return None
+        return { "citations": documents, "intent": json.dumps([ query ]) }
+
+    def setHistoryTrimmer(self, trimmer : Union[None, EasyChatHistoryTrimmer]):
+        """
+        Sets the token budget of the conversation history (None sends the full history)
+        """
+        self._history_trimmer = trimmer
+    def getHistoryTrimmer(self) -> Union[None, EasyChatHistoryTrimmer]:
+        return self._history_trimmer
+
+    def _summarizeHistory(self, previous_summary : Union[None, str], messages: List[EasyChatMessage]) -> str:
+        completion = self._open_ai_client.chat.completions.create(
+            model = self._open_ai_deployment_name,
+            messages = self._history_trimmer.buildSummaryMessages(previous_summary, messages),
+            temperature = 0,
+            max_tokens = self._history_trimmer.getSummaryTokens()
+        )
+        return str(completion.choices[0].message.content or "")
+
+    def _trimHistory(self, messages: List[EasyChatMessage]) -> List[EasyChatMessage]:
+        if self._history_trimmer is None:
+            return messages
+        dropped, kept = self._history_trimmer.split(messages)
+        if len(dropped) == 0:
+            return messages
+        get_counter("chat_history_dropped_messages_total", "Number of history messages that exceeded the history token budget").inc(len(dropped))
+        if not self._history_trimmer.getSummarize():
+            return kept
+        summary, covered = self._history_trimmer.getSummary(dropped)
+        if covered < len(dropped):
+            try:
+                summary = self._summarizeHistory(summary, dropped[covered:])
+                self._history_trimmer.setSummary(dropped, summary)
+            except Exception:
+                # answer with the (older) summary instead of failing the request
+                pass
+        return self._history_trimmer.compose(summary, kept)
+
+    def _getRequestKey(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> str:
+        # the serialized scope is reused as prefix, only the messages are serialized per request
+        return hashlib.sha256((self._getRequestScope(context) + "\n" + json.dumps([ [ m.role, m.content ] for m in messages ])).encode("utf-8")).hexdigest()
+
+    def _useAnswerCache(self, messages: List[EasyChatMessage]) -> bool:
+        return self._answer_cache is not None and len(messages) > 0 and messages[-1].role == "user"
+
+    def _getRequestScope(self, context : EasyChatRequestContext) -> str:
+        return self._getRequestTemplate(context).scope
+
+    def _getRequestTemplate(self, context : EasyChatRequestContext) -> _RequestTemplate:
+        """
+        Returns the data source, the system message and the scope of the request settings, built once per settings
+        (the settings of a role only change with the configuration, see config.py)
+        """
+        key = (context.getFilter(), context.getTopN(), context.getTemperature(), context.getSystemMessage())
+        template = self._request_templates.get(key)
+        if template is None:
+            template = _RequestTemplate(
+                { "role": "system", "content": context.getSystemMessage() },
+                { "data_sources": [ self._buildDataSource(context.getFilter(), context.getTopN()) ] },
+                json.dumps([
+                    self._open_ai_deployment_name,
+                    self._azure_search_index_name,
+                    context.getFilter(),
+                    context.getTemperature(),
+                    context.getTopN(),
+                    hashlib.sha256(context.getSystemMessage().encode("utf-8")).hexdigest()
+                ])
+            )
+            self._request_templates.set(key, template)
+        return template
+
+    def _refreshAnswerCacheIndexVersion(self):
+        if time.monotonic() - self._answer_cache_index_checked_at < self._answer_cache_index_check_interval:
+            return
+        self._answer_cache_index_checked_at = time.monotonic()
+        try:
+            if self._retriever is not None:
+                self._answer_cache.setIndexVersion(self._retriever.getIndexVersion())
+            else:
+                self._answer_cache.setIndexVersion(get_azure_search_index_version(self._azure_search_api_base, self._azure_search_index_name, self._azure_search_api_key))
+        except Exception:
+            # keep the current version, in case the index stats are not accessible
+            pass
+
+    def _isSingleQuestion(self, messages: List[EasyChatMessage]) -> bool:
+        return self._answer_cache.getSimilarityThreshold() > 0 and len([ m for m in messages if m.role != "system" ]) == 1
+
+    def _getQuestionEmbedding(self, messages: List[EasyChatMessage]) -> Union[None, list]:
+        # only single questions are looked up by similarity, follow-up questions depend on the history
+        if not self._isSingleQuestion(messages):
+            return None
+        try:
+            return self._embedding_service.embed(messages[-1].content)
+        except Exception:
+            return None
+
+    def _buildChatRequest(self, messages: List[EasyChatMessage], streamed : bool = False, context : Union[None, EasyChatRequestContext] = None, retrieved : Union[None, dict] = None) -> dict:
+        """
+        Builds the keyword arguments for chat.completions.create()
+
+        :param retrieved: dict, optional, context of the retrieved documents (see _retrieve), replaces the azure_search data source
+        """
+        if context is None:
+            context = self.createRequestContext()
+        if retrieved is not None:
+            return self._buildRetrievedChatRequest(messages, streamed, context, retrieved)
+        # only the messages are built per request, the data source and the system message are shared
+        template = self._getRequestTemplate(context)
+        msgs = [ template.system ]
+        for message in messages:
+            msgs.append({
+                "role": message.role,
+                "content": message.content
+            })
+        return {
+            "model": self._open_ai_deployment_name,
+            "messages": msgs,
+            "temperature": context.getTemperature(), # recommended value is 0 or close to 0 (it can be between 0 and 2)
+            "extra_body": template.extra_body,
+            "stream": streamed
+        }
+
+    def _buildDataSource(self, filter : str, top_n : int) -> dict:
         dataSource = {
             "type": "azure_search",
             "parameters": {
                 "endpoint": self._azure_search_api_base,
                 "index_name": self._azure_search_index_name,
-                "top_n_documents": 5,
+                "top_n_documents": top_n,
                 "role_information": "You must generate citation based on the retrieved information.",
                 "fields_mapping": {
                     "filepath_field": "chunk_id",
@@ -291,13 +1810,22 @@ class EasyChatClient:
                 "api_key": self._azure_search_api_key
             }
         # setting filter
-        if self._filter != "":
-            dataSource["parameters"]["filter"] = str(self._filter)
-        # setting messages
+        if filter != "":
+            dataSource["parameters"]["filter"] = filter
+        return dataSource
+
+    def _buildRetrievedChatRequest(self, messages: List[EasyChatMessage], streamed : bool, context : EasyChatRequestContext, retrieved : dict) -> dict:
+        # the documents are passed in the system message, numbered like the citations of the data source
+        documents = "\n\n".join(
+            "[doc" + str(i + 1) + "] " + d["title"] + "\n" + d["content"]
+            for i, d in enumerate(retrieved["citations"])
+        )
         msgs = [
             {
                 "role": "system",
-                "content": self._final_system_message
+                "content": context.getSystemMessage() + "\n\nRetrieved documents:\n\n" + documents + "\n\n" +
+                    "Answer based on the retrieved documents. You must generate citation based on the retrieved information, " +
+                    "reference the documents as [doc1], [doc2], ..."
             }
         ]
         for message in messages:
@@ -305,29 +1833,326 @@ class EasyChatClient:
                 "role": message.role,
                 "content": message.content
             })
-        # return the completion
-        return self._open_ai_client.chat.completions.create(
+        return {
+            "model": self._open_ai_deployment_name,
+            "messages": msgs,
+            "temperature": context.getTemperature(),
+            "stream": streamed
+        }
+
+    def _chat(self, messages: List[EasyChatMessage], streamed : bool = False, context : Union[None, EasyChatRequestContext] = None):
+        if context is None:
+            context = self.createRequestContext()
+        timings = context.getTimings()
+        timings.setLabel("deployment", self._open_ai_deployment_name)
+        with timings.measure("history"):
+            messages = self._trimHistory(messages)
+        retrieved = self._retrieve(messages, context)
+        # return the completion (the search of the data source runs upstream, before the first chunk is sent)
+        with timings.measure("upstream_connect" if streamed else "completion"):
+            if self._backend_pool is not None:
+                completion = self._backend_pool.create(
+                    served_by = lambda backend: timings.setLabel("deployment", backend.getDeploymentName()),
+                    **self._buildChatRequest(messages, streamed, context, retrieved))
+            else:
+                completion = self._open_ai_client.chat.completions.create(**self._buildChatRequest(messages, streamed, context, retrieved))
+        if retrieved is None:
+            return completion
+        if streamed:
+            return _RetrievedContextStream(completion, retrieved)
+        _attach_retrieved_context(completion, retrieved)
+        return completion
+
+    def _streamedChat(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> Generator[dict, None, None]:
+        timings = context.getTimings()
+        collector = None
+        if self._useAnswerCache(messages):
+            with timings.measure("answer_cache"):
+                self._refreshAnswerCacheIndexVersion()
+                scope = self._getRequestScope(context)
+                # the question is only embedded if the exact lookup misses (the embedding is reused for the new answer)
+                embedding = None
+                answer = self._answer_cache.getExact(scope, messages)
+                if answer is None:
+                    embedding = self._getQuestionEmbedding(messages)
+                    answer = self._answer_cache.get(scope, messages, embedding)
+            if answer is not None:
+                yield from answer_to_stream_records(answer)
+                return
+            collector = EasyChatStreamCollector()
+        start = time.perf_counter()
+        stream = self._chat(messages, True, context)
+        tokens = 0
+        firstTokenAt = None
+        try:
+            for msg in stream:
+                count = _count_streamed_tokens(msg)
+                if count > 0 and firstTokenAt is None:
+                    firstTokenAt = time.perf_counter()
+                    timings.add("ttft", firstTokenAt - start)
+                tokens += count
+                with timings.measure("serialization"):
+                    data = self._serializeResponse(msg, context)
+                if collector is not None:
+                    collector.add(data)
+                yield data
+        except GeneratorExit:
+            # the consumer went away (f.e. the browser disconnected), stop the upstream completion
+            stream.close()
+            _record_stream_end(tokens, True)
+            raise
+        _record_stream_end(tokens, False)
+        _record_generation_timings(timings, firstTokenAt, tokens)
+        if collector is not None and collector.getAnswer() is not None:
+            self._answer_cache.set(scope, messages, collector.getAnswer(), embedding)
+
+    def streamedChat(self, messages: List[EasyChatMessage], outputFormat : str = "dict", context : Union[None, EasyChatRequestContext] = None) -> Generator[Union[dict, str], None, None]:
+        """
+        Streams the answer
+
+        :param messages: List[EasyChatMessage]
+        :param outputFormat: str, 'dict' (records), 'json' (records as JSON lines) or 'compact' (JSON lines of the compact format, see EasyChatCompactStreamEncoder)
+        :param context: EasyChatRequestContext, optional
+        :returns Generator of dicts or str
+        """
+        if outputFormat not in [ "json", "dict", "compact" ]:
+            raise ValueError("outputFormat must be 'json', 'dict' or 'compact'")
+        if context is None:
+            context = self.createRequestContext()
+        if self._single_flight is None:
+            records = self._streamedChat(messages, context)
+        else:
+            # identical concurrent requests share the upstream completion (the records are shared, do not modify them)
+            records = self._single_flight.stream(self._getRequestKey(messages, context), lambda: self._streamedChat(messages, context))
+        encoder = EasyChatCompactStreamEncoder()
+        try:
+            for data in records:
+                if outputFormat == "json":
+                    yield (json.dumps(data) + "\n")
+                elif outputFormat == "compact":
+                    lines = "".join(json.dumps(r, separators = (",", ":")) + "\n" for r in encoder.encode(data))
+                    if lines != "":
+                        yield lines
+                else:
+                    yield data
+        finally:
+            records.close()
+
+    def _completeChat(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> dict:
+        timings = context.getTimings()
+        if not self._useAnswerCache(messages):
+            completion = self._chat(messages, False, context)
+            with timings.measure("serialization"):
+                return self._serializeResponse(completion, context)
+        with timings.measure("answer_cache"):
+            self._refreshAnswerCacheIndexVersion()
+            scope = self._getRequestScope(context)
+            # the question is only embedded if the exact lookup misses (the embedding is reused for the new answer)
+            embedding = None
+            answer = self._answer_cache.getExact(scope, messages)
+            if answer is None:
+                embedding = self._getQuestionEmbedding(messages)
+                answer = self._answer_cache.get(scope, messages, embedding)
+        if answer is None:
+            completion = self._chat(messages, False, context)
+            with timings.measure("serialization"):
+                answer = self._serializeResponse(completion, context)
+            self._answer_cache.set(scope, messages, answer, embedding)
+        return answer
+
+    def chat(self, messages: List[EasyChatMessage], context : Union[None, EasyChatRequestContext] = None) -> dict:
+        if context is None:
+            context = self.createRequestContext()
+        if self._single_flight is None:
+            return self._completeChat(messages, context)
+        return self._single_flight.do(self._getRequestKey(messages, context), lambda: self._completeChat(messages, context))
+
+
+class AsyncEasyChatClient(EasyChatClient):
+    """
+    EasyChatClient variant on top of AsyncAzureOpenAI for asyncio servers (see chat_bot/asgi.py).
+    Configuration and request contexts are the same as for EasyChatClient, but chat() and streamedChat() have to be awaited.
+    """
+    _open_ai_client_class = AsyncAzureOpenAI
+    _open_ai_client: AsyncAzureOpenAI
+    _single_flight_class = AsyncSingleFlight
+    _embedding_service_class = AsyncEasyChatEmbeddingService
+
+    async def _chat(self, messages: List[EasyChatMessage], streamed : bool = False, context : Union[None, EasyChatRequestContext] = None):
+        if context is None:
+            context = self.createRequestContext()
+        timings = context.getTimings()
+        timings.setLabel("deployment", self._open_ai_deployment_name)
+        with timings.measure("history"):
+            messages = await self._trimHistory(messages)
+        retrieved = await self._retrieve(messages, context)
+        # return the completion (the search of the data source runs upstream, before the first chunk is sent)
+        with timings.measure("upstream_connect" if streamed else "completion"):
+            if self._backend_pool is not None:
+                completion = await self._backend_pool.acreate(
+                    served_by = lambda backend: timings.setLabel("deployment", backend.getDeploymentName()),
+                    **self._buildChatRequest(messages, streamed, context, retrieved))
+            else:
+                completion = await self._open_ai_client.chat.completions.create(**self._buildChatRequest(messages, streamed, context, retrieved))
+        if retrieved is None:
+            return completion
+        if streamed:
+            return _AsyncRetrievedContextStream(completion, retrieved)
+        _attach_retrieved_context(completion, retrieved)
+        return completion
+
+    async def _retrieve(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> Union[None, dict]:
+        if self._retriever is None:
+            return None
+        query = build_retrieval_query(messages)
+        if query == "":
+            # the local index has no data source that could search instead
+            return { "citations": [ ], "intent": json.dumps([ ]) } if self._useLocalIndex() else None
+        try:
+            with context.getTimings().measure("retrieval"):
+                documents = await self._retriever.asearch(query, context.getFilter(), context.getTopN(), self._embedding_service.embed)
+        except Exception as e:
+            if self._useLocalIndex():
+                # there is no search index to fall back to, report the cause instead of the error of an unconfigured data source
+                raise RuntimeError("The search of the local index failed: " + str(e)) from e
+            # let the azure_search data source search instead of failing the request
+            get_counter("chat_retrieval_errors_total", "Number of direct searches that failed (the data source searched instead)").inc()
+            return None
+        return { "citations": documents, "intent": json.dumps([ query ]) }
+
+    async def _summarizeHistory(self, previous_summary : Union[None, str], messages: List[EasyChatMessage]) -> str:
+        completion = await self._open_ai_client.chat.completions.create(
             model = self._open_ai_deployment_name,
-            messages = msgs,
-            temperature= float(self._temperature), # recommended value is 0 or close to 0 (it can be between 0 and 2)
-            extra_body= {
-                "data_sources": [ dataSource ]
-            },
-            stream=streamed
+            messages = self._history_trimmer.buildSummaryMessages(previous_summary, messages),
+            temperature = 0,
+            max_tokens = self._history_trimmer.getSummaryTokens()
         )
+        return str(completion.choices[0].message.content or "")
 
-    def streamedChat(self, messages: List[EasyChatMessage], outputFormat : str = "dict") -> Generator[Union[dict, str], None, None]:
-        if outputFormat == "json":
-            for msg in self._chat(messages, True):
-                yield (json.dumps(get_json_serializable_response(msg)) + "\n")
-        elif outputFormat == "dict":
-            for msg in self._chat(messages, True):
-                yield get_json_serializable_response(msg)
+    async def _trimHistory(self, messages: List[EasyChatMessage]) -> List[EasyChatMessage]:
+        if self._history_trimmer is None:
+            return messages
+        dropped, kept = self._history_trimmer.split(messages)
+        if len(dropped) == 0:
+            return messages
+        get_counter("chat_history_dropped_messages_total", "Number of history messages that exceeded the history token budget").inc(len(dropped))
+        if not self._history_trimmer.getSummarize():
+            return kept
+        summary, covered = self._history_trimmer.getSummary(dropped)
+        if covered < len(dropped):
+            try:
+                summary = await self._summarizeHistory(summary, dropped[covered:])
+                self._history_trimmer.setSummary(dropped, summary)
+            except Exception:
+                # answer with the (older) summary instead of failing the request
+                pass
+        return self._history_trimmer.compose(summary, kept)
+
+    async def _getQuestionEmbedding(self, messages: List[EasyChatMessage]) -> Union[None, list]:
+        # only single questions are looked up by similarity, follow-up questions depend on the history
+        if not self._isSingleQuestion(messages):
+            return None
+        try:
+            return await self._embedding_service.embed(messages[-1].content)
+        except Exception:
+            return None
+
+    async def _streamedChat(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> AsyncGenerator[dict, None]:
+        timings = context.getTimings()
+        collector = None
+        if self._useAnswerCache(messages):
+            with timings.measure("answer_cache"):
+                await asyncio.to_thread(self._refreshAnswerCacheIndexVersion)
+                scope = self._getRequestScope(context)
+                # the question is only embedded if the exact lookup misses (the embedding is reused for the new answer)
+                embedding = None
+                answer = self._answer_cache.getExact(scope, messages)
+                if answer is None:
+                    embedding = await self._getQuestionEmbedding(messages)
+                    answer = self._answer_cache.get(scope, messages, embedding)
+            if answer is not None:
+                for data in answer_to_stream_records(answer):
+                    yield data
+                return
+            collector = EasyChatStreamCollector()
+        start = time.perf_counter()
+        stream = await self._chat(messages, True, context)
+        tokens = 0
+        firstTokenAt = None
+        try:
+            async for msg in stream:
+                count = _count_streamed_tokens(msg)
+                if count > 0 and firstTokenAt is None:
+                    firstTokenAt = time.perf_counter()
+                    timings.add("ttft", firstTokenAt - start)
+                tokens += count
+                with timings.measure("serialization"):
+                    data = self._serializeResponse(msg, context)
+                if collector is not None:
+                    collector.add(data)
+                yield data
+        except (GeneratorExit, asyncio.CancelledError):
+            # the consumer went away (f.e. the browser disconnected), stop the upstream completion
+            await stream.close()
+            _record_stream_end(tokens, True)
+            raise
+        _record_stream_end(tokens, False)
+        _record_generation_timings(timings, firstTokenAt, tokens)
+        if collector is not None and collector.getAnswer() is not None:
+            self._answer_cache.set(scope, messages, collector.getAnswer(), embedding)
+
+    async def streamedChat(self, messages: List[EasyChatMessage], outputFormat : str = "dict", context : Union[None, EasyChatRequestContext] = None) -> AsyncGenerator[Union[dict, str], None]:
+        if outputFormat not in [ "json", "dict", "compact" ]:
+            raise ValueError("outputFormat must be 'json', 'dict' or 'compact'")
+        if context is None:
+            context = self.createRequestContext()
+        if self._single_flight is None:
+            records = self._streamedChat(messages, context)
         else:
-            raise ValueError("outputFormat must be 'json' or 'dict'")
+            # identical concurrent requests share the upstream completion (the records are shared, do not modify them)
+            records = self._single_flight.stream(self._getRequestKey(messages, context), lambda: self._streamedChat(messages, context))
+        encoder = EasyChatCompactStreamEncoder()
+        try:
+            async for data in records:
+                if outputFormat == "json":
+                    yield (json.dumps(data) + "\n")
+                elif outputFormat == "compact":
+                    lines = "".join(json.dumps(r, separators = (",", ":")) + "\n" for r in encoder.encode(data))
+                    if lines != "":
+                        yield lines
+                else:
+                    yield data
+        finally:
+            await records.aclose()
+
+    async def _completeChat(self, messages: List[EasyChatMessage], context : EasyChatRequestContext) -> dict:
+        timings = context.getTimings()
+        if not self._useAnswerCache(messages):
+            completion = await self._chat(messages, False, context)
+            with timings.measure("serialization"):
+                return self._serializeResponse(completion, context)
+        with timings.measure("answer_cache"):
+            await asyncio.to_thread(self._refreshAnswerCacheIndexVersion)
+            scope = self._getRequestScope(context)
+            # the question is only embedded if the exact lookup misses (the embedding is reused for the new answer)
+            embedding = None
+            answer = self._answer_cache.getExact(scope, messages)
+            if answer is None:
+                embedding = await self._getQuestionEmbedding(messages)
+                answer = self._answer_cache.get(scope, messages, embedding)
+        if answer is None:
+            completion = await self._chat(messages, False, context)
+            with timings.measure("serialization"):
+                answer = self._serializeResponse(completion, context)
+            self._answer_cache.set(scope, messages, answer, embedding)
+        return answer
 
-    def chat(self, messages: List[EasyChatMessage]) -> dict:       
-        return get_json_serializable_response(self._chat(messages, False))
+    async def chat(self, messages: List[EasyChatMessage], context : Union[None, EasyChatRequestContext] = None) -> dict:
+        if context is None:
+            context = self.createRequestContext()
+        if self._single_flight is None:
+            return await self._completeChat(messages, context)
+        return await self._single_flight.do(self._getRequestKey(messages, context), lambda: self._completeChat(messages, context))
 
 
 def dict_to_chat_messages(data: dict) -> List[EasyChatMessage]:
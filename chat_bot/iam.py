@@ -1,9 +1,18 @@
-import os, base64, json
+import os, base64, json, hashlib
 from typing import Union
+from urllib.parse import quote
 from flask_login import LoginManager, UserMixin, current_user, logout_user
-from flask import request, current_app, redirect, url_for
+from flask import request, current_app, redirect, url_for, g
 from functools import wraps
+from .lrucache import LRUCache
+from .metrics import get_counter
 
+"""
+Environment variables used for the authentication:
+USE_AUTH_TYPE               Optional, 'local' or 'aad' (default: local)
+CHATBOT_AUTH_CACHE_SIZE     Optional, max. number of decoded easy auth principals (aad) kept per worker process (default: 10000)
+CHATBOT_AUTH_CACHE_TTL      Optional, seconds a decoded easy auth principal is kept (default: 300)
+"""
 
 
 USE_AUTH_TYPE= os.environ.get("USE_AUTH_TYPE", "local").lower().strip()
@@ -21,6 +30,7 @@ class ChatbotRole:
     _description : str = ""
     _filter : Union[None, str] = None
     _blobPathStartsWith : Union[None, str] = None
+    _search_filters : dict
 
     def __init__(self, name : str, description : str, filter : Union[None, str] = None, blobPathStartsWith : Union[None, str] = None):
         self._name = str(name)
@@ -29,6 +39,7 @@ class ChatbotRole:
             self._filter = str(filter)
         if not (blobPathStartsWith is None):
             self._blobPathStartsWith = str(blobPathStartsWith)
+        self._search_filters = { }
 
     def getName(self) -> str:
         return self._name
@@ -39,6 +50,39 @@ class ChatbotRole:
     def getBlobPathStartsWith(self) -> Union[None, str]:
         return self._blobPathStartsWith
 
+    def getSearchFilter(self, storage_base_url : str = "") -> str:
+        """
+        Returns the search filter of the role (see build_search_filter_from_role), built once per storage base url.
+        Roles are immutable, a changed roles.json creates new roles (see config.py).
+        """
+        f = self._search_filters.get(storage_base_url)
+        if f is None:
+            f = build_search_filter_from_role(self, storage_base_url)
+            self._search_filters[storage_base_url] = f
+        return f
+    def getSearchFilterBaseUrls(self) -> list:
+        return list(self._search_filters.keys())
+
+
+def build_search_filter_from_role(role : ChatbotRole, storage_base_url : str = "") -> str:
+    """
+    Builds the azure search filter for a role
+
+    :param role: ChatbotRole
+    :param storage_base_url: str, base url of the storage container (used for blobPathStartsWith)
+    :returns str, the filter (empty string in case of no filter)
+    """
+    f = ""
+    if not (role.getFilter() is None):
+        f = str(role.getFilter())
+    if not (role.getBlobPathStartsWith() is None):
+        if f != "":
+            f += " and "
+        metadataPath = storage_base_url + "/" +  quote(str(role.getBlobPathStartsWith()).lstrip("/")) + "*"
+        metadataPath = metadataPath.replace("/", "\\/").replace(":", "\\:")
+        f += "search.ismatch('\"" + metadataPath + "\"', 'metadata_storage_path')"
+    return f
+
 
 class ChatbotUser(UserMixin):
     id = ""
@@ -52,12 +96,16 @@ class ChatbotUser(UserMixin):
         self.id = str(username).lower().strip()
 
     def getRole(self) -> ChatbotRole:
-        return all_defined_roles.get(self.role, all_defined_roles["user"])
+        # the roles of the current configuration (imported here, config.py builds the roles with this module)
+        from .config import get_config
+        return get_config().getRole(self.role)
 
-def create_all_roles():
+def create_all_roles(directory : Union[None, str] = None):
     allRoles = { }
-    # get the directory of the current script
-    roleJson = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "roles.json")
+    # default is the directory of the app
+    if directory is None:
+        directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    roleJson = os.path.join(directory, "roles.json")
     if os.path.exists(roleJson):
         import json
         with open(roleJson, "r") as f:
@@ -76,20 +124,19 @@ def create_all_roles():
         allRoles["user"] = ChatbotRole("user", "User role")
     return allRoles
 
-# create the roles
-all_defined_roles = create_all_roles()
-
-def create_all_users():
+def create_all_users(roles : dict, directory : Union[None, str] = None):
     allUsers = { }
-    # get the directory of the current script
-    userJson = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "users.json")
+    # default is the directory of the app
+    if directory is None:
+        directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    userJson = os.path.join(directory, "users.json")
     if os.path.exists(userJson):
         import json
         with open(userJson, "r") as f:
             for usr in json.load(f):
                 if "username" in usr and "password" in usr and "role" in usr:
                     role = str(usr["role"]).lower().strip()
-                    if role not in all_defined_roles:
+                    if role not in roles:
                         role = "user"
                     print(f"Adding user {usr['username']} with role {role}")
                     allUsers[str(usr["username"]).lower().strip()] = ChatbotUser(
@@ -103,12 +150,6 @@ def create_all_users():
     # TODO: integrate with entra id
     return allUsers
 
-# create the users in case of local auth
-if USE_AUTH_TYPE == "local":
-    all_defined_users = create_all_users()
-else:
-    all_defined_users = { }
-
 
 
 
@@ -120,12 +161,12 @@ class EntraEasyAuthInfo:
     _authenticated = False
 
     def __init__(self, headers : dict):
+        self._authInfo = None
         if "x-ms-client-principal" in headers:
             try:
                 self._authInfo = json.loads(base64.b64decode(headers["x-ms-client-principal"]).decode("utf-8"))
             except:
                 self._authInfo = None
-        self._authInfo = json.loads(base64.b64decode(headers["x-ms-client-principal"]).decode("utf-8"))
 
         self._groups = []
         self._username = ""
@@ -134,11 +175,12 @@ class EntraEasyAuthInfo:
 
         if not (self._authInfo is None) and "auth_typ" in self._authInfo and self._authInfo["auth_typ"] == "aad" and "claims" in self._authInfo:
             for c in self._authInfo['claims']:
-                if c["typ"] == "groups":
+                typ = c["typ"]
+                if typ == "groups":
                     self._groups.append(c["val"])
-                if c["typ"] == "preferred_username":
+                elif typ == "preferred_username":
                     self._username = c["val"]
-                if c["typ"] == "http://schemas.microsoft.com/identity/claims/objectidentifier":
+                elif typ == "http://schemas.microsoft.com/identity/claims/objectidentifier":
                     self._userId = c["val"]
         if self._username != "" and self._userId != "":
             self._authenticated = True
@@ -176,22 +218,65 @@ def iam_is_authenticated() -> bool:
     return False
 
 
+def get_role_for_groups(groups : list, role_groups : frozenset) -> str:
+    """
+    Returns the role of the first group that is a defined role, 'user' if there is none
+
+    :param groups: list, the group claims of the user
+    :param role_groups: frozenset, the names of the defined roles (see ChatbotConfig.getRoleGroups())
+    """
+    for r in groups:
+        if r in role_groups:
+            return r
+    return "user"
+
+
+_principal_cache = LRUCache(int(os.getenv("CHATBOT_AUTH_CACHE_SIZE", "10000")), float(os.getenv("CHATBOT_AUTH_CACHE_TTL", "300")))
+_principal_cache_hits = get_counter("auth_principal_cache_hits_total", "Number of easy auth principals resolved from the cache")
+_principal_cache_misses = get_counter("auth_principal_cache_misses_total", "Number of easy auth principals decoded")
+_NOT_CACHED = object()
+
+def get_user_from_principal(headers : dict) -> Union[None, ChatbotUser]:
+    """
+    Returns the user of the easy auth principal header (x-ms-client-principal) or None if it is missing or not authenticated.
+    The decoded users are cached by the digest of the header and the config version, the header is only decoded once per session token.
+
+    :param headers: dict, the request headers
+    :returns ChatbotUser or None
+    """
+    principal = headers.get("x-ms-client-principal")
+    if principal is None:
+        return None
+    from .config import get_config
+    config = get_config()
+    key = (hashlib.sha256(principal.encode("utf-8")).digest(), config.getVersion())
+    u = _principal_cache.get(key, _NOT_CACHED)
+    if u is not _NOT_CACHED:
+        _principal_cache_hits.inc()
+        return u
+    _principal_cache_misses.inc()
+    u = None
+    auth = EntraEasyAuthInfo(headers)
+    if auth.isAuthenticated():
+        u = ChatbotUser(auth.getUserName(), "", get_role_for_groups(auth.getGroups(), config.getRoleGroups()))
+    _principal_cache.set(key, u)
+    return u
+
+
 def iam_get_current_user() -> Union[None, ChatbotUser]:
     if USE_AUTH_TYPE == "local":
         if not isinstance(current_user, ChatbotUser):
             return None
         else:
-            return current_user
+            # the user itself, the proxy is only valid in the request context (see asgi.py)
+            return current_user._get_current_object()
     elif USE_AUTH_TYPE == "aad":
-        auth = EntraEasyAuthInfo(request.headers)
-        if auth.isAuthenticated():
-            role = "user"
-            for r in auth.getGroups():
-                if r in all_defined_roles:
-                    role = r
-                    break
-            u = ChatbotUser(auth.getUserName(), "", role)
-            return u
+        # resolved once per request (login_required, the view and the templates ask again)
+        u = g.get("iam_user", _NOT_CACHED)
+        if u is _NOT_CACHED:
+            u = get_user_from_principal(request.headers)
+            g.iam_user = u
+        return u
     return None
 
 
@@ -0,0 +1,233 @@
+import argparse, fnmatch, json, mimetypes, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Union, List, Callable
+from .azurestorage import BlobStorage, create_pooled_transport, get_file_md5
+
+"""
+Bulk upload of a folder of documents (f.e. pdf_documents/ of a new department) into the blob container.
+The storage is configured with the AZURE_STORAGEBLOB_* variables (see azurestorage.py).
+
+    python -m chat_bot.ingest <folder> [--prefix <blob prefix>] [--pattern *.pdf] [--workers 8] [--block-size-mb 4] [--state-file <file>] [--force]
+
+Files are streamed from disk in blocks, uploaded by a bounded pool of workers and skipped if the blob already has the same content
+(the ETag recorded in the state file of the last run, or the Content-MD5 of the blob).
+An interrupted run is resumed by starting it again: finished files are skipped and the staged blocks of a partly uploaded file are reused.
+"""
+
+
+class BlobIngestState:
+    """
+    Append-only journal (json lines) of the uploaded files: blob path, size and mtime of the file, MD5 and ETag of the blob.
+    Every finished file is written right away, so an interrupted run loses at most the files in flight.
+    """
+    _file_path : str
+    _entries : dict
+    _lock : threading.Lock
+
+    def __init__(self, file_path : str):
+        self._file_path = str(file_path)
+        self._entries = { }
+        self._lock = threading.Lock()
+        if os.path.exists(self._file_path):
+            with open(self._file_path, "r", encoding = "utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry["path"]] = entry
+                    except (ValueError, KeyError):
+                        # a line cut off by an interruption
+                        pass
+        self._file = open(self._file_path, "a", encoding = "utf-8")
+
+    def getFilePath(self) -> str:
+        return self._file_path
+
+    def get(self, path : str) -> Union[None, dict]:
+        with self._lock:
+            return self._entries.get(path)
+
+    def add(self, path : str, size : int, mtime_ns : int, md5 : str, etag : str):
+        # the ETag of the upload response and of the listing differ in quoting
+        entry = { "path": path, "size": int(size), "mtime_ns": int(mtime_ns), "md5": str(md5), "etag": str(etag).strip('"') }
+        with self._lock:
+            self._entries[path] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class BlobIngest:
+    """
+    Uploads the files of a folder into the blob container with a bounded pool of workers.
+    At most workers * block_size bytes of file content are held in memory.
+    """
+    _bs : BlobStorage
+    _state : Union[None, BlobIngestState]
+    _workers : int
+    _block_size : int
+    _force : bool
+    _stats : dict
+    _failures : List[tuple]
+    _lock : threading.Lock
+
+    def __init__(self, blob_storage : BlobStorage, state : Union[None, BlobIngestState] = None, workers : int = 8, block_size : int = 4 * 1024 * 1024, force : bool = False):
+        """
+        Create a new BlobIngest
+
+        :param blob_storage: BlobStorage, its connection pool should hold at least workers connections (see create_pooled_transport)
+        :param state: BlobIngestState, optional, the journal used to skip files of a previous run without hashing them
+        :param workers: int, number of concurrent uploads
+        :param block_size: int, bytes per upload request
+        :param force: bool, upload unchanged files as well
+        """
+        self._bs = blob_storage
+        self._state = state
+        self._workers = max(1, int(workers))
+        self._block_size = max(1, int(block_size))
+        self._force = bool(force)
+        self._stats = { "files": 0, "uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0, "uploaded_bytes": 0, "started": time.monotonic(), "finished": None }
+        self._failures = [ ]
+        self._lock = threading.Lock()
+
+    def _count(self, name : str, amount : int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _ingestFile(self, file_path : str, path : str, remote : Union[None, dict]):
+        st = os.stat(file_path)
+        self._count("bytes", st.st_size)
+        md5 = None
+        entry = None if self._state is None else self._state.get(path)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            md5 = bytes.fromhex(entry["md5"])
+            if not self._force and remote is not None and str(remote["ETag"]).strip('"') == str(entry["etag"]).strip('"'):
+                self._count("skipped")
+                return
+        if md5 is None:
+            md5 = get_file_md5(file_path, self._block_size)
+        if not self._force and remote is not None and remote["ContentMD5"] == md5:
+            # uploaded by someone else or the state file is gone, remember the blob for the next run
+            if self._state is not None:
+                self._state.add(path, st.st_size, st.st_mtime_ns, md5.hex(), remote["ETag"])
+            self._count("skipped")
+            return
+        contentType = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        etag = self._bs.uploadFile(path, file_path, contentType, self._block_size, md5)
+        if self._state is not None:
+            self._state.add(path, st.st_size, st.st_mtime_ns, md5.hex(), etag)
+        self._count("uploaded")
+        self._count("uploaded_bytes", st.st_size)
+
+    def _run(self, file_path : str, path : str, remote : Union[None, dict]):
+        try:
+            self._ingestFile(file_path, path, remote)
+        except Exception as e:
+            with self._lock:
+                self._failures.append((path, str(e)))
+                self._stats["failed"] += 1
+
+    def ingest(self, source : str, prefix : str = "", pattern : str = "*", progress : Union[None, Callable[[dict], None]] = None, progress_interval : float = 5) -> dict:
+        """
+        Uploads all files of the folder (and its subfolders) matching the pattern
+
+        :param source: str, local folder
+        :param prefix: str, optional, prefix of the blob paths, the path of a file relative to the folder is appended
+        :param pattern: str, optional, fnmatch pattern of the file names (case insensitive)
+        :param progress: function, optional, called with getStats() every progress_interval seconds
+        :param progress_interval: float, seconds
+        :returns dict, see getStats()
+        """
+        if prefix != "" and not prefix.endswith("/"):
+            prefix += "/"
+        # one listing instead of a request per file
+        remote = { b["Name"]: b for b in self._bs.listPath(prefix) }
+        # the state file is written during the run, it is never uploaded (f.e. with the pattern *)
+        stateFile = None if self._state is None else os.path.realpath(self._state.getFilePath())
+        lastProgress = time.monotonic()
+        with ThreadPoolExecutor(max_workers = self._workers) as pool:
+            pending = set()
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if not fnmatch.fnmatch(name.lower(), pattern.lower()):
+                        continue
+                    filePath = os.path.join(root, name)
+                    if os.path.realpath(filePath) == stateFile:
+                        continue
+                    path = prefix + os.path.relpath(filePath, source).replace(os.sep, "/")
+                    self._count("files")
+                    # bounded queue, the folder is walked while the first files are uploaded
+                    if len(pending) >= self._workers * 2:
+                        _, pending = wait(pending, return_when = FIRST_COMPLETED)
+                    pending.add(pool.submit(self._run, filePath, path, remote.get(path)))
+                    if progress is not None and time.monotonic() - lastProgress >= progress_interval:
+                        lastProgress = time.monotonic()
+                        progress(self.getStats())
+            while len(pending) > 0:
+                _, pending = wait(pending, timeout = progress_interval if progress is not None else None, return_when = FIRST_COMPLETED)
+                if progress is not None and time.monotonic() - lastProgress >= progress_interval:
+                    lastProgress = time.monotonic()
+                    progress(self.getStats())
+        with self._lock:
+            self._stats["finished"] = time.monotonic()
+        return self.getStats()
+
+    def getFailures(self) -> List[tuple]:
+        """
+        Returns the (blob path, error) of the files that could not be uploaded
+        """
+        with self._lock:
+            return list(self._failures)
+
+    def getStats(self) -> dict:
+        """
+        Returns the counters of the run and its throughput (seconds, files_per_second, mb_per_second of the uploaded bytes)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        seconds = max(1e-9, (stats.pop("finished") or time.monotonic()) - stats.pop("started"))
+        stats["seconds"] = seconds
+        stats["files_per_second"] = (stats["uploaded"] + stats["skipped"] + stats["failed"]) / seconds
+        stats["mb_per_second"] = stats["uploaded_bytes"] / seconds / (1024 * 1024)
+        return stats
+
+
+def format_stats(stats : dict) -> str:
+    return (
+        f"{stats['uploaded'] + stats['skipped'] + stats['failed']}/{stats['files']} files, "
+        f"{stats['uploaded']} uploaded, {stats['skipped']} unchanged, {stats['failed']} failed, "
+        f"{stats['uploaded_bytes'] / (1024 * 1024):.1f} MB in {stats['seconds']:.1f} s "
+        f"({stats['files_per_second']:.1f} files/s, {stats['mb_per_second']:.2f} MB/s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Uploads a folder of documents into the blob container")
+    parser.add_argument("source", help = "folder with the documents")
+    parser.add_argument("--prefix", default = "", help = "prefix of the blob paths (f.e. the folder of the department)")
+    parser.add_argument("--pattern", default = "*.pdf", help = "pattern of the file names")
+    parser.add_argument("--workers", type = int, default = 8, help = "number of concurrent uploads")
+    parser.add_argument("--block-size-mb", type = int, default = 4, help = "size of the uploaded blocks in MB")
+    parser.add_argument("--state-file", default = "", help = "journal of the uploaded files (default: .ingest-state.jsonl in the folder)")
+    parser.add_argument("--force", action = "store_true", help = "upload unchanged files as well")
+    args = parser.parse_args()
+
+    state = BlobIngestState(args.state_file if args.state_file != "" else os.path.join(args.source, ".ingest-state.jsonl"))
+    try:
+        bs = BlobStorage(transport = create_pooled_transport(args.workers))
+        ingest = BlobIngest(bs, state, args.workers, args.block_size_mb * 1024 * 1024, args.force)
+        stats = ingest.ingest(args.source, args.prefix, args.pattern, lambda s: print(format_stats(s), flush = True))
+    finally:
+        state.close()
+    for path, error in ingest.getFailures():
+        print("failed:", path, error)
+    print(format_stats(stats))
+    if stats["failed"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
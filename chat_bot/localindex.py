@@ -0,0 +1,417 @@
+import argparse, asyncio, bisect, fnmatch, hashlib, json, math, os, re, shutil, threading
+from typing import Union, List, Callable, Awaitable
+from urllib.parse import quote
+import numpy as np
+from .lrucache import LRUCache
+
+"""
+Environment variables used for the local index:
+CHATBOT_RETRIEVAL_BACKEND       Optional, 'azure' (the search index) or 'local' (a local index, see LocalIndexRetriever) (default: azure)
+CHATBOT_LOCAL_INDEX_PATH        Required for the local backend, directory of the index (see build_local_index)
+CHATBOT_LOCAL_INDEX_NPROBE      Optional, number of IVF lists searched per query, 0 searches all vectors (default: 8)
+
+Build an index from a folder of pdf files (the embeddings are created with OPENAI_EMBEDDING_DEPLOYMENT_NAME):
+    python -m chat_bot.localindex <pdf folder> <index folder> [--base-url https://<account>.blob.core.windows.net/documents] [--ivf-lists 0]
+"""
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+_ISMATCH_PATTERN = re.compile(r"""^search\.ismatch\('"(.*)"'\s*,\s*'metadata_storage_path'\)$""")
+
+
+def tokenize(text : str) -> List[str]:
+    return _TOKEN_PATTERN.findall(str(text).lower())
+
+
+def parse_path_filter(filter : str) -> List[str]:
+    """
+    Parses the filters of build_search_filter_from_role():
+    search.ismatch('"<pattern>"', 'metadata_storage_path'), combined with 'and'
+
+    :returns List[str], the (unescaped) patterns, all of them have to match
+    :raises ValueError: for other filter expressions
+    """
+    patterns = [ ]
+    for part in re.split(r'\s+and\s+', str(filter).strip()):
+        if part == "":
+            continue
+        m = _ISMATCH_PATTERN.match(part.strip())
+        if m is None:
+            raise ValueError("The local index only supports search.ismatch filters on metadata_storage_path: " + part)
+        patterns.append(re.sub(r'\\(.)', r'\1', m.group(1)))
+    return patterns
+
+
+class _StringColumn:
+    """
+    Memory mapped list of strings (utf-8 data and offsets), the strings are decoded on access
+    """
+    def __init__(self, path : str, name : str):
+        self._offsets = np.load(os.path.join(path, name + ".offsets.npy"), mmap_mode = "r")
+        dataPath = os.path.join(path, name + ".bin")
+        self._data = np.memmap(dataPath, dtype = np.uint8, mode = "r") if os.path.getsize(dataPath) > 0 else np.zeros(0, dtype = np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i : int) -> str:
+        return self._data[int(self._offsets[i]):int(self._offsets[i + 1])].tobytes().decode("utf-8")
+
+
+def _write_string_column(path : str, name : str, strings : List[str]):
+    data = [ str(s).encode("utf-8") for s in strings ]
+    offsets = np.zeros(len(data) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([ len(d) for d in data ])
+    np.save(os.path.join(path, name + ".offsets.npy"), offsets)
+    with open(os.path.join(path, name + ".bin"), "wb") as f:
+        f.write(b"".join(data))
+
+
+def _normalize_rows(vectors : np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    norms[norms == 0] = 1
+    return (vectors / norms).astype(np.float32)
+
+
+def _kmeans(vectors : np.ndarray, k : int, iterations : int = 10, seed : int = 0) -> np.ndarray:
+    # spherical k-means on a sample of the vectors (the centroids are unit vectors)
+    rnd = np.random.default_rng(seed)
+    sample = vectors[rnd.choice(len(vectors), min(len(vectors), 256 * k), replace = False)]
+    centroids = sample[rnd.choice(len(sample), k, replace = False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis = 1)
+        for c in range(k):
+            members = sample[assignment == c]
+            # empty lists get a random vector of the sample
+            centroids[c] = members.sum(axis = 0) if len(members) > 0 else sample[rnd.integers(len(sample))]
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+
+def build_local_index(path : str, documents : List[dict], vectors : np.ndarray, ivf_lists : int = 0, seed : int = 0):
+    """
+    Builds a local index (vectors, BM25 keyword index and optionally IVF lists), an existing index in path is replaced
+
+    :param path: str, directory of the index
+    :param documents: List[dict], chunks with content, title, url (metadata_storage_path) and filepath (chunk_id)
+    :param vectors: np.ndarray, embeddings of the chunks (one row per document)
+    :param ivf_lists: int, number of IVF lists (0 means no partitioning, every query compares all vectors)
+    :param seed: int, seed of the IVF clustering
+    """
+    vectors = np.asarray(vectors, dtype = np.float32)
+    if vectors.ndim != 2 or len(vectors) != len(documents):
+        raise ValueError("vectors must have one row per document")
+    if int(ivf_lists) < 0 or int(ivf_lists) > len(documents):
+        raise ValueError("ivf_lists must be between 0 and the number of documents")
+    path = os.path.abspath(path).rstrip(os.sep)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+    # the documents are sorted by path, so a path prefix filter is a range of rows
+    order = sorted(range(len(documents)), key = lambda i: (str(documents[i].get("url", "")), str(documents[i].get("filepath", ""))))
+    documents = [ documents[i] for i in order ]
+    vectors = _normalize_rows(vectors[order]) if len(order) > 0 else vectors
+    np.save(os.path.join(tmp, "vectors.npy"), vectors)
+    for name, field in [ ("paths", "url"), ("titles", "title"), ("chunk_ids", "filepath"), ("chunks", "content") ]:
+        _write_string_column(tmp, name, [ d.get(field, "") for d in documents ])
+    # BM25: postings (document, term frequency) per term, the terms are sorted
+    postings = { }
+    lengths = np.zeros(len(documents), dtype = np.float32)
+    for i, d in enumerate(documents):
+        tokens = tokenize(str(d.get("title", "")) + " " + str(d.get("content", "")))
+        lengths[i] = len(tokens)
+        counts = { }
+        for t in tokens:
+            counts[t] = counts.get(t, 0) + 1
+        for t, c in counts.items():
+            postings.setdefault(t, [ ]).append((i, c))
+    terms = sorted(postings.keys())
+    offsets = np.zeros(len(terms) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([ len(postings[t]) for t in terms ])
+    np.save(os.path.join(tmp, "postings_offsets.npy"), offsets)
+    np.save(os.path.join(tmp, "postings_docs.npy"), np.array([ p[0] for t in terms for p in postings[t] ], dtype = np.int32))
+    np.save(os.path.join(tmp, "postings_tf.npy"), np.array([ p[1] for t in terms for p in postings[t] ], dtype = np.float32))
+    np.save(os.path.join(tmp, "doc_lengths.npy"), lengths)
+    _write_string_column(tmp, "terms", terms)
+    if ivf_lists > 0:
+        centroids = _kmeans(vectors, int(ivf_lists), seed = seed)
+        assignment = np.concatenate([ np.argmax(vectors[i:i + 65536] @ centroids.T, axis = 1) for i in range(0, len(vectors), 65536) ])
+        ivfDocs = np.argsort(assignment, kind = "stable").astype(np.int32)
+        ivfOffsets = np.zeros(int(ivf_lists) + 1, dtype = np.int64)
+        ivfOffsets[1:] = np.cumsum(np.bincount(assignment, minlength = int(ivf_lists)))
+        np.save(os.path.join(tmp, "centroids.npy"), centroids)
+        np.save(os.path.join(tmp, "ivf_docs.npy"), ivfDocs)
+        np.save(os.path.join(tmp, "ivf_offsets.npy"), ivfOffsets)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({
+            "version": 1,
+            "count": len(documents),
+            "dimensions": int(vectors.shape[1]),
+            "ivf_lists": int(ivf_lists),
+            "avg_length": float(lengths.mean()) if len(lengths) > 0 else 0.0
+        }, f)
+    # replace the index (a running retriever keeps its mapped files until it reloads)
+    old = path + ".old"
+    shutil.rmtree(old, ignore_errors = True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors = True)
+
+
+class LocalVectorIndex:
+    """
+    Read-only local index built by build_local_index(): memory mapped vectors (brute force or IVF lists)
+    and a BM25 keyword index. Opening the index only maps the files, nothing is read until the first query.
+    """
+    k1 : float = 1.2
+    b : float = 0.75
+
+    def __init__(self, path : str):
+        """
+        Opens the index in path
+
+        :raises FileNotFoundError: if there is no index
+        """
+        self._path = str(path)
+        with open(os.path.join(self._path, "meta.json"), "r") as f:
+            self._meta = json.load(f)
+        self._vectors = np.load(os.path.join(self._path, "vectors.npy"), mmap_mode = "r")
+        self._paths = _StringColumn(self._path, "paths")
+        self._titles = _StringColumn(self._path, "titles")
+        self._chunk_ids = _StringColumn(self._path, "chunk_ids")
+        self._chunks = _StringColumn(self._path, "chunks")
+        self._terms = _StringColumn(self._path, "terms")
+        self._postings_offsets = np.load(os.path.join(self._path, "postings_offsets.npy"), mmap_mode = "r")
+        self._postings_docs = np.load(os.path.join(self._path, "postings_docs.npy"), mmap_mode = "r")
+        self._postings_tf = np.load(os.path.join(self._path, "postings_tf.npy"), mmap_mode = "r")
+        self._doc_lengths = np.load(os.path.join(self._path, "doc_lengths.npy"), mmap_mode = "r")
+        self._centroids = None
+        if self._meta["ivf_lists"] > 0:
+            self._centroids = np.load(os.path.join(self._path, "centroids.npy"), mmap_mode = "r")
+            self._ivf_docs = np.load(os.path.join(self._path, "ivf_docs.npy"), mmap_mode = "r")
+            self._ivf_offsets = np.load(os.path.join(self._path, "ivf_offsets.npy"), mmap_mode = "r")
+        # masks of filters that are not a path prefix
+        self._pattern_masks = LRUCache(100)
+
+    def getCount(self) -> int:
+        return int(self._meta["count"])
+    def getDimensions(self) -> int:
+        return int(self._meta["dimensions"])
+    def getIvfLists(self) -> int:
+        return int(self._meta["ivf_lists"])
+
+    def getDocument(self, i : int) -> dict:
+        return {
+            "content": self._chunks[i],
+            "title": self._titles[i],
+            "url": self._paths[i],
+            "filepath": self._chunk_ids[i]
+        }
+
+    def _getPatternMask(self, pattern : str) -> np.ndarray:
+        mask = self._pattern_masks.get(pattern)
+        if mask is None:
+            mask = np.array([ fnmatch.fnmatchcase(self._paths[i], pattern) for i in range(self.getCount()) ], dtype = bool)
+            self._pattern_masks.set(pattern, mask)
+        return mask
+
+    def getCandidates(self, filter : str = "") -> Union[None, slice, np.ndarray]:
+        """
+        Returns the rows allowed by the filter: None (all rows), a slice (path prefix) or an array of rows
+
+        :raises ValueError: if the filter is not supported (see parse_path_filter)
+        """
+        lo, hi = 0, self.getCount()
+        mask = None
+        for pattern in parse_path_filter(filter):
+            prefix = pattern[:-1] if pattern.endswith("*") else None
+            if prefix is not None and not any(c in prefix for c in "*?["):
+                # the paths are sorted, the rows of a prefix are a range
+                lo = max(lo, bisect.bisect_left(self._paths, prefix, lo, hi))
+                hi = min(hi, bisect.bisect_left(self._paths, prefix + "\U0010ffff", lo, hi))
+            else:
+                mask = self._getPatternMask(pattern) if mask is None else (mask & self._getPatternMask(pattern))
+        if mask is not None:
+            return lo + np.flatnonzero(mask[lo:hi])
+        if lo == 0 and hi == self.getCount():
+            return None
+        return slice(lo, max(lo, hi))
+
+    @staticmethod
+    def _top(ids : np.ndarray, scores : np.ndarray, top_n : int) -> List[int]:
+        if len(ids) > top_n:
+            best = np.argpartition(-scores, top_n)[:top_n]
+            ids, scores = ids[best], scores[best]
+        return [ int(i) for i in ids[np.argsort(-scores, kind = "stable")] ]
+
+    def searchVectors(self, vector : Union[list, np.ndarray], top_n : int = 5, candidates : Union[None, slice, np.ndarray] = None, nprobe : int = 0) -> List[int]:
+        """
+        Returns the rows of the top_n most similar vectors (cosine similarity)
+
+        :param nprobe: int, number of IVF lists to search (0 or an index without IVF lists compares all candidates)
+        """
+        q = np.asarray(vector, dtype = np.float32)
+        q = q / (np.linalg.norm(q) or 1)
+        if self._centroids is not None and 0 < nprobe < self.getIvfLists():
+            lists = np.argpartition(-(self._centroids @ q), nprobe)[:nprobe]
+            ids = np.sort(np.concatenate([ self._ivf_docs[self._ivf_offsets[l]:self._ivf_offsets[l + 1]] for l in lists ]))
+            if isinstance(candidates, slice):
+                ids = ids[(ids >= candidates.start) & (ids < candidates.stop)]
+            elif candidates is not None:
+                ids = ids[np.isin(ids, candidates, assume_unique = True)]
+            return self._top(ids, self._vectors[ids] @ q, top_n)
+        if candidates is None:
+            candidates = slice(0, self.getCount())
+        if isinstance(candidates, slice):
+            return self._top(np.arange(candidates.start, candidates.stop), self._vectors[candidates] @ q, top_n)
+        return self._top(candidates, self._vectors[candidates] @ q, top_n)
+
+    def searchKeywords(self, query : str, top_n : int = 5, candidates : Union[None, slice, np.ndarray] = None) -> List[int]:
+        """
+        Returns the rows of the top_n documents by BM25 score (documents without any term of the query are not returned)
+        """
+        count = self.getCount()
+        scores = np.zeros(count, dtype = np.float32)
+        avgLength = self._meta["avg_length"] or 1
+        for term in set(tokenize(query)):
+            t = bisect.bisect_left(self._terms, term)
+            if t >= len(self._terms) or self._terms[t] != term:
+                continue
+            start, end = int(self._postings_offsets[t]), int(self._postings_offsets[t + 1])
+            docs = self._postings_docs[start:end]
+            tf = self._postings_tf[start:end]
+            idf = math.log(1 + (count - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self._doc_lengths[docs] / avgLength))
+        if isinstance(candidates, slice):
+            ids = np.arange(candidates.start, candidates.stop)
+        elif candidates is not None:
+            ids = np.asarray(candidates)
+        else:
+            ids = np.arange(count)
+        ids = ids[scores[ids] > 0]
+        return self._top(ids, scores[ids], top_n)
+
+    def search(self, query : str, vector : Union[None, list, np.ndarray] = None, top_n : int = 5, filter : str = "", nprobe : int = 0, rank_window : int = 50) -> List[int]:
+        """
+        Hybrid search: the keyword and the vector results are merged by reciprocal rank fusion (like the hybrid search of azure search)
+
+        :param query: str
+        :param vector: embedding of the query, optional (keyword search only without)
+        :param top_n: int
+        :param filter: str, path filter (see parse_path_filter)
+        :param nprobe: int, number of IVF lists to search
+        :param rank_window: int, number of results of each search that are merged
+        :returns List[int], rows of the documents
+        """
+        candidates = self.getCandidates(filter)
+        window = max(int(top_n), int(rank_window))
+        rankings = [ self.searchKeywords(query, window, candidates) ]
+        if vector is not None:
+            rankings.append(self.searchVectors(vector, window, candidates, nprobe))
+        fused = { }
+        for ranking in rankings:
+            for rank, i in enumerate(ranking):
+                fused[i] = fused.get(i, 0) + 1 / (60 + rank + 1)
+        return [ i for i, _ in sorted(fused.items(), key = lambda x: -x[1])[:int(top_n)] ]
+
+
+class LocalIndexRetriever:
+    """
+    Retrieval backend on top of a LocalVectorIndex, with the interface of AzureSearchRetriever.
+    The index is reopened when it was rebuilt (the modification time of meta.json changed).
+    """
+    _path : str
+    _nprobe : int = 8
+    _index : Union[None, LocalVectorIndex] = None
+    _loaded_mtime : float = 0
+
+    def __init__(self, path : str, nprobe : int = 8):
+        """
+        Create a new LocalIndexRetriever
+
+        :param path: str, directory of the index (see build_local_index)
+        :param nprobe: int, number of IVF lists searched per query (0 searches all vectors)
+        """
+        self._path = str(path)
+        self._nprobe = int(nprobe)
+        self._index = None
+        self._loaded_mtime = 0
+        self._lock = threading.Lock()
+
+    def getIndex(self) -> LocalVectorIndex:
+        mtime = os.path.getmtime(os.path.join(self._path, "meta.json"))
+        if self._index is None or mtime != self._loaded_mtime:
+            with self._lock:
+                if self._index is None or mtime != self._loaded_mtime:
+                    self._index = LocalVectorIndex(self._path)
+                    self._loaded_mtime = mtime
+        return self._index
+
+    def getIndexVersion(self) -> str:
+        index = self.getIndex()
+        return str(index.getCount()) + "-" + str(self._loaded_mtime)
+
+    def clearCache(self):
+        pass
+
+    def _search(self, query : str, filter : str, top_n : int, vector : Union[None, np.ndarray]) -> List[dict]:
+        index = self.getIndex()
+        return [ index.getDocument(i) for i in index.search(query, vector, top_n, filter, self._nprobe) ]
+
+    def search(self, query : str, filter : str = "", top_n : int = 5, embed : Union[None, Callable[[str], list]] = None) -> List[dict]:
+        """
+        Returns the top_n chunks for the query (same format as AzureSearchRetriever.search())
+
+        :raises ValueError: if the filter is not supported
+        """
+        return self._search(query, str(filter), int(top_n), None if embed is None else embed(query))
+
+    async def asearch(self, query : str, filter : str = "", top_n : int = 5, embed : Union[None, Callable[[str], Awaitable[list]]] = None) -> List[dict]:
+        vector = None if embed is None else await embed(query)
+        return await asyncio.to_thread(self._search, query, str(filter), int(top_n), vector)
+
+
+def chunk_text(text : str, chunk_size : int = 2000, overlap : int = 500) -> List[str]:
+    """
+    Splits a text into overlapping chunks (like the split skill of the search indexer)
+    """
+    text = str(text)
+    if len(text) <= chunk_size:
+        return [ text ] if text.strip() != "" else [ ]
+    step = max(1, chunk_size - overlap)
+    return [ text[i:i + chunk_size] for i in range(0, max(1, len(text) - overlap), step) if text[i:i + chunk_size].strip() != "" ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Builds a local index from a folder of pdf files")
+    parser.add_argument("source", help = "folder with the pdf files")
+    parser.add_argument("index", help = "folder of the index")
+    parser.add_argument("--base-url", default = "", help = "url of the storage container the files are uploaded to (used as metadata_storage_path)")
+    parser.add_argument("--ivf-lists", type = int, default = 0, help = "number of IVF lists, 0 disables the partitioning")
+    args = parser.parse_args()
+
+    from pypdf import PdfReader
+    from .easy_chat import EasyChatClient
+    documents = [ ]
+    for root, _, files in os.walk(args.source):
+        for name in sorted(files):
+            if not name.lower().endswith(".pdf"):
+                continue
+            relative = os.path.relpath(os.path.join(root, name), args.source).replace(os.sep, "/")
+            url = args.base_url.rstrip("/") + "/" + quote(relative)
+            text = "\n".join(page.extract_text() or "" for page in PdfReader(os.path.join(root, name)).pages)
+            parent = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+            for i, chunk in enumerate(chunk_text(text)):
+                documents.append({ "content": chunk, "title": name, "url": url, "filepath": parent + "_pages_" + str(i) })
+            print(relative, "chunks:", len([ d for d in documents if d["url"] == url ]))
+    if len(documents) == 0:
+        print("No pdf files found")
+        return
+    service = EasyChatClient().getEmbeddingService()
+    vectors = np.stack(service.embedMany([ d["content"] for d in documents ]))
+    build_local_index(args.index, documents, vectors, args.ivf_lists)
+    print("Index with", len(documents), "chunks written to", args.index)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import threading, time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Tuple
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time to live for the entries
+    """
+    _max_entries : int
+    _ttl : float
+    _entries : OrderedDict
+    _lock : threading.Lock
+
+    def __init__(self, max_entries : int = 1000, ttl : float = 0):
+        """
+        Create a new LRUCache
+
+        :param max_entries: int, max. number of entries, the least recently used entries are evicted first
+        :param ttl: float, seconds an entry is valid (0 means no expiry)
+        """
+        if int(max_entries) < 1:
+            raise ValueError("max_entries must be greater than 0")
+        self._max_entries = int(max_entries)
+        self._ttl = float(ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _isExpired(self, storedAt : float) -> bool:
+        return self._ttl > 0 and time.monotonic() - storedAt > self._ttl
+
+    def get(self, key : Hashable, default : Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if self._isExpired(entry[0]):
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key : Hashable, value : Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last = False)
+
+    def delete(self, key : Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """
+        Returns a snapshot of all entries that are not expired (does not change the LRU order)
+        """
+        with self._lock:
+            return [ (k, v[1]) for k, v in self._entries.items() if not self._isExpired(v[0]) ]
+
+    def __len__(self) -> int:
+        return len(self._entries)
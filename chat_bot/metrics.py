@@ -0,0 +1,330 @@
+import os, json, threading, time, bisect, tempfile, atexit
+from contextlib import contextmanager
+from typing import Union, Dict, Tuple, List
+
+"""
+Environment variables used for the metrics:
+CHATBOT_METRICS_DIR             Optional, directory shared by the worker processes of a host: every process writes its metrics there
+                                and /metrics reports the sum of all processes (default: not set, /metrics reports the serving process only)
+CHATBOT_METRICS_WRITE_INTERVAL  Optional, seconds between the writes of the metrics of a process to CHATBOT_METRICS_DIR (default: 5)
+"""
+
+
+class Counter:
+    """
+    Thread-safe, monotonically increasing counter with optional labels
+    """
+    _name : str
+    _description : str
+    _values : Dict[Tuple, float]
+    _lock : threading.Lock
+
+    def __init__(self, name : str, description : str = ""):
+        self._name = str(name)
+        self._description = str(description)
+        self._values = { }
+        self._lock = threading.Lock()
+
+    def getName(self) -> str:
+        return self._name
+    def getDescription(self) -> str:
+        return self._description
+
+    def inc(self, amount : Union[int, float] = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def getAll(self) -> Dict[Tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    """
+    Thread-safe histogram with cumulative buckets and optional labels (rendered like a prometheus histogram)
+    """
+    _name : str
+    _description : str
+    _buckets : List[float]
+    _values : Dict[Tuple, list]
+    _lock : threading.Lock
+
+    def __init__(self, name : str, description : str = "", buckets : List[float] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self._name = str(name)
+        self._description = str(description)
+        self._buckets = sorted(float(b) for b in buckets)
+        self._values = { }
+        self._lock = threading.Lock()
+
+    def getName(self) -> str:
+        return self._name
+    def getDescription(self) -> str:
+        return self._description
+    def getBuckets(self) -> List[float]:
+        return list(self._buckets)
+
+    def observe(self, value : Union[int, float], **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            if key not in self._values:
+                # bucket counts (the last one is +Inf), sum
+                self._values[key] = [ [ 0 ] * (len(self._buckets) + 1), 0 ]
+            self._values[key][0][i] += 1
+            self._values[key][1] += value
+
+    def getCount(self, **labels) -> int:
+        v = self._values.get(tuple(sorted(labels.items())))
+        return 0 if v is None else sum(v[0])
+
+    def getAll(self) -> Dict[Tuple, Tuple[List[int], float]]:
+        """
+        Returns the (non cumulative) bucket counts and the sum per label set
+        """
+        with self._lock:
+            return { k: (list(v[0]), v[1]) for k, v in self._values.items() }
+
+
+_all_metrics : Dict[str, Union[Counter, Histogram]] = { }
+_all_metrics_lock = threading.Lock()
+
+def get_counter(name : str, description : str = "") -> Counter:
+    """
+    Returns the process wide counter with the given name (created on first use)
+    """
+    _start_writer()
+    with _all_metrics_lock:
+        if name not in _all_metrics:
+            _all_metrics[name] = Counter(name, description)
+        return _all_metrics[name]
+
+def get_histogram(name : str, description : str = "", buckets : Union[None, List[float]] = None) -> Histogram:
+    """
+    Returns the process wide histogram with the given name (created on first use)
+    """
+    _start_writer()
+    with _all_metrics_lock:
+        if name not in _all_metrics:
+            _all_metrics[name] = Histogram(name, description) if buckets is None else Histogram(name, description, buckets)
+        return _all_metrics[name]
+
+def get_all_metrics() -> Dict[str, Union[Counter, Histogram]]:
+    with _all_metrics_lock:
+        return dict(_all_metrics)
+
+
+def _format_labels(labels : Tuple, extra : Union[None, Tuple] = None) -> str:
+    labels = list(labels) + ([ extra ] if extra is not None else [ ])
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(str(k) + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels) + "}"
+
+def _format_value(value : float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+def _snapshot() -> dict:
+    # the metrics of this process: name -> { type, description, buckets, values: labels -> value or [ counts, sum ] }
+    data = { }
+    for name, metric in get_all_metrics().items():
+        if isinstance(metric, Histogram):
+            data[name] = { "type": "histogram", "description": metric.getDescription(), "buckets": metric.getBuckets(),
+                           "values": { labels: [ counts, total ] for labels, (counts, total) in metric.getAll().items() } }
+        else:
+            data[name] = { "type": "counter", "description": metric.getDescription(), "values": metric.getAll() }
+    return data
+
+
+def get_metrics_directory() -> str:
+    return os.getenv("CHATBOT_METRICS_DIR", "")
+
+
+_writer_pid : Union[None, int] = None
+_writer_file : str = ""
+_writer_lock = threading.Lock()
+
+def _start_writer():
+    """
+    Starts the thread that writes the metrics of this process to CHATBOT_METRICS_DIR (once per process, also after a fork)
+    """
+    global _writer_pid, _writer_file
+    if _writer_pid == os.getpid() or get_metrics_directory() == "":
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+        # unique per process, the file of a stopped worker is kept, so the sums never go backwards
+        _writer_file = "metrics-" + str(os.getpid()) + "-" + str(time.time_ns()) + ".json"
+    interval = float(os.getenv("CHATBOT_METRICS_WRITE_INTERVAL", "5"))
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_process_metrics()
+            except Exception as e:
+                print("Metrics not written:", str(e))
+    threading.Thread(target = run, name = "chatbot-metrics-writer", daemon = True).start()
+    atexit.register(write_process_metrics)
+
+
+if hasattr(os, "register_at_fork"):
+    # a forked worker writes its own file
+    os.register_at_fork(after_in_child = _start_writer)
+
+
+def write_process_metrics():
+    """
+    Writes the metrics of this process to CHATBOT_METRICS_DIR (see render_prometheus())
+    """
+    directory = get_metrics_directory()
+    if directory == "" or _writer_pid != os.getpid():
+        return
+    os.makedirs(directory, exist_ok = True)
+    data = { }
+    for name, metric in _snapshot().items():
+        metric["values"] = [ [ [ list(l) for l in labels ], value ] for labels, value in metric["values"].items() ]
+        data[name] = metric
+    fd, tmpPath = tempfile.mkstemp(dir = directory, prefix = ".metrics-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmpPath, os.path.join(directory, _writer_file))
+    except:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+
+
+def _merge(merged : dict, data : dict):
+    for name, metric in data.items():
+        target = merged.setdefault(name, { "type": metric["type"], "description": metric["description"], "buckets": metric.get("buckets"), "values": { } })
+        if target["type"] != metric["type"] or target.get("buckets") != metric.get("buckets"):
+            # changed definition (f.e. during a deployment), the first one wins
+            continue
+        for labels, value in metric["values"]:
+            labels = tuple(tuple(l) for l in labels)
+            if metric["type"] == "histogram":
+                current = target["values"].get(labels)
+                if current is None:
+                    target["values"][labels] = [ list(value[0]), value[1] ]
+                else:
+                    current[0] = [ a + b for a, b in zip(current[0], value[0]) ]
+                    current[1] += value[1]
+            else:
+                target["values"][labels] = target["values"].get(labels, 0) + value
+
+
+def _collect() -> dict:
+    directory = get_metrics_directory()
+    if directory == "" or _writer_pid != os.getpid():
+        return _snapshot()
+    # the current values of this process, the others are at most CHATBOT_METRICS_WRITE_INTERVAL seconds old
+    write_process_metrics()
+    merged = { }
+    for fileName in sorted(os.listdir(directory)):
+        if not fileName.startswith("metrics-") or not fileName.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, fileName), "r") as f:
+                _merge(merged, json.load(f))
+        except (OSError, ValueError):
+            pass
+    return merged
+
+
+def render_prometheus() -> str:
+    """
+    Renders all metrics of this process (or the sum of all processes, see CHATBOT_METRICS_DIR) in the prometheus text format
+    """
+    lines = [ ]
+    for name, metric in sorted(_collect().items()):
+        if metric["description"] != "":
+            lines.append("# HELP " + name + " " + metric["description"])
+        if metric["type"] == "histogram":
+            lines.append("# TYPE " + name + " histogram")
+            for labels, (counts, total) in sorted(metric["values"].items()):
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + [ "+Inf" ], counts):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _format_value(bound)
+                    lines.append(name + "_bucket" + _format_labels(labels, ("le", le)) + " " + str(cumulative))
+                lines.append(name + "_sum" + _format_labels(labels) + " " + _format_value(total))
+                lines.append(name + "_count" + _format_labels(labels) + " " + str(cumulative))
+        else:
+            lines.append("# TYPE " + name + " counter")
+            for labels, value in sorted(metric["values"].items()):
+                lines.append(name + _format_labels(labels) + " " + _format_value(value))
+    return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """
+    Durations of the stages of one request (f.e. auth, setup, ttft).
+    finish() adds them to the chat_stage_duration_seconds histogram, labeled with the labels of the request (f.e. role, deployment).
+    """
+    _stages : Dict[str, float]
+    _labels : Dict[str, str]
+    _tokens_per_second : Union[None, float] = None
+    _finished : bool = False
+
+    def __init__(self, **labels):
+        self._stages = { }
+        self._labels = { k: str(v) for k, v in labels.items() }
+        self._tokens_per_second = None
+        self._finished = False
+
+    def setLabel(self, name : str, value : str):
+        self._labels[str(name)] = str(value)
+    def getLabels(self) -> Dict[str, str]:
+        return dict(self._labels)
+
+    def add(self, stage : str, seconds : float):
+        self._stages[stage] = self._stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def measure(self, stage : str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def setTokensPerSecond(self, value : float):
+        self._tokens_per_second = float(value)
+    def getTokensPerSecond(self) -> Union[None, float]:
+        return self._tokens_per_second
+
+    def getAll(self) -> Dict[str, float]:
+        """
+        Returns the durations in milliseconds
+        """
+        return { k: round(v * 1000, 1) for k, v in self._stages.items() }
+
+    def toServerTiming(self) -> str:
+        """
+        Returns the value of the Server-Timing header
+        """
+        return ", ".join(k + ";dur=" + str(v) for k, v in self.getAll().items())
+
+    def finish(self):
+        """
+        Adds the timings to the histograms (only once)
+        """
+        if self._finished:
+            return
+        self._finished = True
+        stages = get_histogram("chat_stage_duration_seconds", "Duration of the stages of the chat requests")
+        for stage, seconds in self._stages.items():
+            stages.observe(seconds, stage = stage, **self._labels)
+        if self._tokens_per_second is not None:
+            get_histogram(
+                "chat_tokens_per_second",
+                "Token generation speed of the streamed answers",
+                [ 1, 5, 10, 20, 30, 50, 75, 100, 150, 200 ]
+            ).observe(self._tokens_per_second, **self._labels)
@@ -0,0 +1,141 @@
+import os, threading, time
+from typing import Union, Any
+from .metrics import get_counter, get_histogram
+
+"""
+Environment variables used for the http connections to azure openai (next to OPENAI_API_BASE, used by all openai clients of a worker process):
+OPENAI_HTTP_MAX_CONNECTIONS             Optional, max. number of connections per worker process (default: 100)
+OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS   Optional, max. number of idle connections kept open (default: 20)
+OPENAI_HTTP_KEEPALIVE_EXPIRY            Optional, seconds an idle connection is kept open (default: 30)
+OPENAI_HTTP_CONNECT_TIMEOUT             Optional, seconds to open a connection (default: 5)
+OPENAI_HTTP_READ_TIMEOUT                Optional, seconds to wait for the next data of a response, f.e. the first token (default: 600)
+OPENAI_HTTP_POOL_TIMEOUT                Optional, seconds a request waits for a free connection when all connections are busy (default: 30)
+OPENAI_HTTP2                            Optional, use HTTP/2 (many concurrent requests over few connections), requires the h2 package (default: false)
+The clients are built on the http package of the installed openai sdk (httpx2 or httpx).
+"""
+
+
+_pool_wait = get_histogram(
+    "openai_http_pool_wait_seconds",
+    "Time a request to azure openai waited for a connection of the pool (a new connection is counted until it starts to connect)",
+    [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30 ]
+)
+_requests = get_counter("openai_http_requests_total", "Number of requests to azure openai by connection (new or reused)")
+
+
+class _PoolWaitTrace:
+    """
+    Trace callback of a request (httpcore trace extension): measures the time until the request got a connection,
+    that is until a new connection starts to connect or the request headers are sent over a reused connection
+    """
+    __slots__ = ("_start", "_host", "_done")
+
+    def __init__(self, host : str):
+        self._start = time.perf_counter()
+        self._host = host
+        self._done = False
+
+    def _event(self, name : str):
+        if self._done:
+            return
+        if name.startswith("connection.connect_"):
+            connection = "new"
+        elif name.endswith(".send_request_headers.started"):
+            connection = "reused"
+        else:
+            return
+        self._done = True
+        _pool_wait.observe(time.perf_counter() - self._start, host = self._host)
+        _requests.inc(host = self._host, connection = connection)
+
+    def trace(self, name : str, info : dict):
+        self._event(name)
+
+    async def traceAsync(self, name : str, info : dict):
+        self._event(name)
+
+
+def _trace_request(request):
+    # called by httpx for every request (and every retry) before it is sent
+    request.extensions["trace"] = _PoolWaitTrace(request.url.host).trace
+
+async def _trace_request_async(request):
+    request.extensions["trace"] = _PoolWaitTrace(request.url.host).traceAsync
+
+
+def _use_http2() -> bool:
+    if str(os.getenv("OPENAI_HTTP2", "false")).lower() not in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+        return False
+    try:
+        import h2
+    except ImportError:
+        print("OPENAI_HTTP2 is enabled, but the h2 package is not installed (pip install h2), using HTTP/1.1")
+        return False
+    return True
+
+
+def _get_http_package() -> tuple:
+    """
+    Returns the http package the openai sdk uses and its client factories (the sdk only accepts clients of its own package)
+
+    :returns (module, sync client factory, async client factory)
+    :raises ImportError: if the package is not installed
+    """
+    import openai
+    if hasattr(openai, "DefaultHttpx2Client"):
+        import httpx2
+        return httpx2, openai.DefaultHttpx2Client, openai.DefaultAsyncHttpx2Client
+    import httpx
+    return httpx, openai.DefaultHttpxClient, openai.DefaultAsyncHttpxClient
+
+
+def create_openai_http_client(asynchronous : bool = False) -> Union[None, Any]:
+    """
+    Creates the http client for the openai clients with the pool limits, timeouts and protocol of the environment variables
+    and the pool wait metrics (openai_http_pool_wait_seconds)
+
+    :param asynchronous: bool, create an AsyncClient (for AsyncAzureOpenAI) instead of a Client
+    :returns httpx2 (or httpx) Client or AsyncClient, None if it can not be created (the openai clients use their default client)
+    """
+    try:
+        httpx, DefaultHttpxClient, DefaultAsyncHttpxClient = _get_http_package()
+    except ImportError as e:
+        print("The shared openai http client is not used, the OPENAI_HTTP_* settings are ignored:", str(e))
+        return None
+    settings = {
+        "limits": httpx.Limits(
+            max_connections = int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections = int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry = float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", "30"))
+        ),
+        "timeout": httpx.Timeout(
+            float(os.getenv("OPENAI_HTTP_READ_TIMEOUT", "600")),
+            connect = float(os.getenv("OPENAI_HTTP_CONNECT_TIMEOUT", "5")),
+            pool = float(os.getenv("OPENAI_HTTP_POOL_TIMEOUT", "30"))
+        ),
+        "http2": _use_http2()
+    }
+    if asynchronous:
+        return DefaultAsyncHttpxClient(event_hooks = { "request": [ _trace_request_async ] }, **settings)
+    return DefaultHttpxClient(event_hooks = { "request": [ _trace_request ] }, **settings)
+
+
+_shared_http_clients : dict = { }
+_shared_http_clients_lock = threading.Lock()
+
+def get_shared_openai_http_client(asynchronous : bool = False) -> Union[None, Any]:
+    """
+    Returns the http client of this worker process that all openai clients (all backends) share (created on first use),
+    so the connections and their limits are shared by all threads and the backends.
+    The async client belongs to the event loop of the worker (the asgi app runs a single loop per worker).
+
+    :param asynchronous: bool, the client for AsyncAzureOpenAI
+    :returns Client, AsyncClient or None (see create_openai_http_client)
+    """
+    key = bool(asynchronous)
+    if key in _shared_http_clients:
+        return _shared_http_clients[key]
+    with _shared_http_clients_lock:
+        if key not in _shared_http_clients:
+            _shared_http_clients[key] = create_openai_http_client(key)
+    return _shared_http_clients[key]
@@ -0,0 +1,362 @@
+import os, json, random, threading, time
+from typing import Union, List, Any, Callable
+from openai import AzureOpenAI, AsyncAzureOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from azure.identity import get_bearer_token_provider
+from .azurecredential import get_default_credential
+from .openaihttp import get_shared_openai_http_client
+from .metrics import get_counter
+
+"""
+Environment variables used for the OpenAI backend pool:
+OPENAI_BACKENDS                     Optional, JSON list of deployments to balance the chat completions over, f.e.
+                                    [{"endpoint": "https://a.openai.azure.com", "deployment": "gpt-4o", "api_key": "...", "weight": 2, "priority": 0}, ...]
+                                    "deployment" defaults to OPENAI_DEPLOYMENT_NAME, without "api_key" the default credential is used,
+                                    lower priorities are preferred, "weight" is the relative capacity within a priority (default: 1)
+OPENAI_BACKEND_FAILURE_COOLDOWN     Optional, seconds a backend is skipped after a connection or server error (default: 10)
+OPENAI_BACKEND_DEFAULT_RETRY_AFTER  Optional, seconds a backend is skipped after a 429 without retry-after header (default: 10)
+"""
+
+
+class OpenAIBackend:
+    """
+    One deployment of the pool, with its load, circuit breaker state and stats
+    """
+    _name : str
+    _client : Any
+    _deployment_name : str
+    _weight : float = 1
+    _priority : int = 0
+    _in_flight : int = 0
+    _blocked_until : float = 0
+    _latency : Union[None, float] = None
+
+    def __init__(self, name : str, client : Any, deployment_name : str, weight : float = 1, priority : int = 0):
+        if float(weight) <= 0:
+            raise ValueError("weight must be greater than 0")
+        self._name = str(name)
+        self._client = client
+        self._deployment_name = str(deployment_name)
+        self._weight = float(weight)
+        self._priority = int(priority)
+        self._in_flight = 0
+        self._blocked_until = 0
+        self._latency = None
+        self._requests = get_counter("openai_backend_requests_total", "Number of chat completions sent to an openai backend")
+        self._throttled = get_counter("openai_backend_throttled_total", "Number of chat completions an openai backend rejected with 429")
+        self._errors = get_counter("openai_backend_errors_total", "Number of chat completions that failed with a connection or server error")
+        self._latency_total = get_counter("openai_backend_latency_seconds_total", "Time until the first token (or the full answer) of an openai backend")
+
+    def getName(self) -> str:
+        return self._name
+    def getClient(self) -> Any:
+        return self._client
+    def getDeploymentName(self) -> str:
+        return self._deployment_name
+    def getWeight(self) -> float:
+        return self._weight
+    def getPriority(self) -> int:
+        return self._priority
+    def getInFlight(self) -> int:
+        return self._in_flight
+    def getBlockedUntil(self) -> float:
+        return self._blocked_until
+
+    def isAvailable(self, now : float) -> bool:
+        return self._blocked_until <= now
+
+    def getLoad(self) -> float:
+        return (self._in_flight + 1) / self._weight
+
+    def getStats(self) -> dict:
+        return {
+            "name": self._name,
+            "deployment": self._deployment_name,
+            "priority": self._priority,
+            "weight": self._weight,
+            "in_flight": self._in_flight,
+            "blocked_for": max(0, self._blocked_until - time.monotonic()),
+            "latency": self._latency,
+            "requests": self._requests.get(backend = self._name),
+            "throttled": self._throttled.get(backend = self._name),
+            "errors": self._errors.get(backend = self._name)
+        }
+
+
+class _BackendStream:
+    """
+    Stream of a backend whose first chunk was already received (the backend is released when the stream ends or is closed)
+    """
+    _empty = object()
+
+    def __init__(self, stream, first, release):
+        self._stream = stream
+        self._first = first
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not self._empty:
+            item, self._first = self._first, self._empty
+            return item
+        try:
+            return next(self._stream)
+        except BaseException:
+            self._release()
+            raise
+
+    def close(self):
+        self._release()
+        self._stream.close()
+
+
+class _AsyncBackendStream:
+    """
+    asyncio variant of _BackendStream
+    """
+    _empty = object()
+
+    def __init__(self, stream, first, release):
+        self._stream = stream
+        self._first = first
+        self._release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not self._empty:
+            item, self._first = self._first, self._empty
+            return item
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self._release()
+            raise
+
+    async def close(self):
+        self._release()
+        await self._stream.close()
+
+
+class OpenAIBackendPool:
+    """
+    Balances chat completions over several deployments.
+    Every call goes to the least loaded available backend of the best priority.
+    A backend that answers with 429 is skipped until its retry-after has passed, a backend with a connection or server error for a cooldown period.
+    Failed calls are retried on the next backend, as long as no token was received (streams are checked up to the first chunk).
+    """
+    _backends : List[OpenAIBackend]
+    _failure_cooldown : float = 10
+    _default_retry_after : float = 10
+    _lock : threading.Lock
+
+    def __init__(self, backends : List[OpenAIBackend], failure_cooldown : float = 10, default_retry_after : float = 10):
+        """
+        Create a new OpenAIBackendPool
+
+        :param backends: List[OpenAIBackend], the clients should not retry on their own (max_retries = 0)
+        :param failure_cooldown: float, seconds a backend is skipped after a connection or server error
+        :param default_retry_after: float, seconds a backend is skipped after a 429 without retry-after header
+        :raises ValueError: if there is no backend
+        """
+        if len(backends) == 0:
+            raise ValueError("At least one backend is required")
+        self._backends = list(backends)
+        self._failure_cooldown = float(failure_cooldown)
+        self._default_retry_after = float(default_retry_after)
+        self._lock = threading.Lock()
+        self._failovers = get_counter("openai_backend_failovers_total", "Number of chat completions retried on another openai backend")
+
+    def getBackends(self) -> List[OpenAIBackend]:
+        return list(self._backends)
+
+    def getStats(self) -> List[dict]:
+        return [ b.getStats() for b in self._backends ]
+
+    def _acquire(self, exclude : List[OpenAIBackend]) -> Union[None, OpenAIBackend]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ b for b in self._backends if b not in exclude ]
+            if len(candidates) == 0:
+                return None
+            available = [ b for b in candidates if b.isAvailable(now) ]
+            if len(available) == 0:
+                if len(exclude) > 0:
+                    return None
+                # all backends are blocked, try the one that gets available first
+                available = [ min(candidates, key = lambda b: b.getBlockedUntil()) ]
+            priority = min(b.getPriority() for b in available)
+            available = [ b for b in available if b.getPriority() == priority ]
+            random.shuffle(available)
+            backend = min(available, key = lambda b: b.getLoad())
+            backend._in_flight += 1
+        backend._requests.inc(backend = backend.getName())
+        return backend
+
+    def _releaser(self, backend : OpenAIBackend):
+        released = [ False ]
+        def release():
+            with self._lock:
+                if not released[0]:
+                    released[0] = True
+                    backend._in_flight -= 1
+        return release
+
+    def _recordLatency(self, backend : OpenAIBackend, seconds : float):
+        backend._latency_total.inc(seconds, backend = backend.getName())
+        with self._lock:
+            backend._latency = seconds if backend._latency is None else 0.8 * backend._latency + 0.2 * seconds
+
+    def _retryAfter(self, error : RateLimitError) -> float:
+        headers = error.response.headers if error.response is not None else { }
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers.get("retry-after-ms")) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers.get("retry-after"))
+        except ValueError:
+            pass
+        return self._default_retry_after
+
+    def _handleError(self, backend : OpenAIBackend, error : Exception) -> bool:
+        """
+        Updates the circuit breaker of the backend, returns True if the call can be retried on another backend
+        """
+        if isinstance(error, RateLimitError):
+            backend._throttled.inc(backend = backend.getName())
+            blockedFor = self._retryAfter(error)
+        elif isinstance(error, (APIConnectionError, InternalServerError)):
+            backend._errors.inc(backend = backend.getName())
+            blockedFor = self._failure_cooldown
+        else:
+            return False
+        with self._lock:
+            backend._blocked_until = max(backend._blocked_until, time.monotonic() + blockedFor)
+        return True
+
+    def create(self, served_by : Union[None, Callable[[OpenAIBackend], None]] = None, **kwargs):
+        """
+        Calls chat.completions.create() on the best backend ("model" is set to the deployment of the backend)
+
+        :param served_by: optional, called with the backend that answered (f.e. to label the metrics with its deployment)
+        :returns ChatCompletion or an iterator of ChatCompletionChunk (if stream is set)
+        :raises the error of the last backend, if no backend succeeded
+        """
+        tried = [ ]
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise lastError
+            if len(tried) > 0:
+                self._failovers.inc()
+            tried.append(backend)
+            release = self._releaser(backend)
+            start = time.monotonic()
+            try:
+                result = backend.getClient().chat.completions.create(**dict(kwargs, model = backend.getDeploymentName()))
+                if served_by is not None:
+                    served_by(backend)
+                if not kwargs.get("stream"):
+                    release()
+                    self._recordLatency(backend, time.monotonic() - start)
+                    return result
+                first = next(result, _BackendStream._empty)
+                self._recordLatency(backend, time.monotonic() - start)
+                return _BackendStream(result, first, release)
+            except Exception as e:
+                release()
+                if not self._handleError(backend, e):
+                    raise
+                lastError = e
+
+    async def acreate(self, served_by : Union[None, Callable[[OpenAIBackend], None]] = None, **kwargs):
+        """
+        asyncio variant of create() (the backends have to use AsyncAzureOpenAI clients)
+        """
+        tried = [ ]
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise lastError
+            if len(tried) > 0:
+                self._failovers.inc()
+            tried.append(backend)
+            release = self._releaser(backend)
+            start = time.monotonic()
+            try:
+                result = await backend.getClient().chat.completions.create(**dict(kwargs, model = backend.getDeploymentName()))
+                if served_by is not None:
+                    served_by(backend)
+                if not kwargs.get("stream"):
+                    release()
+                    self._recordLatency(backend, time.monotonic() - start)
+                    return result
+                try:
+                    first = await result.__anext__()
+                except StopAsyncIteration:
+                    first = _AsyncBackendStream._empty
+                self._recordLatency(backend, time.monotonic() - start)
+                return _AsyncBackendStream(result, first, release)
+            except Exception as e:
+                release()
+                if not self._handleError(backend, e):
+                    raise
+                lastError = e
+
+
+def create_backend_pool_from_env(client_class = AzureOpenAI) -> Union[None, OpenAIBackendPool]:
+    """
+    Creates the backend pool configured in OPENAI_BACKENDS
+
+    :param client_class: AzureOpenAI or AsyncAzureOpenAI
+    :returns OpenAIBackendPool or None, if OPENAI_BACKENDS is not set
+    :raises ValueError: in case of an invalid configuration
+    """
+    config = os.getenv("OPENAI_BACKENDS", "")
+    if config.strip() == "":
+        return None
+    try:
+        config = json.loads(config)
+    except json.JSONDecodeError as e:
+        raise ValueError("OPENAI_BACKENDS is not valid JSON: " + str(e))
+    if not isinstance(config, list):
+        raise ValueError("OPENAI_BACKENDS must be a JSON list")
+    defaultDeployment = os.getenv("OPENAI_DEPLOYMENT_NAME", "")
+    if defaultDeployment == "":
+        defaultDeployment = "gpt-4o"
+    httpClient = get_shared_openai_http_client(issubclass(client_class, AsyncAzureOpenAI))
+    backends = [ ]
+    for b in config:
+        if not isinstance(b, dict) or str(b.get("endpoint", "")) == "":
+            raise ValueError("Every backend in OPENAI_BACKENDS requires an endpoint")
+        deployment = str(b.get("deployment", defaultDeployment))
+        if str(b.get("api_key", "")) == "":
+            client = client_class(
+                azure_endpoint = str(b["endpoint"]),
+                azure_ad_token_provider = get_bearer_token_provider(get_default_credential(), "https://cognitiveservices.azure.com/.default"),
+                api_version = "2024-02-01",
+                max_retries = 0,
+                http_client = httpClient
+            )
+        else:
+            client = client_class(
+                azure_endpoint = str(b["endpoint"]),
+                api_key = str(b["api_key"]),
+                api_version = "2024-02-01",
+                max_retries = 0,
+                http_client = httpClient
+            )
+        backends.append(OpenAIBackend(
+            str(b.get("name", str(b["endpoint"]).rstrip("/") + "/" + deployment)),
+            client,
+            deployment,
+            float(b.get("weight", 1)),
+            int(b.get("priority", 0))
+        ))
+    return OpenAIBackendPool(
+        backends,
+        float(os.getenv("OPENAI_BACKEND_FAILURE_COOLDOWN", "10")),
+        float(os.getenv("OPENAI_BACKEND_DEFAULT_RETRY_AFTER", "10"))
+    )
@@ -0,0 +1,134 @@
+import io, os, threading
+from collections import OrderedDict
+from typing import Union, List, BinaryIO
+from pypdf import PdfReader, PdfWriter
+from pypdf.errors import PyPdfError
+from .metrics import get_counter
+
+"""
+Environment variables used for the pdf page extraction:
+CHATBOT_PDF_PAGES_CACHE_SIZE_MB     Optional, max. size of the extracted pages cache in MB (default: 128)
+CHATBOT_PDF_PAGES_MAX_PAGES         Optional, max. number of pages that can be extracted at once (default: 10)
+"""
+
+
+def parse_page_list(pages : str, max_pages : int = 10) -> List[int]:
+    """
+    Parses a comma separated list of (0-based) page numbers and ranges, f.e. "3,5-7"
+
+    :param pages: str
+    :param max_pages: int, max. number of pages
+    :returns List[int], sorted and unique page numbers
+    :raises ValueError: in case of an invalid list or too many pages
+    """
+    result = set()
+    for part in str(pages).split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start)
+            end = int(end)
+            if start < 0 or end < start:
+                raise ValueError("Invalid page range: " + part)
+            if end - start >= max_pages:
+                raise ValueError("Too many pages requested")
+            result.update(range(start, end + 1))
+        else:
+            if int(part) < 0:
+                raise ValueError("Invalid page: " + part)
+            result.add(int(part))
+        if len(result) > max_pages:
+            raise ValueError("Too many pages requested")
+    if len(result) == 0:
+        raise ValueError("No pages requested")
+    return sorted(result)
+
+
+def extract_pdf_pages(source : Union[str, bytes, BinaryIO], pages : List[int]) -> bytes:
+    """
+    Creates a new pdf document that contains only the given pages
+
+    :param source: str (file path), bytes or file object of the pdf document
+    :param pages: List[int], 0-based page numbers
+    :returns bytes, the new pdf document
+    :raises ValueError: in case a page does not exist or the document can not be read (corrupt or truncated)
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        reader = PdfReader(source)
+        writer = PdfWriter()
+        for p in pages:
+            if p < 0 or p >= len(reader.pages):
+                raise ValueError("Page " + str(p) + " does not exist")
+            writer.add_page(reader.pages[p])
+        output = io.BytesIO()
+        writer.write(output)
+    except PyPdfError as e:
+        raise ValueError("Pdf document can not be read: " + str(e))
+    return output.getvalue()
+
+
+class PdfPagesCache:
+    """
+    Size bounded in-memory LRU cache of extracted pages, keyed by blob path, blob ETag and page list
+    """
+    _max_size : int
+    _size : int = 0
+    _entries : OrderedDict
+    _lock : threading.Lock
+
+    def __init__(self, max_size : int = 128 * 1024 * 1024):
+        self._max_size = int(max_size)
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = get_counter("pdf_pages_cache_hits_total", "Number of extracted pdf pages served from the cache")
+        self._misses = get_counter("pdf_pages_cache_misses_total", "Number of pdf page extractions")
+
+    @staticmethod
+    def _key(path : str, etag : str, pages : List[int]) -> tuple:
+        return (str(path), str(etag), tuple(pages))
+
+    def get(self, path : str, etag : str, pages : List[int]) -> Union[None, bytes]:
+        key = self._key(path, etag, pages)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+        if data is None:
+            self._misses.inc()
+        else:
+            self._hits.inc()
+        return data
+
+    def set(self, path : str, etag : str, pages : List[int], data : bytes):
+        key = self._key(path, etag, pages)
+        if len(data) > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self._max_size:
+                _, removed = self._entries.popitem(last = False)
+                self._size -= len(removed)
+
+
+_shared_pdf_pages_cache : Union[None, PdfPagesCache] = None
+_shared_pdf_pages_cache_lock = threading.Lock()
+
+def get_shared_pdf_pages_cache() -> PdfPagesCache:
+    """
+    Returns the PdfPagesCache of this worker process (created on first use)
+    """
+    global _shared_pdf_pages_cache
+    if _shared_pdf_pages_cache is not None:
+        return _shared_pdf_pages_cache
+    with _shared_pdf_pages_cache_lock:
+        if _shared_pdf_pages_cache is None:
+            _shared_pdf_pages_cache = PdfPagesCache(int(os.getenv("CHATBOT_PDF_PAGES_CACHE_SIZE_MB", "128")) * 1024 * 1024)
+    return _shared_pdf_pages_cache
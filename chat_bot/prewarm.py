@@ -0,0 +1,97 @@
+import os, time
+from typing import Callable
+
+"""
+Environment variables used for the pre-warm phase of the worker processes:
+CHATBOT_PREWARM     Optional, import the sdks, create the clients, acquire the access tokens and open the connections
+                    before a worker accepts requests (gunicorn, see gunicorn.conf.py), true or false (default: false)
+"""
+
+OPENAI_TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+def is_prewarm_enabled() -> bool:
+    return str(os.getenv("CHATBOT_PREWARM", "false")).lower() in [ "true", "on", "yes", "enabled", "enable", "1" ]
+
+
+def _import_modules():
+    # the modules the routes import on first use (see views.py)
+    from . import easy_chat, azurestorage, pdfpages, admission
+
+
+def _get_openai_token():
+    # the clients without an api key use the shared credential, its token is cached (see azurecredential.py)
+    if os.getenv("OPENAI_API_KEY") is None:
+        from .azurecredential import get_default_credential
+        get_default_credential().get_token(OPENAI_TOKEN_SCOPE)
+
+
+def _open_openai_connections(client):
+    from openai import APIStatusError
+    for c in client.getOpenAIClients():
+        try:
+            c.with_options(max_retries = 0).models.list()
+        except APIStatusError:
+            # the connection is open, the endpoint does not need to support the models list
+            pass
+
+
+def _open_search_connection(client):
+    # the azure_search data source is queried by the model, only a direct retriever has its own connection
+    retriever = client.getRetriever()
+    if retriever is not None:
+        retriever.getIndexVersion()
+
+
+def _open_blob_storage_connection():
+    from .azurestorage import get_shared_blob_storage
+    # no retries, an unreachable storage must not delay the start of the worker
+    get_shared_blob_storage().hasPath(".prewarm", retry_total = 0)
+
+
+def _step(timings : dict, name : str, fn : Callable[[], None]):
+    start = time.perf_counter()
+    try:
+        fn()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    except Exception as e:
+        # a step that fails is done again by the first request that needs it
+        timings[name] = None
+        print("Prewarm step", name, "failed:", str(e))
+
+
+def prewarm(asynchronous : bool = False) -> dict:
+    """
+    Prepares this worker process for the first requests: imports the sdks, loads the configuration, creates the chat client,
+    acquires the access tokens and opens the connections to azure openai, the search index and the blob storage.
+    Every step is optional, a step that fails is skipped.
+
+    :param asynchronous: bool, prepare the AsyncEasyChatClient of the asgi app (its connections belong to the event loop
+                         of the worker and are not opened here)
+    :returns dict, step name -> milliseconds (None if the step failed)
+    """
+    from .config import get_config
+    timings = { }
+    start = time.perf_counter()
+    _step(timings, "imports", _import_modules)
+    _step(timings, "config", get_config)
+    clients = [ ]
+    def create_client():
+        if asynchronous:
+            from .asgi import get_shared_async_chat_client
+            clients.append(get_shared_async_chat_client())
+        else:
+            from .views import get_shared_chat_client
+            clients.append(get_shared_chat_client())
+    _step(timings, "chat_client", create_client)
+    _step(timings, "openai_token", _get_openai_token)
+    if len(clients) > 0:
+        if not asynchronous:
+            _step(timings, "openai_connection", lambda: _open_openai_connections(clients[0]))
+        _step(timings, "search_connection", lambda: _open_search_connection(clients[0]))
+    _step(timings, "blob_storage_connection", _open_blob_storage_connection)
+    print(
+        "Prewarm finished in %.0f ms:" % ((time.perf_counter() - start) * 1000),
+        ", ".join([ name + " " + ("failed" if ms is None else str(ms) + " ms") for name, ms in timings.items() ])
+    )
+    return timings
@@ -0,0 +1,192 @@
+import asyncio, copy, re, threading, time
+from typing import Union, List, Callable, Awaitable
+from urllib.parse import quote
+import requests
+from .azurecredential import get_default_credential
+from .lrucache import LRUCache
+from .metrics import get_counter
+
+"""
+Environment variables used for the retrieval of EasyChatClient:
+CHATBOT_RETRIEVAL                       Optional, query the search index directly (with a result cache) instead of the azure_search data source (default: false)
+CHATBOT_RETRIEVAL_CACHE_SIZE            Optional, max. number of cached search results (default: 1000)
+CHATBOT_RETRIEVAL_CACHE_TTL             Optional, seconds a search result is cached (default: 600)
+CHATBOT_RETRIEVAL_INDEX_CHECK_INTERVAL  Optional, seconds between checks of the search index version (default: 300)
+"""
+
+
+def get_azure_search_index_version(api_base : str, index_name : str, api_key : str = "") -> str:
+    """
+    Returns a version string of the search index that changes whenever documents are added, changed or removed
+
+    :param api_base: str, the azure search endpoint
+    :param index_name: str
+    :param api_key: str, optional, if empty the default credential is used
+    :returns str
+    """
+    headers = { }
+    if api_key != "":
+        headers["api-key"] = api_key
+    else:
+        headers["Authorization"] = "Bearer " + get_default_credential().get_token("https://search.azure.com/.default").token
+    r = requests.get(
+        api_base.rstrip("/") + "/indexes/" + quote(index_name) + "/stats",
+        params = { "api-version": "2024-07-01" },
+        headers = headers,
+        timeout = 10
+    )
+    r.raise_for_status()
+    stats = r.json()
+    return str(stats.get("documentCount")) + "-" + str(stats.get("storageSize"))
+
+
+def normalize_query(query : str) -> str:
+    """
+    Normalizes a search query for the result cache (case, punctuation and whitespace are ignored)
+    """
+    return " ".join(re.sub(r'[^\w]+', " ", str(query).lower()).split())
+
+
+class AzureSearchRetriever:
+    """
+    Queries the search index directly (semantic hybrid search) and caches the results.
+    Results are cached by the normalized query, the filter, the number of documents and the version of the index,
+    so a changed index is never answered from the cache.
+    """
+    _api_base : str
+    _index_name : str
+    _api_key : str
+    _semantic_configuration : str
+    _cache : LRUCache
+    _index_version : str = ""
+    _index_checked_at : float = 0
+    _index_check_interval : float = 300
+
+    def __init__(
+        self,
+        api_base : str,
+        index_name : str,
+        api_key : str = "",
+        semantic_configuration : str = "",
+        cache_size : int = 1000,
+        cache_ttl : float = 600,
+        index_check_interval : float = 300
+    ):
+        """
+        Create a new AzureSearchRetriever
+
+        :param api_base: str, the azure search endpoint
+        :param index_name: str
+        :param api_key: str, optional, if empty the default credential is used
+        :param semantic_configuration: str, optional, default is '<index_name>-semantic-configuration'
+        :param cache_size: int, max. number of cached search results
+        :param cache_ttl: float, seconds a search result is cached
+        :param index_check_interval: float, seconds between checks of the index version
+        """
+        if str(api_base) == "":
+            raise ValueError("api_base is required")
+        self._api_base = str(api_base).rstrip("/")
+        self._index_name = str(index_name)
+        self._api_key = str(api_key)
+        self._semantic_configuration = str(semantic_configuration) if str(semantic_configuration) != "" else self._index_name + "-semantic-configuration"
+        self._cache = LRUCache(cache_size, cache_ttl)
+        self._index_version = ""
+        self._index_checked_at = 0
+        self._index_check_interval = float(index_check_interval)
+        self._index_lock = threading.Lock()
+        # one session per retriever, the connections to the search service are reused
+        self._session = requests.Session()
+        self._hits = get_counter("chat_retrieval_cache_hits_total", "Number of searches answered from the retrieval cache")
+        self._misses = get_counter("chat_retrieval_cache_misses_total", "Number of searches sent to the search index")
+
+    def _getHeaders(self) -> dict:
+        if self._api_key != "":
+            return { "api-key": self._api_key }
+        return { "Authorization": "Bearer " + get_default_credential().get_token("https://search.azure.com/.default").token }
+
+    def getIndexVersion(self) -> str:
+        """
+        Returns the (periodically refreshed) version of the index, the last known version is kept if the index stats are not accessible
+        """
+        if time.monotonic() - self._index_checked_at < self._index_check_interval:
+            return self._index_version
+        with self._index_lock:
+            if time.monotonic() - self._index_checked_at >= self._index_check_interval:
+                self._index_checked_at = time.monotonic()
+                try:
+                    self._index_version = get_azure_search_index_version(self._api_base, self._index_name, self._api_key)
+                except Exception:
+                    pass
+        return self._index_version
+
+    def clearCache(self):
+        self._cache.clear()
+
+    def _search(self, query : str, filter : str, top_n : int, vector : Union[None, list] = None) -> List[dict]:
+        body = {
+            "search": query,
+            "top": top_n,
+            "select": "chunk_id,title,chunk,metadata_storage_path",
+            "queryType": "semantic",
+            "semanticConfiguration": self._semantic_configuration,
+            # without an embedding of the query, the vectorizer of the index embeds it
+            "vectorQueries": [ { "kind": "text", "text": query, "fields": "text_vector", "k": top_n } ]
+        }
+        if vector is not None:
+            body["vectorQueries"] = [ { "kind": "vector", "vector": [ float(v) for v in vector ], "fields": "text_vector", "k": top_n } ]
+        if filter != "":
+            body["filter"] = filter
+        r = self._session.post(
+            self._api_base + "/indexes/" + quote(self._index_name) + "/docs/search",
+            params = { "api-version": "2024-07-01" },
+            headers = self._getHeaders(),
+            json = body,
+            timeout = 30
+        )
+        r.raise_for_status()
+        # same fields as the citations of the azure_search data source (filepath_field: chunk_id, url_field: metadata_storage_path)
+        return [
+            {
+                "content": str(d.get("chunk") or ""),
+                "title": str(d.get("title") or ""),
+                "url": str(d.get("metadata_storage_path") or ""),
+                "filepath": str(d.get("chunk_id") or "")
+            }
+            for d in r.json().get("value", [ ])
+        ]
+
+    def search(self, query : str, filter : str = "", top_n : int = 5, embed : Union[None, Callable[[str], list]] = None) -> List[dict]:
+        """
+        Returns the top_n chunks for the query (from the cache, if the same query was searched with the same filter before)
+
+        :param query: str
+        :param filter: str, optional, OData filter (f.e. the filter of the role)
+        :param top_n: int, number of chunks
+        :param embed: function, optional, returns the embedding of the query (only called for a cache miss), if not set the index embeds the query
+        :returns List[dict] with content, title, url and filepath
+        :raises requests.HTTPError: if the search fails
+        """
+        key = (normalize_query(query), str(filter), int(top_n), self.getIndexVersion())
+        documents = self._cache.get(key)
+        if documents is None:
+            self._misses.inc()
+            documents = self._search(query, str(filter), int(top_n), None if embed is None else embed(query))
+            self._cache.set(key, documents)
+        else:
+            self._hits.inc()
+        return copy.deepcopy(documents)
+
+    async def asearch(self, query : str, filter : str = "", top_n : int = 5, embed : Union[None, Callable[[str], Awaitable[list]]] = None) -> List[dict]:
+        """
+        asyncio variant of search() (the embed function has to be awaitable, the search runs in a thread)
+        """
+        key = (normalize_query(query), str(filter), int(top_n), await asyncio.to_thread(self.getIndexVersion))
+        documents = self._cache.get(key)
+        if documents is None:
+            self._misses.inc()
+            vector = None if embed is None else await embed(query)
+            documents = await asyncio.to_thread(self._search, query, str(filter), int(top_n), vector)
+            self._cache.set(key, documents)
+        else:
+            self._hits.inc()
+        return copy.deepcopy(documents)
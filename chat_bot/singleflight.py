@@ -0,0 +1,278 @@
+import asyncio, copy, threading
+from typing import Any, Callable, Awaitable, Generator, AsyncGenerator, Iterator, AsyncIterator
+from .metrics import get_counter
+
+
+def _count_coalesced():
+    get_counter("chat_requests_coalesced_total", "Number of chat requests that joined an identical running upstream request").inc()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SharedStream:
+    """
+    Fans out the items of one upstream iterator to many subscribers.
+    There is no background thread: whichever subscriber needs the next item pulls it from upstream,
+    so the stream keeps going as long as at least one subscriber is connected.
+    """
+    def __init__(self, iterator : Iterator, on_finished : Callable[[], None]):
+        self._iterator = iterator
+        self._on_finished = on_finished
+        self._items = []
+        self._done = False
+        self._error = None
+        self._pumping = False
+        self._subscribers = 0
+        self._cond = threading.Condition()
+
+    def subscribe(self) -> Generator[Any, None, None]:
+        with self._cond:
+            self._subscribers += 1
+        return self._iterate()
+
+    def _finish(self, error = None):
+        # no new subscriber can join a finished stream
+        self._on_finished()
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._pumping = False
+            self._cond.notify_all()
+
+    def _iterate(self) -> Generator[Any, None, None]:
+        index = 0
+        try:
+            while True:
+                pump = False
+                with self._cond:
+                    while index >= len(self._items) and not self._done and self._pumping:
+                        self._cond.wait()
+                    if index < len(self._items):
+                        item = self._items[index]
+                    elif self._done:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    else:
+                        self._pumping = True
+                        pump = True
+                if pump:
+                    try:
+                        item = next(self._iterator)
+                    except StopIteration:
+                        self._finish()
+                        continue
+                    except Exception as e:
+                        self._finish(e)
+                        raise
+                    except BaseException:
+                        # the subscriber was interrupted, not the upstream: another subscriber pulls the next item
+                        with self._cond:
+                            self._pumping = False
+                            self._cond.notify_all()
+                        raise
+                    with self._cond:
+                        self._items.append(item)
+                        self._pumping = False
+                        self._cond.notify_all()
+                index += 1
+                yield item
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+                abandoned = self._subscribers == 0 and not self._done
+            if abandoned:
+                # the last subscriber went away: no new subscriber can join from now on,
+                # the upstream is stopped unless one joined in the meantime
+                self._on_finished()
+                with self._cond:
+                    abandoned = self._subscribers == 0 and not self._done
+                    if abandoned:
+                        self._done = True
+                        self._cond.notify_all()
+            if abandoned:
+                try:
+                    self._iterator.close()
+                except AttributeError:
+                    pass
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls (same key) into one call, thread-safe.
+    Results are shared by all callers that arrived while the call was running.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = { }
+        self._streams = { }
+
+    def do(self, key : str, fn : Callable[[], Any]) -> Any:
+        """
+        Calls fn() unless an identical call is running, in which case its result is awaited (every caller gets a copy)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        else:
+            _count_coalesced()
+            call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result if leader else copy.deepcopy(call.result)
+
+    def stream(self, key : str, factory : Callable[[], Iterator]) -> Generator[Any, None, None]:
+        """
+        Returns the items of factory() or joins an identical running stream (late joiners get all items from the start)
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None:
+                def finished():
+                    with self._lock:
+                        if self._streams.get(key) is shared:
+                            del self._streams[key]
+                shared = _SharedStream(factory(), finished)
+                self._streams[key] = shared
+            else:
+                _count_coalesced()
+            return shared.subscribe()
+
+
+class _AsyncSharedStream:
+    """
+    asyncio variant of _SharedStream. The items are pulled from upstream by a task of the stream (started by the subscriber
+    that needs the next item), so a cancelled subscriber (f.e. a client that disconnected) does not stop the stream for the others.
+    """
+    def __init__(self, iterator : AsyncIterator, on_finished : Callable[[], None]):
+        self._iterator = iterator
+        self._on_finished = on_finished
+        self._items = []
+        self._done = False
+        self._error = None
+        self._pump = None
+        self._subscribers = 0
+        self._cond = asyncio.Condition()
+
+    def subscribe(self) -> AsyncGenerator[Any, None]:
+        self._subscribers += 1
+        return self._iterate()
+
+    async def _pumpNext(self):
+        try:
+            item = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            await self._finish()
+            return
+        except asyncio.CancelledError:
+            # the stream was abandoned (see _iterate)
+            raise
+        except Exception as e:
+            await self._finish(e)
+            return
+        async with self._cond:
+            self._items.append(item)
+            self._pump = None
+            self._cond.notify_all()
+
+    async def _finish(self, error = None):
+        # no new subscriber can join a finished stream
+        self._on_finished()
+        async with self._cond:
+            self._done = True
+            self._error = error
+            self._pump = None
+            self._cond.notify_all()
+
+    async def _iterate(self) -> AsyncGenerator[Any, None]:
+        index = 0
+        try:
+            while True:
+                async with self._cond:
+                    while index >= len(self._items) and not self._done:
+                        if self._pump is None:
+                            self._pump = asyncio.ensure_future(self._pumpNext())
+                        await self._cond.wait()
+                    if index < len(self._items):
+                        item = self._items[index]
+                    elif self._error is not None:
+                        raise self._error
+                    else:
+                        return
+                index += 1
+                yield item
+        finally:
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self._done:
+                # the last subscriber went away, stop the upstream (no new subscriber can join from now on)
+                self._on_finished()
+                self._done = True
+                pump = self._pump
+                self._pump = None
+                if pump is not None:
+                    pump.cancel()
+                    try:
+                        await pump
+                    except BaseException:
+                        pass
+                try:
+                    await self._iterator.aclose()
+                except AttributeError:
+                    pass
+
+
+class AsyncSingleFlight:
+    """
+    asyncio variant of SingleFlight (for use within one event loop)
+    """
+    def __init__(self):
+        self._calls = { }
+        self._streams = { }
+
+    async def do(self, key : str, fn : Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Awaits fn() unless an identical call is running, in which case its result is awaited (every caller gets a copy).
+        The call runs in its own task, so a cancelled caller does not cancel it for the others.
+        """
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            def finished(t):
+                if self._calls.get(key) is t:
+                    del self._calls[key]
+            task.add_done_callback(finished)
+        else:
+            _count_coalesced()
+        result = await asyncio.shield(task)
+        return result if leader else copy.deepcopy(result)
+
+    def stream(self, key : str, factory : Callable[[], AsyncIterator]) -> AsyncGenerator[Any, None]:
+        shared = self._streams.get(key)
+        if shared is None:
+            def finished():
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+            shared = _AsyncSharedStream(factory(), finished)
+            self._streams[key] = shared
+        else:
+            _count_coalesced()
+        return shared.subscribe()
@@ -54,6 +54,7 @@ class ChatManager {
     #restorePromptOnFailure = true;
     #streaming = true;
     #submitting = false;
+    #abortController = null;
 
     constructor(
         streaming = null,
@@ -181,6 +182,11 @@ class ChatManager {
     }
 
     async clearChat() {
+        // stop a running answer, the server then cancels the upstream completion
+        if(this.#abortController !== null) {
+            this.#abortController.abort();
+            this.#abortController = null;
+        }
         this.#chatMessages = [];
         this.#chatBubblesContainer.innerHTML = "";
         this.#submitting = false;
@@ -194,12 +200,81 @@ class ChatManager {
     }
 
 
-    async #fetchFromStreamingApi(message) {
+    #parseStreamRecord(line, compact) {
         const selectedChoice = 0;
+        var data = JSON.parse(line);
+        if(data === undefined || data === null || "error" in data) {
+            console.log("JSON Data", data);
+            throw new Error("Received invalid response");
+        }
+        if(compact) {
+            // compact stream: {"meta": ...}, {"context": ...}, {"d": "content"}, {"end": ...} - other records are ignored
+            if("i" in data && data.i != selectedChoice) {
+                return null;
+            }
+            return {
+                "context": ("context" in data) ? data.context : null,
+                "content": ("d" in data && data.d !== null) ? String(data.d) : null
+            };
+        }
+        if(!("choices" in data)) {
+            console.log("JSON Data", data);
+            throw new Error("Response does not contain choices");
+        }
+        const choice = data.choices[selectedChoice];
+        if(choice === undefined || choice.delta === undefined || choice.delta === null) {
+            return null;
+        }
+        return {
+            "context": (choice.delta.context !== undefined && choice.delta.context !== null) ? choice.delta.context : null,
+            "content": (choice.delta.content !== undefined && choice.delta.content !== null) ? String(choice.delta.content) : null
+        };
+    }
+
+    async #processStreamLines(lines, compact, mdRenderer) {
+        let mergedContent = "";
+        for(let i = 0; i < lines.length; i++) {
+            const line = lines[i].trim();
+            if(line == "") {
+                continue;
+            }
+            const record = this.#parseStreamRecord(line, compact);
+            if(record === null) {
+                continue;
+            }
+            if(mdRenderer === null) {
+                if(record.context === null && record.content === null) {
+                    continue;
+                }
+                // we have no renderer, so we need to create the renderer and process the first choice (with citations)
+                mdRenderer = await this.#processChoice({
+                    "delta": {
+                        "role": "assistant",
+                        "content": record.content,
+                        "context": (record.context !== null) ? record.context : { "citations": [] }
+                    }
+                });
+                continue;
+            }
+            // we have a renderer, so we need to merge the content
+            if(record.content !== null) {
+                mergedContent += record.content;
+            }
+        }
+        if(mergedContent != "") {
+            mdRenderer.addContent(mergedContent);
+        }
+        return mdRenderer;
+    }
+
+    async #fetchFromStreamingApi(message) {
         let mdRenderer = null;
 
-        const response = await fetch("/api/chat/stream", {
+        this.#abortController = new AbortController();
+        // request the compact stream format, older servers answer with the full records
+        const response = await fetch("/api/chat/stream?format=compact", {
             method: "POST",
+            signal: this.#abortController.signal,
             headers: {
                 "Content-Type": "application/json"
             },
@@ -207,6 +282,7 @@ class ChatManager {
                 "messages": this.#chatMessages
             })
         });
+        const compact = (response.headers.get("X-Chat-Stream-Format") === "compact");
         const reader = response.body.getReader();
         const decoder = new TextDecoder("utf-8");
         let { value: chunk, done: readerDone } = await reader.read();
@@ -217,73 +293,27 @@ class ChatManager {
                 buffer += decoder.decode(chunk, { stream: true });
                 let lines = buffer.split("\n");
                 buffer = lines.pop(); // keep the last (partial) line in the buffer
-
                 if(lines.length > 0) {
-                    if(mdRenderer === null) {
-                        // we have no renderer, so we need to create the renderer and process the first choice (with citations)
-                        while(lines.length > 0) {
-                            let line = lines.shift().trim();
-                            if(line != "") {
-                                var data = JSON.parse(line);
-                                if(data === undefined || data === null || "error" in data) {
-                                    console.log("JSON Data", data);
-                                    throw new Error("Received invalid response");
-                                }
-                                if(!("choices" in data)) {
-                                    console.log("JSON Data", data);
-                                    throw new Error("Response does not contain choices");
-                                }
-                                mdRenderer = await this.#processChoice(data.choices[selectedChoice]);
-                                break;
-                            }
-                        }
-                    }
-                    // we have a renderer, so we need to merge the content
-                    let mergedContent = "";
-                    while(lines.length > 0) {
-                        let line = lines.shift().trim();
-                        if(line != "") {
-                            var data = JSON.parse(line);
-                            if(data === undefined || data === null || "error" in data) {
-                                console.log("JSON Data", data);
-                                throw new Error("Received invalid response");
-                            }
-                            if(!("choices" in data)) {
-                                console.log("JSON Data", data);
-                                throw new Error("Response does not contain choices");
-                            }
-                            if(data.choices[selectedChoice].delta.content !== undefined && data.choices[selectedChoice].delta.content !== null) {
-                                mergedContent += String(data.choices[selectedChoice].delta.content);
-                            }
-                        }
-                    }
-                    if(mergedContent != "") {
-                        mdRenderer.addContent(mergedContent);
-                    }
+                    mdRenderer = await this.#processStreamLines(lines, compact, mdRenderer);
                 }
                 ({ value: chunk, done: readerDone } = await reader.read());
             }
-            buffer = buffer.trim();
-            if(buffer != "") {
-                console.log("Buffer", buffer);
-                var data = JSON.parse(line);
-                if(data === undefined || data === null || "error" in data) {
-                    console.log("JSON Data", data);
-                    throw new Error("Received invalid response");
-                }
-                if(!("choices" in data)) {
-                    console.log("JSON Data", data);
-                    throw new Error("Response does not contain choices");
-                }
-                if(data.choices[selectedChoice].delta.content !== undefined && data.choices[selectedChoice].delta.content !== null) {
-                    mdRenderer.addContent(data.choices[selectedChoice].delta.content);
-                }
+            mdRenderer = await this.#processStreamLines([ buffer ], compact, mdRenderer);
+            if(mdRenderer === null) {
+                throw new Error("Received empty response");
             }
         }
         catch(e) {
+            if(e.name === "AbortError") {
+                console.log("Streaming aborted");
+                return false;
+            }
             console.error("Error while processing choice", e);
             return false;
         }
+        finally {
+            this.#abortController = null;
+        }
 
         this.#chatMessages.pop();
         this.#chatMessages.push({
@@ -365,6 +395,9 @@ class ChatManager {
             }
         }
         catch(e) {
+            if(e.name === "AbortError") {
+                return;
+            }
             if(this.#restorePromptOnFailure) {
                 this.#popLastChatMessage()
                 this.#chatTextBox.value = message;
@@ -71,7 +71,7 @@ class StoragePDFRenderer {
         this.#documentCache.clear();
     }
 
-    async renderPDF(citation) {
+    async renderPDF(citation, fullDocument = false) {
         console.log("Rendering PDF", citation);
         if(citation === undefined || citation === null) {
             console.error("Invalid citation");
@@ -97,47 +97,60 @@ class StoragePDFRenderer {
         const rootDiv = document.createElement("div");
         rootDiv.style.display = "none";
         this.#modalWindow.addElement(rootDiv);
+        // just the cited pages are loaded (extracted on the server), unless the full document is requested
+        const pageNumbers = [...new Set(citation.pages.map(p => parseInt(p)))].filter(p => p >= 0).sort((a, b) => a - b);
+        const citedPagesOnly = !fullDocument && pageNumbers.length > 0;
+        if(citedPagesOnly) {
+            const fullDocumentLink = document.createElement("a");
+            fullDocumentLink.href = "#";
+            fullDocumentLink.innerText = "Show the whole document";
+            fullDocumentLink.addEventListener("click", (event) => {
+                event.preventDefault();
+                this.renderPDF(citation, true);
+            });
+            rootDiv.appendChild(fullDocumentLink);
+        }
         // open the modal window
         this.#modalWindow.open();
         // size of the modal body
         const bodySize = this.#modalWindow.getModalBodySize();
 
-        var pdfBlob = await this.#documentCache.get(
-            citation.storageaccount_blob + '|' + citation.storageaccount_container + '|' + citation.storageaccount_name,
+        // pdf.js loads the document with range requests, so only the required parts are transferred
+        const params = {
+            "storageaccount_blob" : citation.storageaccount_blob,
+            "storageaccount_container" : citation.storageaccount_container,
+            "storageaccount_name" : citation.storageaccount_name
+        };
+        if(citedPagesOnly) {
+            params["pages"] = pageNumbers.join(",");
+        }
+        var pdf = await this.#documentCache.get(
+            citation.storageaccount_blob + '|' + citation.storageaccount_container + '|' + citation.storageaccount_name + (citedPagesOnly ? '|' + params["pages"] : ''),
             () => {
-                return fetch(
-                    "/api/blobstorage/file?" + (new URLSearchParams([ ...Object.entries({
-                        "storageaccount_blob" : citation.storageaccount_blob,
-                        "storageaccount_container" : citation.storageaccount_container,
-                        "storageaccount_name" : citation.storageaccount_name
-                    })])).toString(), 
-                    {
-                        method: 'GET',
-                        cache: 'no-cache'
-                    }
-                ).then(response => response.blob());
+                return pdfjsLib.getDocument({
+                    url: (citedPagesOnly ? "/api/blobstorage/file/pages?" : "/api/blobstorage/file?") + (new URLSearchParams([ ...Object.entries(params)])).toString(),
+                    disableAutoFetch: true,
+                    rangeChunkSize: 262144
+                }).promise.catch(error => {
+                    console.error("Failed to load the PDF", error);
+                    return null;
+                });
             }
         );
-        if(pdfBlob === null) {
-            console.error("Failed to fetch the PDF Blob");
-            this.#modalWindow.close();
-            return;
-        }
-        if(pdfBlob.size === 0) {
-            console.error("PDF Blob is empty");
-            this.#modalWindow.close();
-            return;
+        if(pdf === null && citedPagesOnly) {
+            console.log("Failed to fetch the cited pages, loading the whole document");
+            return await this.renderPDF(citation, true);
         }
-        if(pdfBlob.type !== "application/pdf") {
-            console.error("PDF Blob is not a PDF file:", pdfBlob.type);
+        if(pdf === null) {
+            console.error("Failed to fetch the PDF");
             this.#modalWindow.close();
             return;
         }
-        var pdfData = await new Response(pdfBlob).arrayBuffer();
-        var pdf = await pdfjsLib.getDocument({data: pdfData}).promise;
         var pdfPages = pdf.numPages;
         console.log("PDF Pages", pdfPages);
         for(var i = 0; i < pdfPages; i++) {
+            // page number in the original document
+            var originalPage = citedPagesOnly ? pageNumbers[i] : i;
             var pdfPage = await pdf.getPage(i + 1);
             var pdfViewport = pdfPage.getViewport({scale: 1.5});
             var pdfCanvas = document.createElement("canvas");
@@ -165,8 +178,8 @@ class StoragePDFRenderer {
             pdfImage.src = pdfCanvas.toDataURL();
             pdfImage.style.width = "100%";
             pdfImage.style.height = "auto";
-            pdfImage.id = "pdf-canvas-page" + i;
-            pdfImage.title = "Page " + (i + 1);
+            pdfImage.id = "pdf-canvas-page" + originalPage;
+            pdfImage.title = "Page " + (originalPage + 1);
             rootDiv.appendChild(pdfImage);
         }
         loaderDiv.style.display = "none";
@@ -174,7 +187,7 @@ class StoragePDFRenderer {
         // async sleep to allow the layout to update
         await new Promise(r => setTimeout(r, 250));
         // Scroll to the first citation page
-        if(citation.pages.length > 0 && citation.pages[0] > 0 && citation.pages[0] <= pdfPages) {
+        if(!citedPagesOnly && citation.pages.length > 0 && citation.pages[0] > 0 && citation.pages[0] < pdfPages) {
             document.getElementById("pdf-canvas-page" + citation.pages[0]).scrollIntoView();
         }
         return;
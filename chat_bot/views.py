@@ -1,33 +1,44 @@
 from datetime import datetime, timedelta
-import json, io, hashlib, os
+import json, io, hashlib, hmac, os, math, zlib, threading
+from urllib.parse import quote
 from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file, stream_with_context, Response
-from . import app, all_defined_users
+from . import app
 from .iam import ChatbotUser, iam_login_required, iam_get_current_user, iam_is_authenticated, USE_AUTH_TYPE
 from flask_login import login_user, logout_user
-from .easy_chat import EasyChatClient, dict_to_chat_messages
-from .azurestorage import BlobStorage
-
-chatClient = EasyChatClient()
-# get the path of the current script
-try:
-    systemPromptFewshotPath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "system-prompt-fewshot-examples.md")
-    systemPromptPath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "system-prompt.md")
-    systemPrompt = ""
-    systemPromptFewshot = ""
-    if os.path.exists(systemPromptPath):
-        with open(systemPromptPath, "r") as f:
-            systemPrompt = f.read()
-        systemPrompt = systemPrompt.strip()
-        if systemPrompt != "":
-            chatClient.setSystemMessage(systemPrompt)
-    if os.path.exists(systemPromptFewshotPath):
-        with open(systemPromptFewshotPath, "r") as f:
-            systemPromptFewshot = f.read()
-        systemPromptFewshot = systemPromptFewshot.strip()
-        if systemPromptFewshot != "":
-            chatClient.setFewShotExamples([systemPromptFewshot])
-except:
-    pass
+from .metrics import RequestTimings, render_prometheus
+from .config import get_config, get_shared_config_watcher
+# the openai and azure sdks (easy_chat, azurestorage, pdfpages, admission) are imported by the routes that use them,
+# so a worker serves the login and the ui without loading them (see prewarm.py)
+
+def load_system_prompts(client):
+    # system-prompt.md and system-prompt-fewshot-examples.md of the configuration, applied again on every reload (see config.py)
+    defaultSystemMessage = client.getSystemMessage()
+    get_shared_config_watcher().addListener(
+        lambda config: client.setSystemPrompts(
+            config.getSystemMessage() if config.getSystemMessage() != "" else defaultSystemMessage,
+            config.getFewShotExamples()
+        )
+    )
+
+_shared_chat_client = None
+_shared_chat_client_lock = threading.Lock()
+
+def get_shared_chat_client():
+    """
+    Returns the EasyChatClient of this worker process (created on first use)
+
+    :returns EasyChatClient
+    """
+    global _shared_chat_client
+    if _shared_chat_client is not None:
+        return _shared_chat_client
+    with _shared_chat_client_lock:
+        if _shared_chat_client is None:
+            from .easy_chat import EasyChatClient
+            client = EasyChatClient()
+            load_system_prompts(client)
+            _shared_chat_client = client
+    return _shared_chat_client
 
 
 def getChatbotConfig() -> dict:
@@ -43,6 +54,25 @@ def getChatbotConfig() -> dict:
     return c
 
 
+def admitChatRequest(user : ChatbotUser, messages : list):
+    """
+    Applies the admission control to a chat request, returns the function to call when the request is finished
+
+    :raises AdmissionRejectedError: if the user or role exceeds a limit or the request queue is full
+    """
+    from .admission import get_shared_admission_controller
+    admission = get_shared_admission_controller()
+    if admission is None:
+        return lambda: None
+    return admission.admit(user.id, user.getRole().getName(), messages)
+
+def getFileCacheControl() -> str:
+    maxAge = int(os.getenv("CHATBOT_FILE_BROWSER_MAX_AGE", "0"))
+    if maxAge <= 0:
+        return "private, no-cache"
+    return "private, max-age=" + str(maxAge)
+
+
 #region -------- WEB/UI ENDPOINTS --------
 @app.route("/")
 def home():
@@ -67,9 +97,9 @@ def login():
     if request.method == "POST":
         # user exists?
         username = str(request.form.get("username")).lower().strip()
-        if username not in all_defined_users:
+        user = get_config().getUser(username)
+        if user is None:
             return render_template("login.html", message="User not found", user=iam_get_current_user())
-        user = all_defined_users[username]
         # Check the username (again)
         if str(user.username).lower().strip() != username:
             return render_template("login.html", message="Invalid credentials", user=iam_get_current_user())
@@ -94,45 +124,160 @@ def login():
 @iam_login_required
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
-    user = iam_get_current_user()
+    from .easy_chat import dict_to_chat_messages
+    from .admission import AdmissionRejectedError
+    from .azurestorage import get_shared_blob_storage
+    timings = RequestTimings()
+    with timings.measure("auth"):
+        user = iam_get_current_user()
     if user is None:
         return jsonify({"success": False, "error": "Not logged in"}), 404
+    timings.setLabel("role", user.getRole().getName())
+    try:
+        messages = dict_to_chat_messages(request.get_json())
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    try:
+        with timings.measure("admission"):
+            release = admitChatRequest(user, messages)
+    except AdmissionRejectedError as e:
+        return jsonify({"success": False, "error": str(e)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
     try:
-        bs = BlobStorage()
-        chatClient.setSearchFilterFromRole(user.getRole(), bs.getBaseUrl())
-        return jsonify(
-            chatClient.chat(
-                dict_to_chat_messages(request.get_json())
-            )
-        ), 200
+        with timings.measure("setup"):
+            bs = get_shared_blob_storage()
+            chatClient = get_shared_chat_client()
+            context = chatClient.createRequestContext(role = user.getRole(), storage_base_url = bs.getBaseUrl(), timings = timings)
+        answer = chatClient.chat(
+            messages,
+            context = context
+        )
+        with timings.measure("response"):
+            response = jsonify(answer)
+        response.headers["Server-Timing"] = timings.toServerTiming()
+        return response, 200
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        release()
+        timings.finish()
+
+def withTimingsRecord(records, timings : RequestTimings):
+    """
+    Appends a record with the timings of the request to a streamed answer
+    """
+    yield from records
+    yield json.dumps({ "timings": timings.getAll(), "tokens_per_second": timings.getTokensPerSecond() }) + "\n"
+
+def useStreamGzip() -> bool:
+    """
+    Returns True if the compact stream should be gzipped (CHATBOT_STREAM_GZIP and the client accepts gzip)
+    """
+    if str(os.getenv("CHATBOT_STREAM_GZIP", "false")).lower() not in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+        return False
+    return "gzip" in str(request.headers.get("Accept-Encoding", "")).lower()
+
+def gzipStream(chunks):
+    """
+    Compresses a stream with gzip, every chunk is flushed so the client can render it right away
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
 
 @iam_login_required
 @app.route("/api/chat/stream", methods=["POST"])
 def api_chat_stream():
-    user = iam_get_current_user()
+    from .easy_chat import dict_to_chat_messages
+    from .admission import AdmissionRejectedError
+    from .azurestorage import get_shared_blob_storage
+    timings = RequestTimings()
+    with timings.measure("auth"):
+        user = iam_get_current_user()
     if user is None:
         return jsonify({"success": False, "error": "Not logged in"}), 404
+    timings.setLabel("role", user.getRole().getName())
     try:
-        bs = BlobStorage()
-        chatClient.setSearchFilterFromRole(user.getRole(), bs.getBaseUrl())
-        return Response(
-            stream_with_context(
-                chatClient.streamedChat(
-                    dict_to_chat_messages(request.get_json()),
-                    outputFormat = "json"
-                )
-            ),
+        messages = dict_to_chat_messages(request.get_json())
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    try:
+        with timings.measure("admission"):
+            release = admitChatRequest(user, messages)
+    except AdmissionRejectedError as e:
+        return jsonify({"success": False, "error": str(e)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
+    try:
+        with timings.measure("setup"):
+            bs = get_shared_blob_storage()
+            chatClient = get_shared_chat_client()
+            context = chatClient.createRequestContext(role = user.getRole(), storage_base_url = bs.getBaseUrl(), timings = timings)
+        # clients can request the compact stream format (see EasyChatCompactStreamEncoder)
+        compact = str(request.args.get("format", "")).lower() == "compact"
+        records = chatClient.streamedChat(
+            messages,
+            outputFormat = "compact" if compact else "json",
+            context = context
+        )
+        # the timings of the answer are only known at the end, clients can request them as the last record
+        if str(request.args.get("timings", "false")).lower() in [ "true", "on", "yes", "1" ]:
+            records = withTimingsRecord(records, timings)
+        gzip = compact and useStreamGzip()
+        if gzip:
+            records = gzipStream(records)
+        response = Response(
+            stream_with_context(records),
             200,
-            content_type="application/json"
+            content_type = "application/x-ndjson" if compact else "application/json"
         )
+        if compact:
+            response.headers["X-Chat-Stream-Format"] = "compact"
+        if gzip:
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Server-Timing"] = timings.toServerTiming()
+        # the slot is used until the stream is finished
+        response.call_on_close(release)
+        response.call_on_close(timings.finish)
+        return response
     except Exception as e:
+        release()
+        timings.finish()
         return jsonify({"success": False, "error": str(e)}), 500
 
+@iam_login_required
+@app.route("/api/chat/citation/<citation_id>", methods=["GET"])
+def api_chat_citation(citation_id):
+    from .azurestorage import get_shared_blob_storage
+    user = iam_get_current_user()
+    if user is None:
+        return jsonify({"success": False, "error": "Not logged in"}), 404
+    # the full texts are scoped by the search filter of the role, other roles get a 404
+    bs = get_shared_blob_storage()
+    chatClient = get_shared_chat_client()
+    context = chatClient.createRequestContext(role = user.getRole(), storage_base_url = bs.getBaseUrl())
+    content = chatClient.getCitationContent(citation_id, context)
+    if content is None:
+        return jsonify({"success": False, "error": "Citation does not exist"}), 404
+    response = jsonify({"success": True, "id": citation_id, "content": content})
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # the metrics are disabled by default, they are summed up over the worker processes (CHATBOT_METRICS_DIR, see metrics.py)
+    if str(os.getenv("CHATBOT_METRICS", "false")).lower() not in [ "true", "on", "yes", "enabled", "enable", "1" ]:
+        return jsonify({"success": False, "error": "Not found"}), 404
+    token = os.getenv("CHATBOT_METRICS_TOKEN", "")
+    if token != "" and not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    return Response(render_prometheus(), 200, content_type = "text/plain; version=0.0.4; charset=utf-8")
+
 @iam_login_required
 @app.route("/api/blobstorage/file", methods=["GET"])
 def api_blobstorage_pdf():
+    from azure.core import MatchConditions
+    from azure.core.exceptions import HttpResponseError
+    from .azurestorage import get_shared_blob_storage, get_shared_blob_file_cache
     # check for required parameters
     if not request.args.get("storageaccount_name") or not request.args.get("storageaccount_container") or not request.args.get("storageaccount_blob"):
         return jsonify({"success": False, "error": "Missing parameters"}), 400
@@ -143,20 +288,176 @@ def api_blobstorage_pdf():
         mimetype = "application/pdf"
     else:
         return jsonify({"success": False, "error": "Invalid file type"}), 406
-    bs = BlobStorage()
-    if not bs.hasFullPath(
+    bs = get_shared_blob_storage()
+    if not bs.isAccountAndContainer(
         account_name = request.args.get("storageaccount_name"),
-        container_name = request.args.get("storageaccount_container"),
-        path = request.args.get("storageaccount_blob")
+        container_name = request.args.get("storageaccount_container")
     ):
         return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
-    # send the file
-    return send_file(
-        io.BytesIO(bs.downloadBinary(request.args.get("storageaccount_blob"))),
-        mimetype = mimetype,
-        as_attachment = True,
-        download_name = str(request.args.get("storageaccount_blob")).split("/")[-1]
-    ), 200
+    downloadName = str(request.args.get("storageaccount_blob")).split("/")[-1]
+    # serve from the local file cache (send_file handles If-None-Match and Range requests)
+    fileCache = get_shared_blob_file_cache()
+    downloader = None
+    if fileCache is not None:
+        # the file can be evicted by another worker process before it is opened, it is downloaded once more
+        for attempt in range(2):
+            entry = fileCache.getFile(request.args.get("storageaccount_blob"))
+            if entry is None:
+                return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+            if not entry.isCached():
+                # larger than the cache, the download is streamed below (range and conditional requests are passed to the storage)
+                if request.range is None and request.headers.get("If-None-Match", "") == "":
+                    downloader = entry.getDownloader()
+                break
+            try:
+                response = send_file(
+                    entry.getFilePath(),
+                    mimetype = mimetype,
+                    as_attachment = True,
+                    download_name = downloadName,
+                    etag = entry.getETag().strip('"'),
+                    conditional = True
+                )
+            except FileNotFoundError:
+                continue
+            response.headers["Cache-Control"] = getFileCacheControl()
+            return response
+    # single byte range requests are passed to the storage (multiple or suffix ranges get the full file)
+    offset = None
+    length = None
+    if downloader is None and request.range is not None and request.range.units == "bytes" and len(request.range.ranges) == 1:
+        begin, end = request.range.ranges[0]
+        if begin >= 0:
+            offset = begin
+            if end is not None:
+                length = end - begin
+    # a browser revalidating its copy gets a 304 from the storage
+    conditions = { }
+    ifNoneMatch = request.headers.get("If-None-Match", "").strip()
+    if ifNoneMatch != "" and ifNoneMatch != "*" and "," not in ifNoneMatch:
+        conditions = { "etag": ifNoneMatch, "match_condition": MatchConditions.IfModified }
+    # download without a separate existence check, not found is reported by the download itself
+    if downloader is None:
+        try:
+            downloader = bs.downloadStream(request.args.get("storageaccount_blob"), offset, length, **conditions)
+        except HttpResponseError as e:
+            if e.status_code == 304:
+                return Response(status = 304, headers = { "ETag": ifNoneMatch, "Cache-Control": getFileCacheControl() })
+            if e.status_code == 416:
+                return jsonify({"success": False, "error": "Range not satisfiable"}), 416
+            raise
+        if downloader is None:
+            return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+    # stream the file
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(downloader.size),
+        "Content-Disposition": "attachment; filename*=UTF-8''" + quote(downloadName),
+        "ETag": str(downloader.properties.etag),
+        "Cache-Control": getFileCacheControl()
+    }
+    status = 200
+    if offset is not None and downloader.properties.content_range:
+        totalSize = str(downloader.properties.content_range).split("/")[-1]
+        headers["Content-Range"] = "bytes " + str(offset) + "-" + str(offset + downloader.size - 1) + "/" + totalSize
+        status = 206
+    return Response(
+        stream_with_context(downloader.chunks()),
+        status,
+        headers = headers,
+        mimetype = mimetype
+    )
+
+@iam_login_required
+@app.route("/api/blobstorage/file/pages", methods=["GET"])
+def api_blobstorage_pdf_pages():
+    from azure.core import MatchConditions
+    from azure.core.exceptions import HttpResponseError
+    from .azurestorage import get_shared_blob_storage, get_shared_blob_file_cache
+    from .pdfpages import parse_page_list, extract_pdf_pages, get_shared_pdf_pages_cache
+    # check for required parameters
+    if not request.args.get("storageaccount_name") or not request.args.get("storageaccount_container") or not request.args.get("storageaccount_blob") or not request.args.get("pages"):
+        return jsonify({"success": False, "error": "Missing parameters"}), 400
+    # check for supported file type
+    if str(request.args.get("storageaccount_blob")).split(".")[-1] != "pdf":
+        return jsonify({"success": False, "error": "Invalid file type"}), 406
+    try:
+        pages = parse_page_list(request.args.get("pages"), int(os.getenv("CHATBOT_PDF_PAGES_MAX_PAGES", "10")))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    bs = get_shared_blob_storage()
+    if not bs.isAccountAndContainer(
+        account_name = request.args.get("storageaccount_name"),
+        container_name = request.args.get("storageaccount_container")
+    ):
+        return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+    blobPath = request.args.get("storageaccount_blob")
+    # get the etag of the blob (the source file is only required for a cache miss)
+    fileCache = get_shared_blob_file_cache()
+    entry = None
+    if fileCache is not None:
+        entry = fileCache.getFile(blobPath)
+        etag = None if entry is None else entry.getETag()
+    else:
+        etag = bs.getETag(blobPath)
+    if etag is None:
+        return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+    pagesCache = get_shared_pdf_pages_cache()
+    data = pagesCache.get(blobPath, etag, pages)
+    source = None
+    if data is None and entry is not None:
+        # the file can be evicted by another worker process before it is opened, it is downloaded once more
+        for attempt in range(2):
+            if not entry.isCached():
+                source = entry.getDownloader().readall()
+                break
+            try:
+                with open(entry.getFilePath(), "rb") as f:
+                    source = f.read()
+                break
+            except FileNotFoundError:
+                if attempt > 0:
+                    raise
+            entry = fileCache.getFile(blobPath)
+            if entry is None:
+                return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+            etag = entry.getETag()
+    elif data is None:
+        # the blob can change after getETag(), the download then fails (412) and is done once more with the new etag
+        for attempt in range(2):
+            try:
+                downloader = bs.downloadStream(blobPath, etag = etag, match_condition = MatchConditions.IfNotModified)
+                if downloader is None:
+                    return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+                source = downloader.readall()
+                break
+            except HttpResponseError as e:
+                if e.status_code != 412:
+                    raise
+                if attempt > 0:
+                    return jsonify({"success": False, "error": "Pdf document was modified during the download"}), 409
+            etag = bs.getETag(blobPath)
+            if etag is None:
+                return jsonify({"success": False, "error": "Pdf document does not exist"}), 404
+            data = pagesCache.get(blobPath, etag, pages)
+            if data is not None:
+                break
+    if data is None:
+        try:
+            data = extract_pdf_pages(source, pages)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 416
+        pagesCache.set(blobPath, etag, pages, data)
+    response = send_file(
+        io.BytesIO(data),
+        mimetype = "application/pdf",
+        download_name = str(blobPath).split("/")[-1],
+        etag = hashlib.sha256((etag + "|" + ",".join(str(p) for p in pages)).encode("utf-8")).hexdigest(),
+        conditional = True
+    )
+    response.headers["Cache-Control"] = getFileCacheControl()
+    response.headers["X-Pdf-Pages"] = ",".join(str(p) for p in pages)
+    return response
 #endregion -------- API ENDPOINTS --------
 
 
@@ -0,0 +1,27 @@
+"""
+Gunicorn settings of the chatbot, loaded by gunicorn from the working directory (see startup.sh).
+The command line options of startup.sh take precedence.
+"""
+import os
+
+ENABLED = [ "true", "on", "yes", "enabled", "enable", "1" ]
+
+
+def on_starting(server):
+    # the metrics of all workers are summed up in /metrics (CHATBOT_METRICS_DIR, see chat_bot/metrics.py),
+    # the workers inherit the environment of the master
+    if str(os.getenv("CHATBOT_METRICS", "false")).lower() in ENABLED:
+        os.environ.setdefault("CHATBOT_METRICS_DIR", "/tmp/chatbot-metrics")
+        # the files of the previous server (the app is not imported by the master)
+        directory = os.environ["CHATBOT_METRICS_DIR"]
+        if os.path.isdir(directory):
+            for fileName in os.listdir(directory):
+                if fileName.startswith("metrics-") or fileName.startswith(".metrics-"):
+                    os.remove(os.path.join(directory, fileName))
+
+
+def post_worker_init(worker):
+    # prepare the worker before it accepts requests (CHATBOT_PREWARM, see chat_bot/prewarm.py)
+    from chat_bot.prewarm import is_prewarm_enabled, prewarm
+    if is_prewarm_enabled():
+        prewarm(asynchronous = "uvicorn" in str(getattr(worker.cfg, "worker_class_str", "")).lower())
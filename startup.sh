@@ -1,2 +1,6 @@
 cd /app
-gunicorn --bind=0.0.0.0 --workers=10 startup:app
+if [ "${CHATBOT_SERVER_MODE:-wsgi}" = "asgi" ]; then
+    gunicorn --bind=0.0.0.0 --workers=${GUNICORN_WORKERS:-4} --worker-class uvicorn.workers.UvicornWorker startup_asgi:app
+else
+    gunicorn --bind=0.0.0.0 --workers=${GUNICORN_WORKERS:-10} --threads=${GUNICORN_THREADS:-1} startup:app
+fi
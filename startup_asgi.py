@@ -0,0 +1,8 @@
+"""
+ASGI counterpart of startup.py: the chat endpoints are served with asyncio (see chat_bot/asgi.py),
+all other routes by the flask app. Specify startup_asgi:app with an ASGI worker, f.e.:
+
+gunicorn --worker-class uvicorn.workers.UvicornWorker startup_asgi:app
+"""
+
+from chat_bot.asgi import app